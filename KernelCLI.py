@@ -246,6 +246,8 @@ class KernelCLI(Cmd):
             "getheight": "Get the current blockchain height",
             "getconfig": "Display the current config settings",
             "getinfo": "Display informations about node's status",
+            "gettxoutsetinfo": "Display statistics about the UTXO set",
+            "dumptxoutset [path]": "Write a UTXO set snapshot for fast bootstrap",
             "settings": "Open a menu to edit your config",
             "ping": "Check connection with the daemon",
             "help": "Show help menu",
@@ -277,6 +279,38 @@ class KernelCLI(Cmd):
             print(f"  {Colors.OKCYAN}Wallets Loaded:{Colors.ENDC} {wallets}")
             print(f"  {Colors.BOLD}--------------------------{Colors.ENDC}\n")
 
+    def do_gettxoutsetinfo(self, arg):
+        print(f"{Colors.WARNING}Fetching UTXO set info...{Colors.ENDC}", end="\r")
+        response = self.rpc_call({"command": "gettxoutsetinfo"})
+        sys.stdout.write(" " * 30 + "\r")
+        if response:
+            info = response.get("info", {})
+            print(f"\n  {Colors.BOLD}--- UTXO Set ---{Colors.ENDC}")
+            print(f"  {Colors.OKCYAN}Height:{Colors.ENDC}       {info.get('height')}")
+            print(
+                f"  {Colors.OKCYAN}Best Block:{Colors.ENDC}   {info.get('bestblock')}"
+            )
+            print(f"  {Colors.OKCYAN}UTXOs:{Colors.ENDC}        {info.get('txouts')}")
+            print(
+                f"  {Colors.OKCYAN}Total Amount:{Colors.ENDC} {info.get('total_amount')} KOR"
+            )
+            print(
+                f"  {Colors.OKCYAN}Size:{Colors.ENDC}         {info.get('serialized_size')} bytes"
+            )
+            print(f"  {Colors.BOLD}----------------{Colors.ENDC}\n")
+
+    def do_dumptxoutset(self, arg):
+        print(f"{Colors.WARNING}Dumping UTXO set...{Colors.ENDC}", end="\r")
+        params = {"path": arg.strip()} if arg.strip() else {}
+        response = self.rpc_call({"command": "dumptxoutset", "params": params})
+        sys.stdout.write(" " * 30 + "\r")
+        if response:
+            info = response.get("info", {})
+            print(
+                f"{Colors.OKGREEN}Snapshot written:{Colors.ENDC} {info.get('path')} ({info.get('coins')} UTXOs at height {info.get('height')})"
+            )
+            print(f"  {Colors.OKCYAN}Commitment:{Colors.ENDC} {info.get('commitment')}")
+
     def do_ping(self, arg):
         print(f"{Colors.WARNING}Pinging daemon...{Colors.ENDC}", end="\r")
         response = self.rpc_call({"command": "ping"})
@@ -0,0 +1,83 @@
+import json
+from collections import deque
+from queue import Empty, Full, Queue
+from threading import Lock
+
+KEEPALIVE_INTERVAL = 15  # seconds between comments on an idle stream
+RETRY_DELAY = 1000  # milliseconds clients wait before reconnecting
+
+
+class Subscription:
+    def __init__(self, max_queued):
+        self.queue = Queue(max_queued)
+        # Set when the client fell behind, it gets what is queued then reconnects
+        self.dropped = False
+
+
+class EventBroadcaster:
+    """Sends published events to every Server-Sent Events client
+
+    Each client has a bounded queue, so a slow client cannot hold events in
+    memory. Recent events are kept to replay them to a client reconnecting
+    with Last-Event-ID; one that missed more gets a resync event instead.
+    """
+
+    def __init__(self, max_queued=1000, history=1000):
+        self.max_queued = max_queued
+        self.history = deque(maxlen=history)
+        self.subscriptions = set()
+        self.last_id = 0
+        self.lock = Lock()
+
+    def publish(self, event, data):
+        with self.lock:
+            self.last_id += 1
+            message = (self.last_id, event, json.dumps(data))
+            self.history.append(message)
+            for subscription in list(self.subscriptions):
+                try:
+                    subscription.queue.put_nowait(message)
+                except Full:
+                    subscription.dropped = True
+                    self.subscriptions.discard(subscription)
+
+    def subscribe(self, last_event_id=None):
+        subscription = Subscription(self.max_queued)
+        with self.lock:
+            if last_event_id is not None and last_event_id != self.last_id:
+                missed = [m for m in self.history if m[0] > last_event_id]
+                if (
+                    last_event_id > self.last_id
+                    or not missed
+                    or missed[0][0] != last_event_id + 1
+                    or len(missed) > self.max_queued
+                ):
+                    missed = [(self.last_id, "resync", "{}")]
+                for message in missed:
+                    subscription.queue.put_nowait(message)
+            self.subscriptions.add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self.lock:
+            self.subscriptions.discard(subscription)
+
+    def has_subscribers(self):
+        return bool(self.subscriptions)
+
+    def stream(self, subscription):
+        """text/event-stream body for subscription, ends when the client leaves"""
+        try:
+            yield f"retry: {RETRY_DELAY}\n\n"
+            while not subscription.dropped or not subscription.queue.empty():
+                try:
+                    event_id, event, data = subscription.queue.get(
+                        timeout=KEEPALIVE_INTERVAL
+                    )
+                except Empty:
+                    # Also how a closed connection is noticed
+                    yield ": keepalive\n\n"
+                    continue
+                yield f"id: {event_id}\nevent: {event}\ndata: {data}\n\n"
+        finally:
+            self.unsubscribe(subscription)
@@ -0,0 +1,242 @@
+import hashlib
+import logging
+from threading import RLock
+
+from src.core.coin import p2pkh_h160
+from src.utils.serialization import encode_base58
+
+logger = logging.getLogger(__name__)
+
+MAIN_PREFIX = b"\x6c"
+HASHRATE_WINDOW = 120  # blocks
+STATS_DAYS = 30
+
+
+def h160_to_address(h160_bytes):
+    payload = MAIN_PREFIX + h160_bytes
+    checksum = hashlib.sha256(hashlib.sha256(payload).digest()).digest()[:4]
+    return encode_base58(payload + checksum)
+
+
+def get_miner_address(block):
+    if not block or not block.Txs or not block.Txs[0].is_coinbase():
+        return "N/A"
+    h160 = p2pkh_h160(block.Txs[0].tx_outs[0].script_pubkey)
+    return h160_to_address(h160) if h160 else "Error Reading Miner Address"
+
+
+class BlockSummary:
+    """What the explorer lists about a block, without its transactions"""
+
+    __slots__ = ("hash", "height", "timestamp", "tx_count", "size", "miner")
+
+    def __init__(self, block_hash, height, timestamp, tx_count, size, miner):
+        self.hash = block_hash
+        self.height = height
+        self.timestamp = timestamp
+        self.tx_count = tx_count
+        self.size = size
+        self.miner = miner
+
+    @classmethod
+    def from_block(cls, block, block_hash):
+        return cls(
+            block_hash,
+            block.Height,
+            block.BlockHeader.timestamp,
+            len(block.Txs),
+            block.Blocksize,
+            get_miner_address(block),
+        )
+
+    @classmethod
+    def from_record(cls, height, record):
+        block_hash, timestamp, tx_count, size, miner = record
+        miner = h160_to_address(miner) if miner else "Error Reading Miner Address"
+        return cls(block_hash, height, timestamp, tx_count, size, miner)
+
+    @classmethod
+    def from_index(cls, index_entry):
+        # Pruned blocks and blocks below a snapshot only have a header
+        return cls(
+            index_entry.hash, index_entry.height, index_entry.timestamp, 0, 0, "N/A"
+        )
+
+
+class ExplorerReadModel:
+    """Explorer view of the active chain, kept up to date by ChainManager events
+
+    Only a summary per block is held in memory, loaded from the block
+    records of ChainStatsDB, which also has the chain totals. The coin
+    supply comes from the UTXO set statistics. Blocks and transactions are
+    read from the block files when requested, found by height, block hash
+    (block index) or txid (txindex).
+    """
+
+    def __init__(self, db, txindex, chainstats, utxos):
+        self.db = db
+        self.txindex = txindex
+        self.chainstats = chainstats
+        self.utxos = utxos
+        self.lock = RLock()
+        self.summaries = []
+
+    def load(self):
+        with self.lock:
+            self.chain_reset()
+            records = self.chainstats.iter_records()
+            record = next(records, None)
+            for index_entry in list(self.db.active_chain):
+                while record and record[0] < index_entry.height:
+                    record = next(records, None)
+                self.summaries.append(self.get_block_summary(index_entry, record))
+        logger.info(f"Explorer read model loaded {len(self.summaries)} blocks")
+
+    def sync(self):
+        """Catches up with a chain written by another process, see BlockchainDB.refresh
+
+        Returns the index entries of the disconnected and connected blocks.
+        """
+        with self.lock:
+            disconnected, connected = self.db.refresh()
+            self.chainstats.reload()
+            for index_entry in disconnected:
+                del self.summaries[index_entry.height :]
+            for index_entry in connected:
+                record = self.chainstats.get_record(index_entry.height)
+                del self.summaries[index_entry.height :]
+                self.summaries.append(
+                    self.get_block_summary(index_entry, (index_entry.height, record))
+                )
+            return disconnected, connected
+
+    @staticmethod
+    def get_block_summary(index_entry, record):
+        """Summary from the (height, record) stored for index_entry, if it has one"""
+        if (
+            record
+            and record[1]
+            and record[0] == index_entry.height
+            and record[1][0] == index_entry.hash
+        ):
+            return BlockSummary.from_record(index_entry.height, record[1])
+        # Blocks below an unvalidated snapshot or pruned before a rebuild
+        return BlockSummary.from_index(index_entry)
+
+    def chain_reset(self):
+        with self.lock:
+            self.summaries = []
+
+    def block_connected(self, block, block_undo=None):
+        block_hash = block.BlockHeader.generateBlockHash()
+        with self.lock:
+            if len(self.summaries) != block.Height:
+                logger.warning(
+                    f"Read model at height {len(self.summaries) - 1} got block {block.Height}"
+                )
+                del self.summaries[block.Height :]
+            self.summaries.append(BlockSummary.from_block(block, block_hash))
+
+    def block_disconnected(self, block, block_undo=None):
+        block_hash = block.BlockHeader.generateBlockHash()
+        with self.lock:
+            if not self.summaries or self.summaries[-1].hash != block_hash:
+                logger.warning(f"Read model does not end with block {block_hash}")
+                return
+            self.summaries.pop()
+
+    def get_height(self):
+        return len(self.summaries) - 1
+
+    def get_tip_hash(self):
+        with self.lock:
+            return self.summaries[-1].hash if self.summaries else None
+
+    def get_summaries(self, start=0, end=None):
+        """Summaries of the blocks from height start up to (excluding) end"""
+        with self.lock:
+            return self.summaries[start:end]
+
+    def get_summary(self, height):
+        with self.lock:
+            if 0 <= height < len(self.summaries):
+                return self.summaries[height]
+            return None
+
+    def get_stats(self):
+        totals = self.chainstats.get_totals()
+        daily_transactions = totals["daily_transactions"]
+        days = sorted(daily_transactions)[-STATS_DAYS:]
+        return {
+            "total_transactions": totals["transactions"],
+            "active_addresses": totals["active_addresses"],
+            "total_fees": totals["fees"],
+            "coin_supply": self.utxos.get_stats()["total_amount"],
+            "daily_transactions": [
+                {"date": day, "transactions": daily_transactions[day]} for day in days
+            ],
+        }
+
+    def get_network_hashrate(self, window=HASHRATE_WINDOW):
+        """Hashes per second over the last window blocks, None below two blocks"""
+        with self.lock:
+            if len(self.summaries) < 2:
+                return None
+            tip_hash = self.summaries[-1].hash
+        tip = self.db.get_index(tip_hash)
+        first = tip.get_ancestor(max(0, tip.height - window))
+        elapsed = tip.timestamp - first.timestamp
+        if elapsed <= 0:
+            return None
+        return (tip.total_work - first.total_work) / elapsed
+
+    def get_block(self, block_hash):
+        """Active chain block with the coins its inputs spent, or (None, None)"""
+        index_entry = self.db.get_index(block_hash)
+        if not index_entry or not self.db.is_in_active_chain(index_entry):
+            return None, None
+        block = self.db.get_block(block_hash)
+        if not block:
+            return None, None
+        return block, self.db.get_block_undo(block_hash)
+
+    def find_tx(self, tx_id):
+        """Returns (block index entry, spent coins of the tx inputs, tx) or None
+
+        Only the tx and the coins it spent are read from the block and undo
+        files, at the offsets the txindex recorded for them.
+        """
+        location = self.txindex.get_location(tx_id)
+        if not location:
+            return None
+        block_hash, position, offset, length, undo_offset, undo_length = location
+        index_entry = self.db.get_index(block_hash)
+        if not index_entry or not self.db.is_in_active_chain(index_entry):
+            return None
+
+        if offset is None:
+            tx = None
+            block = self.db.get_block(block_hash)
+            for position, block_tx in enumerate(block.Txs if block else []):
+                if block_tx.TxId == tx_id:
+                    tx = block_tx
+                    break
+        else:
+            tx = self.db.get_block_tx(block_hash, offset, length)
+        if tx is None or tx.TxId != tx_id:
+            return None
+
+        if position == 0:
+            spent_coins = []
+        elif undo_offset is None:
+            spent_coins = get_spent_coins(self.db.get_block_undo(block_hash), position)
+        else:
+            spent_coins = self.db.get_tx_undo(block_hash, undo_offset, undo_length)
+        return index_entry, spent_coins or [], tx
+
+
+def get_spent_coins(block_undo, position):
+    """Coins spent by the inputs of the tx at position, [] for a coinbase"""
+    if position == 0 or not block_undo or position > len(block_undo.tx_undos):
+        return []
+    return block_undo.tx_undos[position - 1]
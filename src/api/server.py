@@ -1,108 +1,94 @@
-import hashlib
+import json
+import multiprocessing
+import socket
+import string
 import time
 from datetime import datetime, timezone
+from threading import Thread
 
-from flask import Flask, jsonify
+from flask import Flask, Response, jsonify, request
 from flask_cors import CORS
-
-from src.database.db_manager import BlockchainDB
-from src.utils.serialization import decode_base58, encode_base58
+from werkzeug.serving import make_server
+
+from src.api.cache import LRUCache
+from src.api.events import EventBroadcaster
+from src.api.read_model import (BlockSummary, ExplorerReadModel,
+                                get_spent_coins, h160_to_address)
+from src.core.coin import p2pkh_h160
+from src.database.db_manager import (UTXODB, AddressIndexDB, BlockchainDB,
+                                     ChainStatsDB, MempoolDB, TxIndexDB)
+from src.database.kvstore import CHAINSTATE_FILE, KVStore
+from src.utils.logging_config import setup_logging
+from src.utils.serialization import decode_base58
 
 app = Flask(__name__)
-CORS(app)
-MAIN_PREFIX = b"\x6c"
+CORS(app, expose_headers=["X-Next-Cursor"])
 KOR = 100000000
+DEFAULT_PAGE_LIMIT = 50
+MAX_PAGE_LIMIT = 500
+NDJSON_MIMETYPE = "application/x-ndjson"
+CACHE_MAX_AGE = 10  # seconds clients and proxies may reuse a response
+WORKER_SYNC_INTERVAL = 1  # seconds between chain refreshes of a worker process
+# Block and tx details, which only change when a reorg drops their block
+IMMUTABLE_CACHE = LRUCache(4096)
+# Rendered responses, keyed on the chain tip or mempool sequence they show
+RESPONSE_CACHE = LRUCache(1024)
+# Live chain and mempool events for /api/events
+EVENTS = EventBroadcaster()
 MEMPOOL = {}
 UTXOS = {}
-BLOCKCHAIN_CACHE = {"blocks": None, "last_update": 0}
-CACHE_TIMEOUT = 10
+BLOCKCHAIN_DB = None
+READ_MODEL = None
+ADDRESS_INDEX = None
+# Set in worker processes, which read the stores the node writes
+READ_ONLY = False
 
 
 # ==============================================================================
 
 
-# Store blockchain data in memory for quick access
-def get_blockchain_data():
-    global BLOCKCHAIN_CACHE
-    now = time.time()
-    if (
-        not BLOCKCHAIN_CACHE["blocks"]
-        or (now - BLOCKCHAIN_CACHE["last_update"]) > CACHE_TIMEOUT
-    ):
-        try:
-            blockchain_db = BlockchainDB()
-            blocks = blockchain_db.read()
-            if blocks:
-                BLOCKCHAIN_CACHE["blocks"] = blocks
-                BLOCKCHAIN_CACHE["last_update"] = now
-        except Exception as e:
-            app.logger.error(f"Error while fetching blockchain data: {e}")
-            return BLOCKCHAIN_CACHE["blocks"] if BLOCKCHAIN_CACHE["blocks"] else []
-
-    return BLOCKCHAIN_CACHE["blocks"]
+def format_timestamp(timestamp):
+    return datetime.fromtimestamp(timestamp, timezone.utc).isoformat()
 
 
-# encode a public key hash to a Base58Check address
-def encode_base58_checksum(h160_bytes):
-    payload = MAIN_PREFIX + h160_bytes
-    checksum = hashlib.sha256(hashlib.sha256(payload).digest()).digest()[:4]
-    full_payload = payload + checksum
-    return encode_base58(full_payload)
+def is_hex_hash(value):
+    return len(value) == 64 and all(c in string.hexdigits for c in value)
 
 
-# Find a transaction in a list of blocks by its ID
-def find_transaction_in_blocks(tx_id, blocks):
-    if not blocks:
-        return None
-    for block in blocks:
-        for tx in block.get("Txs", []):
-            if tx.get("TxId") == tx_id:
-                return tx
-    return None
+# Address paid by a script, "Error" for scripts without one
+def get_script_address(script_pubkey):
+    h160 = p2pkh_h160(script_pubkey)
+    return h160_to_address(h160) if h160 else "Error"
 
 
-# Format transaction details for API response
-def format_transaction_details(tx, block, blocks):
-    tx_id = tx.get("TxId")
-    total_in = 0
-    from_addresses = set()
-
-    for inp in tx.get("tx_ins", []):
-        if inp.get("prev_tx") == "00" * 32:
-            from_addresses.add("Coinbase")
-            continue
-        prev_tx_data = find_transaction_in_blocks(inp.get("prev_tx"), blocks)
+# Addresses spending and receiving in a tx, spent_coins comes from the undo data
+def get_tx_addresses(tx, spent_coins):
+    if tx.is_coinbase():
+        from_addresses = ["Coinbase"]
+    else:
+        from_addresses = list(
+            {get_script_address(coin.script_pubkey) for coin in spent_coins if coin}
+        )
+    to_addresses = [
+        {
+            "address": get_script_address(tx_out.script_pubkey),
+            "amount": tx_out.amount / KOR,
+        }
+        for tx_out in tx.tx_outs
+    ]
+    return from_addresses, to_addresses
 
-        if prev_tx_data:
-            try:
-                spent_output = prev_tx_data["tx_outs"][inp.get("prev_index")]
-                total_in += spent_output.get("amount", 0)
-                h160_bytes = bytes.fromhex(spent_output["script_pubkey"]["cmds"][2])
-                from_addresses.add(encode_base58_checksum(h160_bytes))
 
-            except (IndexError, KeyError, ValueError, TypeError):
-                from_addresses.add("Error")
+# Format transaction details for API response
+def format_transaction_details(tx, height, block_hash, spent_coins):
+    from_addresses, to_addresses_details = get_tx_addresses(tx, spent_coins)
+    total_in = sum(coin.amount for coin in spent_coins if coin)
+    total_out = sum(tx_out.amount for tx_out in tx.tx_outs)
 
-    total_out = sum(out.get("amount", 0) for out in tx.get("tx_outs", []))
-    to_addresses_details = []
     sent_value = 0
-
-    for out in tx.get("tx_outs", []):
-        try:
-            h160_bytes = bytes.fromhex(out["script_pubkey"]["cmds"][2])
-            recipient_address = encode_base58_checksum(h160_bytes)
-            amount = out.get("amount", 0)
-            to_addresses_details.append(
-                {"address": recipient_address, "amount": amount / KOR}
-            )
-
-            if recipient_address not in from_addresses:
-                sent_value += amount
-
-        except (IndexError, KeyError, ValueError, TypeError):
-            to_addresses_details.append(
-                {"address": "Error", "amount": out.get("amount", 0) / KOR}
-            )
+    for tx_out, recipient in zip(tx.tx_outs, to_addresses_details):
+        if recipient["address"] not in from_addresses:
+            sent_value += tx_out.amount
 
     if "Coinbase" in from_addresses:
         fee = 0
@@ -112,10 +98,10 @@ def format_transaction_details(tx, block, blocks):
         value = sent_value if sent_value > 0 else total_out
 
     return {
-        "hash": tx_id,
-        "block_height": block.get("Height"),
-        "block_hash": block.get("BlockHeader", {}).get("blockHash"),
-        "from": list(from_addresses),
+        "hash": tx.TxId,
+        "block_height": height,
+        "block_hash": block_hash,
+        "from": from_addresses,
         "to": [item["address"] for item in to_addresses_details],
         "value": value / KOR,
         "fee": fee / KOR,
@@ -123,22 +109,328 @@ def format_transaction_details(tx, block, blocks):
     }
 
 
-# Extract miner address from coinbase transaction of a block
-def get_miner_address(block):
-    if not block or not block.get("Txs"):
-        return "N/A"
+# limit query argument of the paginated endpoints
+def get_page_limit():
+    limit = request.args.get("limit", DEFAULT_PAGE_LIMIT, type=int)
+    return min(max(limit, 1), MAX_PAGE_LIMIT)
+
+
+# JSON list response, with the cursor of the next page in X-Next-Cursor
+def paginated_response(items, next_cursor):
+    response = jsonify(items)
+    if next_cursor is not None:
+        response.headers["X-Next-Cursor"] = str(next_cursor)
+    return response
 
-    coinbase_tx = block["Txs"][0]
-    if coinbase_tx.get("tx_ins", [{}])[0].get("prev_tx") == "00" * 32:
-        try:
-            h160_hex = coinbase_tx["tx_outs"][0]["script_pubkey"]["cmds"][2]
-            h160_bytes = bytes.fromhex(h160_hex)
-            return encode_base58_checksum(h160_bytes)
 
-        except (IndexError, KeyError, TypeError, ValueError):
-            return "Error Reading Miner Address"
+# Streams one JSON document per line, lines is generated while the body is sent
+def ndjson_response(lines):
+    return Response(
+        (json.dumps(line) + "\n" for line in lines), mimetype=NDJSON_MIMETYPE
+    )
+
+
+# Serves the response build() makes for key from RESPONSE_CACHE, with an ETag
+def cached_response(key, build):
+    cached = RESPONSE_CACHE.get(key)
+    if cached is None:
+        response = build()
+        if not isinstance(response, Response) or response.status_code != 200:
+            return response
+        response.add_etag()
+        headers = [
+            (name, value)
+            for name, value in response.headers.items()
+            if name != "Content-Length"
+        ]
+        cached = (response.get_data(), headers)
+        RESPONSE_CACHE.put(key, cached)
+
+    body, headers = cached
+    response = Response(body, headers=headers)
+    response.cache_control.public = True
+    response.cache_control.max_age = CACHE_MAX_AGE
+    return response.make_conditional(request)
+
+
+# Details of an active chain block or tx, build() returns (height, block hash, details)
+def get_immutable_details(key, build):
+    cached = IMMUTABLE_CACHE.get(key)
+    if cached is not None:
+        height, block_hash, details = cached
+        summary = READ_MODEL.get_summary(height)
+        if summary and summary.hash == block_hash:
+            return height, details
+    cached = build()
+    if cached is None:
+        return None, None
+    IMMUTABLE_CACHE.put(key, cached)
+    return cached[0], cached[2]
+
+
+# Details of a block whose data was pruned (or is not downloaded yet)
+def get_header_only_details(index_entry):
+    header = index_entry.get_header()
+    header.to_hex()
+    return {
+        "block_number": index_entry.height,
+        "hash": index_entry.hash,
+        "previous_hash": header.prevBlockHash,
+        "confirmations": READ_MODEL.get_height() + 1 - index_entry.height,
+        "merkle_root": header.merkleRoot,
+        "nonce": header.nonce,
+        "timestamp": format_timestamp(header.timestamp),
+        "transactions": [],
+        "version": header.version,
+        "bits": header.bits,
+        "pruned": BLOCKCHAIN_DB.is_pruned(index_entry.hash),
+    }
+
 
-    return "N/A"
+# Address history from the address index, without scanning the chain
+def get_indexed_address_details(public_address, target_h160):
+    entries = ADDRESS_INDEX.get_entries(target_h160)
+    txs = {}
+    for entry in entries:
+        received = txs.setdefault(
+            entry["txid"], {"height": entry["height"], "value_in": 0, "value_out": 0}
+        )
+        received["value_in"] += entry["amount"]
+        if entry["spent_by"]:
+            spent = txs.setdefault(
+                entry["spent_by"],
+                {"height": entry["spent_height"], "value_in": 0, "value_out": 0},
+            )
+            spent["value_out"] += entry["amount"]
+
+    total_received_kores = sum(entry["amount"] for entry in entries)
+    total_sent_kores = sum(entry["amount"] for entry in entries if entry["spent_by"])
+
+    address_transactions = []
+    for tx_id, tx_info in txs.items():
+        summary = READ_MODEL.get_summary(tx_info["height"])
+        if not summary:
+            continue
+
+        # Reads the tx and the coins it spent, not its whole block
+        from_addresses, to_addresses_details = [], []
+        found = READ_MODEL.find_tx(tx_id)
+        if found:
+            _, spent_coins, tx = found
+            from_addresses, to_addresses_details = get_tx_addresses(tx, spent_coins)
+
+        net_effect = tx_info["value_in"] - tx_info["value_out"]
+        address_transactions.append(
+            {
+                "hash": tx_id,
+                "block_height": summary.height,
+                "block_hash": summary.hash,
+                "timestamp": format_timestamp(summary.timestamp),
+                "from": from_addresses,
+                "to": to_addresses_details,
+                "direction": "IN" if net_effect >= 0 else "OUT",
+                "value": abs(net_effect) / KOR,
+            }
+        )
+
+    return {
+        "address": public_address,
+        "total_received": total_received_kores / KOR,
+        "total_sent": total_sent_kores / KOR,
+        "current_balance": (total_received_kores - total_sent_kores) / KOR,
+        "transaction_count": len(address_transactions),
+        "transactions": sorted(
+            address_transactions, key=lambda x: x["block_height"], reverse=True
+        ),
+    }
+
+
+# Entry of an address history, None if the tx neither pays nor spends target_h160
+def format_address_transaction(
+    tx, spent_coins, target_h160, height, block_hash, timestamp
+):
+    value_out = sum(
+        coin.amount
+        for coin in spent_coins
+        if coin and p2pkh_h160(coin.script_pubkey) == target_h160
+    )
+    value_in = sum(
+        tx_out.amount
+        for tx_out in tx.tx_outs
+        if p2pkh_h160(tx_out.script_pubkey) == target_h160
+    )
+    is_sender = any(
+        coin and p2pkh_h160(coin.script_pubkey) == target_h160 for coin in spent_coins
+    )
+    is_receiver = any(
+        p2pkh_h160(tx_out.script_pubkey) == target_h160 for tx_out in tx.tx_outs
+    )
+    if not is_sender and not is_receiver:
+        return None
+
+    net_effect = value_in - value_out
+    direction = "IN" if is_receiver else "OUT"
+    if is_sender and is_receiver:
+        direction = "OUT" if net_effect < 0 else "IN"
+
+    from_addresses, to_addresses_details = get_tx_addresses(tx, spent_coins)
+    formatted_tx = {
+        "hash": tx.TxId,
+        "block_height": height,
+        "block_hash": block_hash,
+        "timestamp": format_timestamp(timestamp),
+        "from": from_addresses,
+        "to": to_addresses_details,
+        "direction": direction,
+        "value": abs(net_effect) / KOR,
+    }
+    return formatted_tx, value_in, value_out
+
+
+# Address history read block by block, for nodes without the address index
+def get_scanned_address_details(public_address, target_h160):
+    total_received_kores = 0
+    total_sent_kores = 0
+    address_transactions = []
+
+    for summary in READ_MODEL.get_summaries():
+        block, block_undo = READ_MODEL.get_block(summary.hash)
+        if not block:
+            continue
+        for position, tx in enumerate(block.Txs):
+            formatted = format_address_transaction(
+                tx,
+                get_spent_coins(block_undo, position),
+                target_h160,
+                block.Height,
+                summary.hash,
+                summary.timestamp,
+            )
+            if formatted is None:
+                continue
+            formatted_tx, value_in, value_out = formatted
+            total_received_kores += value_in
+            total_sent_kores += value_out
+            address_transactions.append(formatted_tx)
+
+    return {
+        "address": public_address,
+        "total_received": total_received_kores / KOR,
+        "total_sent": total_sent_kores / KOR,
+        "current_balance": (total_received_kores - total_sent_kores) / KOR,
+        "transaction_count": len(address_transactions),
+        "transactions": sorted(
+            address_transactions, key=lambda x: x["block_height"], reverse=True
+        ),
+    }
+
+
+# Last line of a streamed address history
+def format_address_totals(public_address, received, sent, transaction_count):
+    return {
+        "address": public_address,
+        "total_received": received / KOR,
+        "total_sent": sent / KOR,
+        "current_balance": (received - sent) / KOR,
+        "transaction_count": transaction_count,
+    }
+
+
+def iter_scanned_address_lines(public_address, target_h160):
+    """Same history as get_scanned_address_details, one block in memory at a time"""
+    received, sent, transaction_count = 0, 0, 0
+    for height in range(READ_MODEL.get_height(), -1, -1):
+        summary = READ_MODEL.get_summary(height)
+        block, block_undo = (None, None)
+        if summary:
+            block, block_undo = READ_MODEL.get_block(summary.hash)
+        if not block:
+            continue
+        for position, tx in enumerate(block.Txs):
+            formatted = format_address_transaction(
+                tx,
+                get_spent_coins(block_undo, position),
+                target_h160,
+                height,
+                summary.hash,
+                summary.timestamp,
+            )
+            if formatted is None:
+                continue
+            formatted_tx, value_in, value_out = formatted
+            received += value_in
+            sent += value_out
+            transaction_count += 1
+            yield formatted_tx
+    yield format_address_totals(public_address, received, sent, transaction_count)
+
+
+# Address history entry of tx_id, read through the txindex
+# spent_outpoint is set when tx_id was found as the spender of that output
+def format_indexed_address_tx(tx_id, target_h160, spent_outpoint=None):
+    found = READ_MODEL.find_tx(tx_id)
+    if not found:
+        return None
+    index_entry, spent_coins, tx = found
+
+    if spent_outpoint is not None:
+        # Listed with its own outputs if it pays the address too, else with
+        # the first output of the address it spends
+        if any(p2pkh_h160(o.script_pubkey) == target_h160 for o in tx.tx_outs):
+            return None
+        first_input = next(
+            (
+                tx_in
+                for tx_in, coin in zip(tx.tx_ins, spent_coins)
+                if coin and p2pkh_h160(coin.script_pubkey) == target_h160
+            ),
+            None,
+        )
+        if (
+            first_input is None
+            or (first_input.prev_tx.hex(), first_input.prev_index) != spent_outpoint
+        ):
+            return None
+
+    formatted = format_address_transaction(
+        tx,
+        spent_coins,
+        target_h160,
+        index_entry.height,
+        index_entry.hash,
+        index_entry.timestamp,
+    )
+    return formatted[0] if formatted else None
+
+
+def iter_indexed_address_lines(public_address, target_h160):
+    """Address index history without holding it in memory
+
+    Entries are read newest output first. A tx is listed where its outputs to
+    the address are, or where the first output of the address it spends is,
+    so spending txs are not in strict height order.
+    """
+    received, sent, transaction_count = 0, 0, 0
+    last_tx_id = None
+    for entry in ADDRESS_INDEX.iter_entries(target_h160, reverse=True):
+        received += entry["amount"]
+        formatted_txs = []
+        if entry["txid"] != last_tx_id:
+            # The outputs of a tx are next to each other in the index
+            last_tx_id = entry["txid"]
+            formatted_txs.append(format_indexed_address_tx(entry["txid"], target_h160))
+        if entry["spent_by"]:
+            sent += entry["amount"]
+            formatted_txs.append(
+                format_indexed_address_tx(
+                    entry["spent_by"], target_h160, (entry["txid"], entry["vout"])
+                )
+            )
+        for formatted_tx in formatted_txs:
+            if formatted_tx:
+                transaction_count += 1
+                yield formatted_tx
+    yield format_address_totals(public_address, received, sent, transaction_count)
 
 
 # ==============================================================================
@@ -155,214 +447,294 @@ def get_miner_address(block):
 # get stats about the blockchain
 @app.route("/api/stats")
 def get_stats():
-    blocks_db = get_blockchain_data()
-    active_addresses = set()
-    total_transactions = 0
-
-    if blocks_db:
-        for block in blocks_db:
-            total_transactions += block.get("TxCount", 0)
-            for tx in block.get("Txs", []):
-                for tx_out in tx.get("tx_outs", []):
-                    try:
-                        active_addresses.add(tx_out["script_pubkey"]["cmds"][2])
-                    except (IndexError, KeyError, TypeError, ValueError):
-                        continue
+    return cached_response(("stats", READ_MODEL.get_tip_hash()), build_stats)
 
+
+def build_stats():
+    stats = READ_MODEL.get_stats()
+    hashrate = READ_MODEL.get_network_hashrate()
     return jsonify(
         {
-            "total_transactions": total_transactions,
-            "active_addresses": len(active_addresses),
-            "network_hashrate": "N/A",
+            "total_transactions": stats["total_transactions"],
+            "active_addresses": stats["active_addresses"],
+            "network_hashrate": hashrate if hashrate is not None else "N/A",
+            "total_fees": stats["total_fees"] / KOR,
+            "coin_supply": stats["coin_supply"] / KOR,
+            "daily_transactions": stats["daily_transactions"],
         }
     )
 
 
-# Get blocks list of the blockchain
+# Get blocks list of the blockchain, newest first
+# ?limit=N&cursor=HEIGHT starts the page at block HEIGHT
 @app.route("/api/blocks")
 def get_blocks():
-    blocks_db = get_blockchain_data()
-    if not blocks_db:
-        return jsonify([])
+    key = ("blocks", request.query_string, READ_MODEL.get_tip_hash())
+    return cached_response(key, build_blocks)
 
-    formatted_blocks = []
-    for block in reversed(blocks_db):
-        header = block.get("BlockHeader", {})
-        block_size_used = (block.get("Blocksize", 0) / 1000000) * 100
 
-        formatted_blocks.append(
-            {
-                "height": block.get("Height"),
-                "hash": header.get("blockHash"),
-                "timestamp": datetime.fromtimestamp(
-                    header.get("timestamp", 0), timezone.utc
-                ).isoformat(),
-                "transaction_count": block.get("TxCount"),
-                "miner": get_miner_address(block),
-                "size_used": block_size_used,
-                "reward": 50,
-            }
-        )
-    return jsonify(formatted_blocks)
+def build_blocks():
+    limit = get_page_limit()
+    tip_height = READ_MODEL.get_height()
+    cursor = min(request.args.get("cursor", tip_height, type=int), tip_height)
+    start = max(cursor - limit + 1, 0)
+
+    formatted_blocks = [
+        format_block_summary(summary)
+        for summary in reversed(READ_MODEL.get_summaries(start, max(cursor + 1, 0)))
+    ]
+    return paginated_response(formatted_blocks, start - 1 if start > 0 else None)
+
+
+def format_block_summary(summary):
+    return {
+        "height": summary.height,
+        "hash": summary.hash,
+        "timestamp": format_timestamp(summary.timestamp),
+        "transaction_count": summary.tx_count,
+        "miner": summary.miner,
+        "size_used": (summary.size / 1000000) * 100,
+        "reward": 50,
+    }
 
 
 # Get block details by its hash
+# ?format=ndjson streams the block and its transactions line by line
 @app.route("/api/block/<block_hash>")
 def get_block_details(block_hash):
-    blocks_db = get_blockchain_data()
-    if not blocks_db:
-        return jsonify({"error": "Blockchain is empty"}), 404
-
-    for block in blocks_db:
-        header = block.get("BlockHeader", {})
-        if header.get("blockHash") == block_hash:
-            formatted_txs = []
-            if block.get("Txs"):
-                for tx in block["Txs"]:
-                    inputs = []
-                    for inp in tx.get("tx_ins", []):
-                        if inp.get("prev_tx") == "00" * 32:
-                            inputs.append({"address": "Coinbase"})
-                        else:
-                            prev_tx_data = find_transaction_in_blocks(
-                                inp.get("prev_tx"), blocks_db
-                            )
-                            sender_address = "Address not found"
-                            if prev_tx_data:
-                                try:
-                                    spent_output = prev_tx_data["tx_outs"][
-                                        inp.get("prev_index")
-                                    ]
-                                    h160_hex = spent_output["script_pubkey"]["cmds"][2]
-                                    h160_bytes = bytes.fromhex(h160_hex)
-                                    sender_address = encode_base58_checksum(h160_bytes)
-                                except (IndexError, KeyError, TypeError, ValueError):
-                                    sender_address = "Erreur while reading address"
-                            inputs.append({"address": sender_address})
-
-                    outputs = []
-                    for out in tx.get("tx_outs", []):
-                        if (
-                            "script_pubkey" in out
-                            and len(out["script_pubkey"].get("cmds", [])) > 2
-                        ):
-                            try:
-                                h160_hex = out["script_pubkey"]["cmds"][2]
-                                h160_bytes = bytes.fromhex(h160_hex)
-                                address = encode_base58_checksum(h160_bytes)
-                                amount = out.get("amount", 0) / 100000000
-                                outputs.append({"address": address, "amount": amount})
-                            except (IndexError, KeyError, TypeError, ValueError):
-                                continue
-                    formatted_txs.append(
-                        {"hash": tx.get("TxId"), "inputs": inputs, "outputs": outputs}
-                    )
+    if request.args.get("format") == "ndjson":
+        return stream_block_details(block_hash)
+    key = ("block", block_hash, READ_MODEL.get_tip_hash())
+    return cached_response(key, lambda: build_block_details(block_hash))
 
-            return jsonify(
-                {
-                    "block_number": block.get("Height"),
-                    "hash": header.get("blockHash"),
-                    "previous_hash": header.get("prevBlockHash"),
-                    "confirmations": len(blocks_db) - block.get("Height"),
-                    "transaction_count": block.get("TxCount"),
-                    "miner": get_miner_address(block),
-                    "size": block.get("Blocksize"),
-                    "merkle_root": header.get("merkleRoot"),
-                    "nonce": header.get("nonce"),
-                    "timestamp": datetime.fromtimestamp(
-                        header.get("timestamp", 0), timezone.utc
-                    ).isoformat(),
-                    "transactions": formatted_txs,
-                    "reward": 50,
-                    "version": header.get("version"),
-                    "bits": header.get("bits"),
-                }
+
+def build_block_details(block_hash):
+    height, details = get_immutable_details(
+        ("block", block_hash), lambda: format_block_details(block_hash)
+    )
+    if details is None:
+        index_entry = BLOCKCHAIN_DB.get_index(block_hash)
+        if (
+            index_entry
+            and not index_entry.has_data()
+            and BLOCKCHAIN_DB.is_in_active_chain(index_entry)
+        ):
+            return jsonify(get_header_only_details(index_entry))
+        return jsonify({"error": "Bloc not found"}), 404
+
+    return jsonify(dict(details, confirmations=READ_MODEL.get_height() + 1 - height))
+
+
+def format_block_details(block_hash):
+    block, block_undo = READ_MODEL.get_block(block_hash)
+    if not block:
+        return None
+
+    details = format_block_header(block, block_hash)
+    details["transactions"] = [
+        format_block_tx(tx, get_spent_coins(block_undo, position))
+        for position, tx in enumerate(block.Txs)
+    ]
+    return block.Height, block_hash, details
+
+
+def format_block_header(block, block_hash):
+    header = block.BlockHeader
+    header.to_hex()
+    summary = READ_MODEL.get_summary(block.Height)
+    return {
+        "block_number": block.Height,
+        "hash": block_hash,
+        "previous_hash": header.prevBlockHash,
+        "transaction_count": len(block.Txs),
+        "miner": summary.miner if summary else "N/A",
+        "size": block.Blocksize,
+        "merkle_root": header.merkleRoot,
+        "nonce": header.nonce,
+        "timestamp": format_timestamp(header.timestamp),
+        "reward": 50,
+        "version": header.version,
+        "bits": header.bits,
+    }
+
+
+def format_block_tx(tx, spent_coins):
+    inputs = []
+    if tx.is_coinbase():
+        inputs.append({"address": "Coinbase"})
+    else:
+        for index in range(len(tx.tx_ins)):
+            coin = spent_coins[index] if index < len(spent_coins) else None
+            if coin:
+                inputs.append({"address": get_script_address(coin.script_pubkey)})
+            else:
+                inputs.append({"address": "Address not found"})
+
+    outputs = []
+    for tx_out in tx.tx_outs:
+        h160 = p2pkh_h160(tx_out.script_pubkey)
+        if h160:
+            outputs.append(
+                {"address": h160_to_address(h160), "amount": tx_out.amount / KOR}
             )
+    return {"hash": tx.TxId, "inputs": inputs, "outputs": outputs}
 
-    return jsonify({"error": "Bloc not found"}), 404
 
+# Block details as NDJSON: the block without its txs, then one line per tx
+def stream_block_details(block_hash):
+    block, block_undo = READ_MODEL.get_block(block_hash)
+    if not block:
+        return build_block_details(block_hash)
 
-# Get the latest 50 transactions of the blockchain
+    def lines():
+        yield dict(
+            format_block_header(block, block_hash),
+            confirmations=READ_MODEL.get_height() + 1 - block.Height,
+        )
+        for position, tx in enumerate(block.Txs):
+            yield format_block_tx(tx, get_spent_coins(block_undo, position))
+
+    return ndjson_response(lines())
+
+
+# Get the serialized block as stored on disk, without decoding it
+@app.route("/api/block/<block_hash>/raw")
+def get_raw_block(block_hash):
+    block_view = BLOCKCHAIN_DB.get_block_view(block_hash)
+    if block_view is None:
+        if BLOCKCHAIN_DB.is_pruned(block_hash):
+            return jsonify({"error": "Block data has been pruned"}), 410
+        return jsonify({"error": "Bloc not found"}), 404
+
+    if request.args.get("format") == "hex":
+        return jsonify({"hash": block_hash, "hex": block_view.hex()})
+    return Response(block_view.tobytes(), mimetype="application/octet-stream")
+
+
+# Export the active chain as NDJSON, one line per block with its transactions
+# ?start=HEIGHT&end=HEIGHT limits the export to these heights (both included)
+@app.route("/api/export/blocks")
+def export_blocks():
+    tip_height = READ_MODEL.get_height()
+    start = max(request.args.get("start", 0, type=int), 0)
+    end = min(request.args.get("end", tip_height, type=int), tip_height)
+    return ndjson_response(iter_exported_blocks(start, end))
+
+
+def iter_exported_blocks(start, end):
+    for height in range(start, end + 1):
+        summary = READ_MODEL.get_summary(height)
+        if not summary:
+            # The chain got shorter while exporting
+            return
+        formatted = format_block_details(summary.hash)
+        if formatted is None:
+            index_entry = BLOCKCHAIN_DB.get_index(summary.hash)
+            if index_entry:
+                yield get_header_only_details(index_entry)
+            continue
+        _, _, details = formatted
+        yield dict(details, confirmations=READ_MODEL.get_height() + 1 - height)
+
+
+# Get the latest transactions of the blockchain, coinbase transactions excluded
+# ?limit=N&cursor=HEIGHT:POSITION starts the page at a tx of block HEIGHT
 @app.route("/api/transactions")
 def get_transactions():
-    blocks_db = get_blockchain_data()
-    all_txs = []
-    limit = 50
+    key = ("transactions", request.query_string, READ_MODEL.get_tip_hash())
+    return cached_response(key, build_transactions)
 
-    if not blocks_db:
-        return jsonify([])
 
-    for block in reversed(blocks_db):
-        if len(all_txs) >= limit:
-            break
-        for tx in reversed(block.get("Txs", [])[1:]):
-            if len(all_txs) >= limit:
-                break
-            all_txs.append(format_transaction_details(tx, block, blocks_db))
+def build_transactions():
+    limit = get_page_limit()
+    height, _, position = request.args.get("cursor", "").partition(":")
+    try:
+        tip_height = READ_MODEL.get_height()
+        height = min(int(height), tip_height) if height else tip_height
+        position = int(position) if position else None
+    except ValueError:
+        return jsonify({"error": "Invalid cursor"}), 400
 
-    return jsonify(all_txs)
+    all_txs = []
+    while height >= 0 and len(all_txs) < limit:
+        summary = READ_MODEL.get_summary(height)
+        block, block_undo = None, None
+        if summary and summary.tx_count > 1:
+            block, block_undo = READ_MODEL.get_block(summary.hash)
+        if block:
+            last = len(block.Txs) - 1 if position is None else position
+            for position in range(min(last, len(block.Txs) - 1), 0, -1):
+                if len(all_txs) >= limit:
+                    return paginated_response(all_txs, f"{height}:{position}")
+                all_txs.append(
+                    format_transaction_details(
+                        block.Txs[position],
+                        height,
+                        summary.hash,
+                        get_spent_coins(block_undo, position),
+                    )
+                )
+        height -= 1
+        position = None
+
+    return paginated_response(all_txs, height if height >= 0 else None)
 
 
 # Get transaction details by its hash
 @app.route("/api/tx/<tx_hash>")
 def get_transaction_details(tx_hash):
-    blocks_db = get_blockchain_data()
-    if not blocks_db:
-        return jsonify({"error": "Blockchain not found"}), 404
-
-    for block in blocks_db:
-        for tx in block.get("Txs", []):
-            if tx.get("TxId") == tx_hash:
-                formatted_tx = format_transaction_details(tx, block, blocks_db)
-                formatted_tx["status"] = "Confirmed"
-                formatted_tx["timestamp"] = datetime.fromtimestamp(
-                    block.get("BlockHeader", {}).get("timestamp", 0), timezone.utc
-                ).isoformat()
-                formatted_tx["confirmations"] = len(blocks_db) - block.get("Height")
-
-                detailed_inputs = []
-                for inp in tx.get("tx_ins", []):
-                    if inp.get("prev_tx") == "00" * 32:
-                        detailed_inputs.append({"address": "Coinbase", "value": None})
-                    else:
-                        prev_tx_data = find_transaction_in_blocks(
-                            inp.get("prev_tx"), blocks_db
-                        )
-                        if prev_tx_data:
-                            try:
-                                spent_output = prev_tx_data["tx_outs"][
-                                    inp.get("prev_index")
-                                ]
-                                h160_bytes = bytes.fromhex(
-                                    spent_output["script_pubkey"]["cmds"][2]
-                                )
-                                address = encode_base58_checksum(h160_bytes)
-                                value = spent_output.get("amount", 0) / KOR
-                                detailed_inputs.append(
-                                    {"address": address, "value": value}
-                                )
-                            except (IndexError, KeyError, TypeError, ValueError):
-                                pass
-
-                detailed_outputs = []
-                for out in tx.get("tx_outs", []):
-                    try:
-                        h160_bytes = bytes.fromhex(out["script_pubkey"]["cmds"][2])
-                        address = encode_base58_checksum(h160_bytes)
-                        value = out.get("amount", 0) / KOR
-                        detailed_outputs.append({"address": address, "value": value})
-                    except (IndexError, KeyError, TypeError, ValueError):
-                        pass
-
-                formatted_tx["inputs"] = detailed_inputs
-                formatted_tx["outputs"] = detailed_outputs
-
-                return jsonify(formatted_tx)
-
-    return jsonify({"error": "Transaction not found"}), 404
+    key = ("tx", tx_hash, READ_MODEL.get_tip_hash())
+    return cached_response(key, lambda: build_transaction_details(tx_hash))
+
+
+def build_transaction_details(tx_hash):
+    height, details = get_immutable_details(
+        ("tx", tx_hash), lambda: format_confirmed_transaction(tx_hash)
+    )
+    if details is None:
+        return jsonify({"error": "Transaction not found"}), 404
+    return jsonify(dict(details, confirmations=READ_MODEL.get_height() + 1 - height))
+
+
+def format_confirmed_transaction(tx_hash):
+    found = READ_MODEL.find_tx(tx_hash) if is_hex_hash(tx_hash) else None
+    if not found:
+        return None
+
+    index_entry, spent_coins, tx = found
+    formatted_tx = format_transaction_details(
+        tx, index_entry.height, index_entry.hash, spent_coins
+    )
+    formatted_tx["status"] = "Confirmed"
+    formatted_tx["timestamp"] = format_timestamp(index_entry.timestamp)
+
+    detailed_inputs = []
+    if tx.is_coinbase():
+        detailed_inputs.append({"address": "Coinbase", "value": None})
+    for coin in spent_coins:
+        if coin:
+            detailed_inputs.append(
+                {
+                    "address": get_script_address(coin.script_pubkey),
+                    "value": coin.amount / KOR,
+                }
+            )
+
+    detailed_outputs = []
+    for tx_out in tx.tx_outs:
+        h160 = p2pkh_h160(tx_out.script_pubkey)
+        if h160:
+            detailed_outputs.append(
+                {"address": h160_to_address(h160), "value": tx_out.amount / KOR}
+            )
+
+    formatted_tx["inputs"] = detailed_inputs
+    formatted_tx["outputs"] = detailed_outputs
+    return index_entry.height, index_entry.hash, formatted_tx
 
 
 # Get address details and its transaction history
+# ?format=ndjson streams the transactions line by line, then the address totals
 @app.route("/api/address/<public_address>")
 def get_address_details(public_address):
     try:
@@ -371,8 +743,15 @@ def get_address_details(public_address):
         app.logger.error(f"Error while decoding address{public_address}: {e}")
         return jsonify({"error": "Address format invalid"}), 400
 
-    blocks_db = get_blockchain_data()
-    if not blocks_db:
+    streamed = request.args.get("format") == "ndjson"
+    if ADDRESS_INDEX is not None:
+        if streamed:
+            return ndjson_response(
+                iter_indexed_address_lines(public_address, target_h160)
+            )
+        return jsonify(get_indexed_address_details(public_address, target_h160))
+
+    if READ_MODEL.get_height() < 0:
         return (
             jsonify(
                 {
@@ -383,133 +762,84 @@ def get_address_details(public_address):
             ),
             404,
         )
-
-    total_received_kores = 0
-    total_sent_kores = 0
-    address_transactions = []
-    processed_tx_ids = set()
-
-    for block in blocks_db:
-        for tx in block.get("Txs", []):
-            tx_id = tx.get("TxId")
-            if tx_id in processed_tx_ids:
-                continue
-
-            is_sender = False
-            is_receiver = False
-            value_in = 0
-            value_out = 0
-            from_addresses = set()
-            to_addresses_details = []
-
-            for tx_in in tx.get("tx_ins", []):
-                if tx_in.get("prev_tx") == "00" * 32:
-                    from_addresses.add("Coinbase")
-                    continue
-
-                prev_tx = find_transaction_in_blocks(tx_in.get("prev_tx"), blocks_db)
-                if prev_tx:
-                    try:
-                        spent_output = prev_tx["tx_outs"][tx_in.get("prev_index")]
-                        h160_bytes = bytes.fromhex(
-                            spent_output["script_pubkey"]["cmds"][2]
-                        )
-                        from_addresses.add(encode_base58_checksum(h160_bytes))
-                        if h160_bytes == target_h160:
-                            is_sender = True
-                            value_out += spent_output.get("amount", 0)
-                    except (IndexError, KeyError, ValueError, TypeError):
-                        continue
-
-            for tx_out in tx.get("tx_outs", []):
-                try:
-                    h160_bytes = bytes.fromhex(tx_out["script_pubkey"]["cmds"][2])
-                    receiver_address = encode_base58_checksum(h160_bytes)
-                    amount = tx_out.get("amount", 0)
-                    to_addresses_details.append(
-                        {"address": receiver_address, "amount": amount / KOR}
-                    )
-                    if h160_bytes == target_h160:
-                        is_receiver = True
-                        value_in += amount
-                except (ValueError, TypeError, IndexError):
-                    continue
-
-            if is_sender or is_receiver:
-                net_effect = value_in - value_out
-                direction = "IN" if is_receiver else "OUT"
-                if is_sender and is_receiver:
-                    if net_effect < 0:
-                        direction = "OUT"
-                    else:
-                        direction = "IN"
-
-                if is_sender:
-                    total_sent_kores += value_out
-                if is_receiver:
-                    total_received_kores += value_in
-
-                address_transactions.append(
-                    {
-                        "hash": tx_id,
-                        "block_height": block.get("Height"),
-                        "block_hash": block.get("BlockHeader", {}).get("blockHash"),
-                        "timestamp": datetime.fromtimestamp(
-                            block.get("BlockHeader", {}).get("timestamp", 0),
-                            timezone.utc,
-                        ).isoformat(),
-                        "from": list(from_addresses),
-                        "to": to_addresses_details,
-                        "direction": direction,
-                        "value": abs(net_effect) / KOR,
-                    }
-                )
-                processed_tx_ids.add(tx_id)
-
-    current_balance_kores = total_received_kores - total_sent_kores
-
-    return jsonify(
-        {
-            "address": public_address,
-            "total_received": total_received_kores / KOR,
-            "total_sent": total_sent_kores / KOR,
-            "current_balance": current_balance_kores / KOR,
-            "transaction_count": len(address_transactions),
-            "transactions": sorted(
-                address_transactions, key=lambda x: x["block_height"], reverse=True
-            ),
-        }
-    )
+    if streamed:
+        return ndjson_response(iter_scanned_address_lines(public_address, target_h160))
+    return jsonify(get_scanned_address_details(public_address, target_h160))
 
 
 # Get current mempool stream
 @app.route("/api/mempool")
 def get_mempool():
+    if READ_ONLY:
+        # The node's mempool sequence is not visible here, let entries expire
+        key = ("mempool", int(time.time() // CACHE_MAX_AGE))
+    else:
+        key = ("mempool", getattr(MEMPOOL, "sequence", None))
+    return cached_response(key, build_mempool)
+
+
+def build_mempool():
     formatted_txs = []
     current_mempool = dict(MEMPOOL)
     for tx_id, tx_obj in current_mempool.items():
         try:
-            total_value = sum(out.amount for out in tx_obj.tx_outs)
-            formatted_txs.append(
-                {
-                    "hash": tx_id,
-                    "value": total_value / KOR,
-                    "received_time": getattr(tx_obj, "received_time", time.time()),
-                }
-            )
+            formatted_txs.append(format_mempool_tx(tx_id, tx_obj))
         except Exception as e:
             app.logger.error(f"Error while formating tx {tx_id} in mempool: {e}")
             continue
     return jsonify(formatted_txs)
 
 
+def format_mempool_tx(tx_id, tx_obj):
+    total_value = sum(out.amount for out in tx_obj.tx_outs)
+    return {
+        "hash": tx_id,
+        "value": total_value / KOR,
+        "received_time": getattr(tx_obj, "received_time", time.time()),
+    }
+
+
+# Live events as Server-Sent Events, each with a JSON payload:
+# block_connected (same fields as /api/blocks), block_disconnected,
+# mempool_tx_added (same fields as /api/mempool), mempool_tx_removed,
+# and resync when events were missed and the client should reload its data
+@app.route("/api/events")
+def stream_events():
+    subscription = EVENTS.subscribe(request.headers.get("Last-Event-ID", type=int))
+    response = Response(EVENTS.stream(subscription), mimetype="text/event-stream")
+    response.cache_control.no_cache = True
+    # Proxies must not buffer the stream
+    response.headers["X-Accel-Buffering"] = "no"
+    return response
+
+
+class ChainEventPublisher:
+    """ChainManager listener publishing its events to the /api/events clients"""
+
+    def block_connected(self, block, block_undo):
+        block_hash = block.BlockHeader.generateBlockHash()
+        summary = BlockSummary.from_block(block, block_hash)
+        EVENTS.publish("block_connected", format_block_summary(summary))
+
+    def block_disconnected(self, block, block_undo):
+        block_hash = block.BlockHeader.generateBlockHash()
+        EVENTS.publish(
+            "block_disconnected", {"height": block.Height, "hash": block_hash}
+        )
+
+    def chain_reset(self):
+        EVENTS.publish("resync", {})
+
+    def mempool_tx_added(self, tx_id, tx):
+        EVENTS.publish("mempool_tx_added", format_mempool_tx(tx_id, tx))
+
+    def mempool_tx_removed(self, tx_id):
+        EVENTS.publish("mempool_tx_removed", {"hash": tx_id})
+
+
 # Search for an address, a block or a transaction
 @app.route("/api/search/<query>")
 def search_blockchain(query):
-    blocks_db = get_blockchain_data()
-    if not blocks_db:
-        return jsonify({"found": False})
-
     try:
         decode_base58(query)
         return jsonify({"found": True, "type": "address", "identifier": query})
@@ -517,25 +847,15 @@ def search_blockchain(query):
         pass
 
     if query.isdigit():
-        for block in blocks_db:
-            if block.get("Height") == int(query):
-                return jsonify(
-                    {
-                        "found": True,
-                        "type": "block",
-                        "identifier": block["BlockHeader"]["blockHash"],
-                    }
-                )
+        summary = READ_MODEL.get_summary(int(query))
+        if summary:
+            return jsonify({"found": True, "type": "block", "identifier": summary.hash})
 
-    if len(query) == 64:
-        for block in blocks_db:
-            if block["BlockHeader"]["blockHash"] == query:
-                return jsonify({"found": True, "type": "block", "identifier": query})
-            for tx in block.get("Txs", []):
-                if tx.get("TxId") == query:
-                    return jsonify(
-                        {"found": True, "type": "transaction", "identifier": query}
-                    )
+    if is_hex_hash(query):
+        if BLOCKCHAIN_DB.get_index(query):
+            return jsonify({"found": True, "type": "block", "identifier": query})
+        if query in READ_MODEL.txindex:
+            return jsonify({"found": True, "type": "transaction", "identifier": query})
 
     return jsonify({"found": False})
 
@@ -544,9 +864,83 @@ def search_blockchain(query):
 
 
 # Start API SERVER with Deamon
-def main(utxos, MemPool, port, localPort):
-    global UTXOS, MEMPOOL
+def main(blockchain_db, read_model, utxos, MemPool, port, localPort, addrindex=None):
+    global BLOCKCHAIN_DB, READ_MODEL, UTXOS, MEMPOOL, ADDRESS_INDEX
+    BLOCKCHAIN_DB = blockchain_db
+    READ_MODEL = read_model
+    ADDRESS_INDEX = addrindex
     UTXOS = utxos
     MEMPOOL = MemPool
-    get_blockchain_data()
     app.run(port=port)
+
+
+# Start API SERVER as worker processes sharing one listening socket
+def start_workers(host, port, workers, addrindex=False):
+    listen_socket = socket.create_server((host, port))
+    context = multiprocessing.get_context("spawn")
+    processes = []
+    for number in range(workers):
+        process = context.Process(
+            target=run_worker,
+            args=(listen_socket, host, port, addrindex),
+            name=f"api-worker-{number}",
+            daemon=True,
+        )
+        process.start()
+        processes.append(process)
+    return processes
+
+
+def run_worker(listen_socket, host, port, addrindex):
+    global BLOCKCHAIN_DB, READ_MODEL, MEMPOOL, ADDRESS_INDEX, READ_ONLY
+    setup_logging()
+    store = KVStore(CHAINSTATE_FILE, readonly=True)
+    BLOCKCHAIN_DB = BlockchainDB(store)
+    READ_MODEL = ExplorerReadModel(
+        BLOCKCHAIN_DB, TxIndexDB(store), ChainStatsDB(store), UTXODB(store)
+    )
+    READ_MODEL.load()
+    ADDRESS_INDEX = AddressIndexDB(store) if addrindex else None
+    MEMPOOL = MempoolDB()
+    READ_ONLY = True
+
+    Thread(target=follow_chain, daemon=True).start()
+    server = make_server(host, port, app, threaded=True, fd=listen_socket.fileno())
+    server.serve_forever()
+
+
+def follow_chain():
+    known_mempool = None
+    while True:
+        time.sleep(WORKER_SYNC_INTERVAL)
+        try:
+            disconnected, connected = READ_MODEL.sync()
+            for index_entry in disconnected:
+                EVENTS.publish(
+                    "block_disconnected",
+                    {"height": index_entry.height, "hash": index_entry.hash},
+                )
+            for index_entry in connected:
+                summary = READ_MODEL.get_summary(index_entry.height)
+                if summary and summary.hash == index_entry.hash:
+                    EVENTS.publish("block_connected", format_block_summary(summary))
+            known_mempool = publish_mempool_changes(known_mempool)
+        except Exception as e:
+            app.logger.error(f"Error while following the chain: {e}")
+
+
+# Workers only see the mempool file, so they compare its txids between syncs
+def publish_mempool_changes(known_mempool):
+    if not EVENTS.has_subscribers():
+        return None
+    current_mempool = set(MEMPOOL.keys())
+    if known_mempool is not None:
+        for tx_id in known_mempool - current_mempool:
+            EVENTS.publish("mempool_tx_removed", {"hash": tx_id})
+        for tx_id in current_mempool - known_mempool:
+            try:
+                tx_obj = MEMPOOL[tx_id]
+            except KeyError:
+                continue
+            EVENTS.publish("mempool_tx_added", format_mempool_tx(tx_id, tx_obj))
+    return current_mempool
@@ -2,26 +2,63 @@ import logging
 from threading import RLock
 
 from src.chain.mempool import Mempool
+from src.chain.params import MIN_BLOCKS_TO_KEEP
+from src.chain.reindex import stream_blocks
 from src.chain.validator import Validator
-from src.core.block import Block
-from src.core.transaction import TxOut
+from src.core.coin import Coin, outpoint_key, p2pkh_h160
+from src.database.block_index import find_fork
+from src.database.kvstore import WriteBatch
+from src.database.undo import BlockUndo
 from src.database.utxo_manager import UTXOManager
+from src.utils.crypto_hash import hash256
+from src.utils.serialization import encode_varint
 
 logger = logging.getLogger(__name__)
 
 
 class ChainManager:
-    def __init__(self, blockchain_db, utxo_db, mempool_db, txindex_db, new_block_event):
+    def __init__(
+        self,
+        blockchain_db,
+        utxo_db,
+        mempool_db,
+        txindex_db,
+        new_block_event,
+        addrindex_db=None,
+        chainstats_db=None,
+    ):
         self.db = blockchain_db
         self.utxos = utxo_db
         self.mempool = mempool_db
         self.txindex = txindex_db
+        self.addrindex = addrindex_db
+        self.chainstats = chainstats_db
         self.new_block_event = new_block_event
 
         self.validator = Validator(self.utxos, self.mempool)
         self.utxo_manager = UTXOManager(self.utxos)
         self.mempool_manager = Mempool(self.mempool, self.utxos)
         self.mempool_lock = RLock()
+        self.chain_lock = RLock()
+        # Highest block pruning may delete, on top of MIN_BLOCKS_TO_KEEP
+        self.prune_limit = None
+        self.listeners = []
+
+    def add_listener(self, listener):
+        """Subscribes to block_connected, block_disconnected, chain_reset,
+        mempool_tx_added and mempool_tx_removed, listeners define the ones they use
+        """
+        self.listeners.append(listener)
+
+    def notify(self, event, *args):
+        for listener in self.listeners:
+            handler = getattr(listener, event, None)
+            if handler is None:
+                continue
+            try:
+                handler(*args)
+            except Exception as e:
+                logger.error(f"Chain listener failed on {event}: {e}")
 
     def add_transaction_to_mempool(self, tx):
         tx_id = tx.id()
@@ -36,99 +73,243 @@ class ChainManager:
 
             logger.info(f"Tx {tx_id} added in mempool")
             self.mempool[tx_id] = tx
+            self.notify("mempool_tx_added", tx_id, tx)
             return True
 
     def process_new_block(self, block_obj):
-        block_hash = block_obj.BlockHeader.generateBlockHash()
-        if self.db.get_block(block_hash):
-            logger.debug(f"Block {block_hash} already known. Discarding...")
-            return False
-
-        if not self.validator.validate_block_header(block_obj.BlockHeader, self.db):
-            logger.warning(
-                f"Block {block_hash} failed header validation. Discarding..."
-            )
-            return False
-
-        if not self.validator.validate_block_body(block_obj, self.db):
-            logger.warning(f"Block {block_hash} failed body validation. Discarding...")
-            return False
+        with self.chain_lock:
+            block_hash = block_obj.BlockHeader.generateBlockHash()
+            if self.db.has_block(block_hash):
+                logger.debug(f"Block {block_hash} already known. Discarding...")
+                return False
 
-        block_dict = self.block_to_dict(block_obj)
-        self.db.write_block(block_dict)
+            if not self.validator.validate_block_header(
+                block_obj.BlockHeader, self.db, block_obj.Height
+            ):
+                logger.warning(
+                    f"Block {block_hash} failed header validation. Discarding..."
+                )
+                return False
 
-        logger.info(
-            f"Accepted new block: {block_obj.Height} (hash: {block_hash[:10]}...)"
-        )
-        main_tip_hash = self.db.get_main_chain_tip_hash()
-        if not main_tip_hash:
-            logger.debug("Processing Genesis block")
-            self.connect_block(block_obj)
-            self.db.set_main_chain_tip(block_hash)
-            return True
+            if not self.validator.validate_block_body(block_obj, self.db):
+                logger.warning(
+                    f"Block {block_hash} failed body validation. Discarding..."
+                )
+                return False
 
-        main_tip_index = self.db.get_index(main_tip_hash)
-        new_block_index = self.db.get_index(block_hash)
+            if not self.db.write_block(block_obj):
+                logger.error(f"Failed to store block {block_hash}. Discarding...")
+                return False
 
-        if new_block_index["total_work"] > main_tip_index["total_work"]:
-            logger.info(f"New block {block_hash} has more work. Reorganizing chain...")
-            self.reorganize_chain(block_hash)
-        else:
             logger.info(
-                f"New block {block_hash} is on a fork with less work. Storing..."
+                f"Accepted new block: {block_obj.Height} (hash: {block_hash[:10]}...)"
             )
+            main_tip_hash = self.db.get_main_chain_tip_hash()
+            if not main_tip_hash:
+                logger.debug("Processing Genesis block")
+                self.connect_block(block_obj)
+                self.db.set_main_chain_tip(block_hash)
+                return True
+
+            main_tip_index = self.db.get_index(main_tip_hash)
+            new_block_index = self.db.get_index(block_hash)
+
+            if new_block_index.total_work > main_tip_index.total_work:
+                logger.info(
+                    f"New block {block_hash} has more work. Reorganizing chain..."
+                )
+                self.reorganize_chain(block_hash)
+            elif self.db.is_in_active_chain(new_block_index):
+                # Block below a loaded snapshot, only its data was missing
+                logger.info(f"Stored block {block_obj.Height} below the chain tip")
+            else:
+                logger.info(
+                    f"New block {block_hash} is on a fork with less work. Storing..."
+                )
 
-        return True
+            return True
 
     def reorganize_chain(self, new_tip_hash):
-        new_chain = []
-        old_chain = []
+        new_tip = self.db.get_index(new_tip_hash)
+        old_tip = self.db.get_main_chain_tip()
+        fork = find_fork(new_tip, old_tip)
 
-        curr_new_hash = new_tip_hash
-        curr_old_hash = self.db.get_main_chain_tip_hash()
+        new_chain = []
+        entry = new_tip
+        while entry is not fork:
+            new_chain.append(entry.hash)
+            entry = entry.prev
 
-        while curr_new_hash != curr_old_hash:
-            new_idx = self.db.get_index(curr_new_hash)
-            old_idx = self.db.get_index(curr_old_hash)
+        old_chain = []
+        entry = old_tip
+        while entry is not fork:
+            old_chain.append(entry.hash)
+            entry = entry.prev
 
-            if not new_idx:
-                break
+        logger.debug(f"Common ancestor is {fork.hash if fork else None}")
 
-            if not old_idx or new_idx["height"] > old_idx["height"]:
-                new_chain.append(curr_new_hash)
-                curr_new_hash = new_idx["prev_hash"]
-            elif new_idx["height"] < old_idx["height"]:
-                old_chain.append(curr_old_hash)
-                curr_old_hash = old_idx["prev_hash"]
-            else:
-                new_chain.append(curr_new_hash)
-                old_chain.append(curr_old_hash)
-                curr_new_hash = new_idx["prev_hash"]
-                curr_old_hash = old_idx["prev_hash"]
-
-        common_ancestor_hash = curr_new_hash
-        logger.debug(f"Common ancestor is {common_ancestor_hash}")
+        # Checked first, a block that cannot be disconnected would leave the chain half rewound
+        for block_hash in old_chain:
+            index_entry = self.db.get_index(block_hash)
+            if not index_entry.has_data() or not index_entry.has_undo():
+                logger.error(
+                    f"Cannot reorganize below pruned block {index_entry.height}. The node must be rebuilt with -reindex"
+                )
+                return
 
         for block_hash in old_chain:
             logger.debug(f"Disconnecting block {block_hash}")
-            block = Block.to_obj(self.db.get_block(block_hash))
+            block = self.db.get_block(block_hash)
             self.disconnect_block(block)
+            self.db.set_main_chain_tip(block.BlockHeader.prevBlockHash.hex())
 
         for block_hash in reversed(new_chain):
             logger.debug(f"Connecting block {block_hash}")
-            block = Block.to_obj(self.db.get_block(block_hash))
-            if not self.connect_block(block):
+            block = self.db.get_block(block_hash)
+            if not block or not self.connect_block(block):
                 logger.error(
-                    f"Failed to connect block {block_hash} during reorg. Chain state may be corrupt"
+                    f"Failed to connect block {block_hash} during reorg. Chain stays at {self.db.get_main_chain_tip_hash()}"
                 )
-                return
+                break
+            self.db.set_main_chain_tip(block_hash)
 
-        self.db.set_main_chain_tip(new_tip_hash)
-        self.utxos.set_meta("last_block_hash", new_tip_hash)
+        self.utxos.set_meta("last_block_hash", self.db.get_main_chain_tip_hash())
         self.utxos.commit()
+        self.flush_state()
 
         self.new_block_event.set()
 
+    def recover_chain_state(self):
+        """Moves the UTXO set from its best block to the best stored chain
+
+        Only the blocks between the two are disconnected and connected. Returns
+        False when the UTXO set has no known best block and must be rebuilt.
+        """
+        with self.chain_lock:
+            utxo_tip = self.db.get_index(self.utxos.get_meta("last_block_hash"))
+            if not utxo_tip:
+                return False
+
+            if self.db.get_main_chain_tip_hash() != utxo_tip.hash:
+                logger.info(f"Moving chain tip back to UTXO best block {utxo_tip.hash}")
+                self.db.set_main_chain_tip(utxo_tip.hash)
+
+            best_tip = self.db.get_best_stored_tip()
+            if best_tip.total_work > utxo_tip.total_work:
+                logger.info(
+                    f"Recovering chain state from block {utxo_tip.height} to {best_tip.height}"
+                )
+                self.reorganize_chain(best_tip.hash)
+            self.flush_state(force=True)
+            return True
+
+    def reindex(self, workers=1):
+        """Rebuilds the UTXO set and indexes by connecting every stored block again
+
+        Returns False when some blocks are missing or one fails to connect.
+        """
+        with self.chain_lock:
+            best_tip = self.db.get_best_stored_tip()
+            if not best_tip:
+                return False
+
+            chain = []
+            entry = best_tip
+            while entry:
+                chain.append(entry)
+                entry = entry.prev
+            chain.reverse()
+            if not all(entry.has_data() for entry in chain):
+                logger.error(
+                    "Cannot reindex: some blocks of the chain are pruned or not downloaded yet"
+                )
+                return False
+
+            logger.info(f"Reindexing {len(chain)} blocks with {workers} decoders...")
+            self.utxos.clear()
+            self.txindex.clear()
+            if self.addrindex is not None:
+                self.addrindex.clear()
+            if self.chainstats is not None:
+                self.chainstats.clear()
+            self.db.set_main_chain_tip(None)
+            self.notify("chain_reset")
+
+            connected = True
+            for block in stream_blocks(self.db, chain, workers):
+                block_hash = block.BlockHeader.blockHash
+                if not self.connect_block(block):
+                    logger.error(
+                        f"Reindex stopped: block {block_hash} failed to connect"
+                    )
+                    connected = False
+                    break
+                self.db.set_main_chain_tip(block_hash)
+                self.utxos.set_meta("last_block_hash", block_hash)
+                self.utxos.commit()
+                self.flush_state()
+                if block.Height % 1000 == 0:
+                    logger.info(f"Reindexed up to block {block.Height}")
+
+            if connected and self.addrindex is not None:
+                # Built from genesis, flushes may now mark it in sync
+                self.addrindex.complete = True
+            if connected and self.chainstats is not None:
+                self.chainstats.complete = True
+            self.flush_state(force=True)
+            logger.info(
+                f"Reindex done at height {self.db.get_chain_height()}. {len(self.utxos)} UTXOs found"
+            )
+            return connected
+
+    def build_chain_stats(self):
+        """Rebuilds the explorer totals from the stored blocks of the active chain
+
+        Blocks without data, pruned or below a snapshot, are left out.
+        """
+        with self.chain_lock:
+            self.chainstats.clear()
+            missing = 0
+            for index_entry in list(self.db.active_chain):
+                block = None
+                if index_entry.has_data():
+                    block = self.db.get_block(index_entry.hash)
+                if block is None:
+                    missing += 1
+                    continue
+                self.chainstats.connect_block(
+                    block, self.db.get_block_undo(index_entry.hash)
+                )
+            if missing:
+                logger.warning(
+                    f"Explorer totals leave out {missing} blocks without data"
+                )
+            self.chainstats.complete = True
+            self.flush_state(force=True)
+
+    def flush_state(self, force=False):
+        """Writes block index, txindex and UTXO changes in one atomic batch"""
+        with self.chain_lock:
+            if not force and not self.utxos.needs_flush():
+                return
+            batch = WriteBatch()
+            self.db.write_batch(batch)
+            self.txindex.write_batch(batch)
+            if self.addrindex is not None:
+                self.addrindex.write_batch(batch, self.db.get_main_chain_tip_hash())
+            if self.chainstats is not None:
+                self.chainstats.write_batch(batch, self.db.get_main_chain_tip_hash())
+            self.utxos.write_batch(batch)
+            self.db.store.write(batch)
+            if self.db.prune_target:
+                self.prune_blocks()
+
+    def prune_blocks(self):
+        max_height = self.db.get_chain_height() - MIN_BLOCKS_TO_KEEP
+        if self.prune_limit is not None:
+            max_height = min(max_height, self.prune_limit)
+        self.db.prune_block_files(max_height)
+
     def connect_block(self, block_obj):
         if not self.validator.validate_block_transactions(block_obj, is_in_block=True):
             logger.warning(
@@ -139,21 +320,53 @@ class ChainManager:
         block_hash = block_obj.BlockHeader.generateBlockHash()
         tx_ids_in_block = []
 
-        for tx in block_obj.Txs:
-            tx_id = tx.id()
-            tx_ids_in_block.append(bytes.fromhex(tx_id))
-            self.txindex[tx_id] = block_hash
-
         spent_outputs = [
             [tx_in.prev_tx, tx_in.prev_index]
             for tx in block_obj.Txs[1:]
             for tx_in in tx.tx_ins
         ]
 
+        block_undo = BlockUndo(
+            [
+                [
+                    self.utxos.get(outpoint_key(tx_in.prev_tx, tx_in.prev_index))
+                    for tx_in in tx.tx_ins
+                ]
+                for tx in block_obj.Txs[1:]
+            ]
+        )
+        if not self.db.write_undo(block_hash, block_undo):
+            logger.error(f"Failed to store undo data of block {block_hash}")
+            return False
+
+        # Height, block size and header come before the txs in the block record
+        offset = 88 + len(encode_varint(len(block_obj.Txs)))
+        undo_locations = [(0, 0)] + block_undo.tx_undo_locations()
+        for position, tx in enumerate(block_obj.Txs):
+            raw_tx = tx.serialize()
+            tx_id = hash256(raw_tx)[::-1].hex()
+            tx_ids_in_block.append(bytes.fromhex(tx_id))
+            self.txindex.add(
+                tx_id,
+                block_hash,
+                position,
+                offset,
+                len(raw_tx),
+                undo_locations[position],
+            )
+            offset += len(raw_tx)
+
+        if self.addrindex is not None:
+            self.index_addresses(block_obj, block_undo)
+        if self.chainstats is not None:
+            self.chainstats.connect_block(block_obj, block_undo)
         self.utxo_manager.remove_spent_utxos(spent_outputs)
         self.utxo_manager.add_new_outputs_from_block(block_obj)
 
-        self.mempool_manager.remove_transactions(tx_ids_in_block)
+        removed = self.mempool_manager.remove_transactions(tx_ids_in_block)
+        self.notify("block_connected", block_obj, block_undo)
+        for tx_id in removed:
+            self.notify("mempool_tx_removed", tx_id)
 
         logger.debug(f"Connected block {block_obj.Height}. UTXOs and mempool updated")
         return True
@@ -164,62 +377,126 @@ class ChainManager:
             if tx_id_hex in self.txindex:
                 del self.txindex[tx_id_hex]
 
+            tx_id = bytes.fromhex(tx_id_hex)
             for i in range(len(tx.tx_outs)):
-                key = f"{tx_id_hex}_{i}"
+                key = outpoint_key(tx_id, i)
                 if key in self.utxos:
                     del self.utxos[key]
 
+        block_undo = self.db.get_block_undo(block_obj.BlockHeader.generateBlockHash())
+        if self.addrindex is not None:
+            self.unindex_addresses(block_obj, block_undo)
+        if self.chainstats is not None:
+            self.chainstats.disconnect_block(block_obj, block_undo)
+        if block_undo is not None:
+            for tx, spent_coins in zip(block_obj.Txs[1:], block_undo.tx_undos):
+                for tx_in, coin in zip(tx.tx_ins, spent_coins):
+                    self.utxos[outpoint_key(tx_in.prev_tx, tx_in.prev_index)] = coin
+        else:
+            logger.debug(
+                f"No undo data for block {block_obj.Height}, searching spent outputs"
+            )
+            self.restore_spent_outputs(block_obj)
+
+        returned = []
+        for tx in block_obj.Txs[1:]:
+            tx_id = tx.id()
+            if tx_id not in self.mempool:
+                if self.validator.validate_transaction(tx, is_in_block=False):
+                    self.mempool[tx_id] = tx
+                    returned.append((tx_id, tx))
+                else:
+                    logger.debug(
+                        f"Orphaned tx {tx_id} is no longer valid. Discarding..."
+                    )
+        self.notify("block_disconnected", block_obj, block_undo)
+        for tx_id, tx in returned:
+            self.notify("mempool_tx_added", tx_id, tx)
+
+        logger.debug(
+            f"Disconnected block {block_obj.Height}. UTXOs restored, txs returned to mempool"
+        )
+        return True
+
+    def index_addresses(self, block_obj, block_undo):
+        for tx in block_obj.Txs:
+            tx_id = bytes.fromhex(tx.id())
+            for index, tx_out in enumerate(tx.tx_outs):
+                h160 = p2pkh_h160(tx_out.script_pubkey)
+                if h160:
+                    self.addrindex.add_output(
+                        h160, block_obj.Height, tx_id, index, tx_out.amount
+                    )
+
+        for tx, spent_coins in zip(block_obj.Txs[1:], block_undo.tx_undos):
+            tx_id = bytes.fromhex(tx.id())
+            for tx_in, coin in zip(tx.tx_ins, spent_coins):
+                h160 = p2pkh_h160(coin.script_pubkey) if coin else None
+                if h160:
+                    self.addrindex.spend_output(
+                        h160,
+                        coin.height,
+                        tx_in.prev_tx,
+                        tx_in.prev_index,
+                        coin.amount,
+                        tx_id,
+                        block_obj.Height,
+                    )
+
+    def unindex_addresses(self, block_obj, block_undo):
+        for tx in block_obj.Txs:
+            tx_id = bytes.fromhex(tx.id())
+            for index, tx_out in enumerate(tx.tx_outs):
+                h160 = p2pkh_h160(tx_out.script_pubkey)
+                if h160:
+                    self.addrindex.remove_output(h160, block_obj.Height, tx_id, index)
+
+        if block_undo is None:
+            return
+        for tx, spent_coins in zip(block_obj.Txs[1:], block_undo.tx_undos):
+            for tx_in, coin in zip(tx.tx_ins, spent_coins):
+                h160 = p2pkh_h160(coin.script_pubkey) if coin else None
+                if h160:
+                    self.addrindex.add_output(
+                        h160, coin.height, tx_in.prev_tx, tx_in.prev_index, coin.amount
+                    )
+
+    def restore_spent_outputs(self, block_obj):
+        # Blocks connected before undo data was written
         for tx in block_obj.Txs[1:]:
             for tx_in in tx.tx_ins:
                 prev_tx_hash = tx_in.prev_tx.hex()
                 prev_tx_index = tx_in.prev_index
-                prev_tx_block_dict = self.find_tx_block_in_chain(prev_tx_hash)
-                if not prev_tx_block_dict:
+                prev_tx_block = self.find_tx_block_in_chain(prev_tx_hash)
+                if not prev_tx_block:
                     logger.warning(
                         f"Corruption detected: txindex doesn't find {prev_tx_hash} during disconnect"
                     )
                     continue
 
                 found_parent_tx = False
-                for tx_dict in prev_tx_block_dict["Txs"]:
-                    if tx_dict["TxId"] == prev_tx_hash:
+                for parent_tx in prev_tx_block.Txs:
+                    if parent_tx.TxId == prev_tx_hash:
                         try:
-                            tx_out_dict = tx_dict["tx_outs"][prev_tx_index]
-                            if tx_out_dict is None:
-                                logger.warning(
-                                    f"Tried to disconnect and restore a 'None' output for {prev_tx_hash}_{prev_tx_index}"
-                                )
-                                continue
-                            tx_out_obj = TxOut.from_dict(tx_out_dict)
-                            key = f"{prev_tx_hash}_{prev_tx_index}"
-                            self.utxos[key] = tx_out_obj
+                            tx_out_obj = parent_tx.tx_outs[prev_tx_index]
+                            key = outpoint_key(tx_in.prev_tx, prev_tx_index)
+                            self.utxos[key] = Coin.from_tx_out(
+                                tx_out_obj,
+                                prev_tx_block.Height,
+                                parent_tx.is_coinbase(),
+                            )
                             found_parent_tx = True
                             break
-                        except (IndexError, KeyError) as e:
+                        except IndexError as e:
                             logger.error(
-                                f"Failed to parse tx_out from stored block: {e}"
+                                f"Failed to read tx_out from stored block: {e}"
                             )
 
                 if not found_parent_tx:
                     logger.warning(
-                        f"Corruption detected: block {prev_tx_block_dict['Height']} found but doesn't have tx {prev_tx_hash}"
-                    )
-
-        for tx in block_obj.Txs[1:]:
-            tx_id = tx.id()
-            if tx_id not in self.mempool:
-                if self.validator.validate_transaction(tx, is_in_block=False):
-                    self.mempool[tx_id] = tx
-                else:
-                    logger.debug(
-                        f"Orphaned tx {tx_id} is no longer valid. Discarding..."
+                        f"Corruption detected: block {prev_tx_block.Height} found but doesn't have tx {prev_tx_hash}"
                     )
 
-        logger.debug(
-            f"Disconnected block {block_obj.Height}. UTXOs restored, txs returned to mempool"
-        )
-        return True
-
     def find_tx_block_in_chain(self, tx_id):
         block_hash = self.txindex.get(tx_id)
         if not block_hash:
@@ -234,14 +511,3 @@ class ChainManager:
             return None
 
         return block
-
-    def block_to_dict(self, block):
-        block.BlockHeader.to_hex()
-        tx_json_list = [tx.to_dict() for tx in block.Txs]
-        return {
-            "Height": block.Height,
-            "Blocksize": block.Blocksize,
-            "BlockHeader": block.BlockHeader.__dict__,
-            "TxCount": len(tx_json_list),
-            "Txs": tx_json_list,
-        }
@@ -3,54 +3,59 @@ import logging
 from src.chain.params import (AVERAGE_MINE_TIME, MAX_TARGET,
                               RESET_DIFFICULTY_AFTER_BLOCKS)
 from src.core.genesis import GENESIS_BITS
-from src.database.db_manager import BlockchainDB
 from src.utils.serialization import bits_to_target, target_to_bits
 
 logger = logging.getLogger(__name__)
 
 
 def get_ancestor_at_height(db, tip_hash, target_height):
-    current_hash = tip_hash
-    current_block = db.get_block(current_hash)
-    if not current_block:
+    current_index = db.get_index(tip_hash)
+    if not current_index:
         return None
+    if target_height >= current_index.height:
+        return current_index
+    if db.is_in_active_chain(current_index):
+        return db.get_index_at_height(target_height)
+    return current_index.get_ancestor(target_height)
 
-    current_height = current_block["Height"]
 
-    while current_height > target_height:
-        current_hash = current_block["BlockHeader"]["prevBlockHash"]
-        current_block = db.get_block(current_hash)
-        if not current_block:
-            return None
-        current_height = current_block["Height"]
+def calculate_new_bits(db, current_height):
+    last_index = db.get_main_chain_tip()
 
-    return current_block
-
-
-def calculate_new_bits(current_height):
-    db = BlockchainDB()
-    last_block = db.lastBlock()
-
-    if not last_block:
+    if not last_index:
         return GENESIS_BITS
 
     if current_height % RESET_DIFFICULTY_AFTER_BLOCKS != 0:
-        return bytes.fromhex(last_block["BlockHeader"]["bits"])
+        return last_index.bits
 
     start_period_height = current_height - RESET_DIFFICULTY_AFTER_BLOCKS
 
-    first_block_in_period = get_ancestor_at_height(
-        db, last_block["BlockHeader"]["blockHash"], start_period_height
+    first_index_in_period = get_ancestor_at_height(
+        db, last_index.hash, start_period_height
     )
 
-    if not first_block_in_period:
-        return bytes.fromhex(last_block["BlockHeader"]["bits"])
+    if not first_index_in_period:
+        return last_index.bits
+
+    time_diff = last_index.timestamp - first_index_in_period.timestamp
+    return retarget_bits(last_index.bits, time_diff, current_height)
+
+
+def get_expected_bits(headers, current_height):
+    """Same rules as calculate_new_bits, for headers from genesis not indexed yet"""
+    if current_height == 0:
+        return GENESIS_BITS
+
+    last_header = headers[current_height - 1]
+    if current_height % RESET_DIFFICULTY_AFTER_BLOCKS != 0:
+        return last_header.bits
+
+    first_header_in_period = headers[current_height - RESET_DIFFICULTY_AFTER_BLOCKS]
+    time_diff = last_header.timestamp - first_header_in_period.timestamp
+    return retarget_bits(last_header.bits, time_diff, current_height)
 
-    time_diff = (
-        last_block["BlockHeader"]["timestamp"]
-        - first_block_in_period["BlockHeader"]["timestamp"]
-    )
 
+def retarget_bits(last_bits, time_diff, current_height):
     if time_diff == 0:
         time_diff = 1
 
@@ -60,7 +65,7 @@ def calculate_new_bits(current_height):
     if time_diff > target_time * 4:
         time_diff = target_time * 4
 
-    last_target = bits_to_target(bytes.fromhex(last_block["BlockHeader"]["bits"]))
+    last_target = bits_to_target(last_bits)
     new_target = int(last_target * (time_diff / target_time))
     new_target = min(new_target, MAX_TARGET)
     new_bits = target_to_bits(new_target)
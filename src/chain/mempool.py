@@ -1,3 +1,6 @@
+from src.core.coin import outpoint_key
+
+
 class Mempool:
     def __init__(self, mempool, utxos):
         self.mempool = mempool
@@ -7,7 +10,7 @@ class Mempool:
         for txin in tx.tx_ins:
             if txin.prev_tx in block_pending_txs:
                 return True
-            utxo_key = f"{txin.prev_tx.hex()}_{txin.prev_index}"
+            utxo_key = outpoint_key(txin.prev_tx, txin.prev_index)
             if utxo_key not in self.utxos:
                 return True
         return False
@@ -70,8 +73,7 @@ class Mempool:
         output_amount = 0
 
         for tx_id_bytes, output_index in spent_utxos_for_block:
-            tx_id_hex = tx_id_bytes.hex()
-            key = f"{tx_id_hex}_{output_index}"
+            key = outpoint_key(tx_id_bytes, output_index)
             if key in self.utxos:
                 tx_out_obj = self.utxos[key]
                 input_amount += tx_out_obj.amount
@@ -90,7 +92,10 @@ class Mempool:
         }
 
     def remove_transactions(self, tx_ids):
+        removed = []
         for tx_id_bytes in tx_ids:
             tx_id_hex = tx_id_bytes.hex()
             if tx_id_hex in self.mempool:
                 del self.mempool[tx_id_hex]
+                removed.append(tx_id_hex)
+        return removed
@@ -13,10 +13,26 @@ AVERAGE_MINE_TIME = AVERAGE_BLOCK_MINE_TIME * RESET_DIFFICULTY_AFTER_BLOCKS
 # blockchain
 KOR = 100000000
 MAX_BLOCK_SIZE = 1000000  # 1Mb
+MAX_BLOCKFILE_SIZE = 128 * 1024 * 1024  # 128Mb
 INITIAL_REWARD_KOR = 50 * KOR
 HALVING_INTERVAL = 250000
 REDUCTION_FACTOR = 0.75
 
+# utxo cache
+UTXO_CACHE_MAX_MEMORY = 64 * 1024 * 1024  # 64Mb
+UTXO_CACHE_FLUSH_INTERVAL = 50  # blocks
+UTXO_CACHE_ENTRY_SIZE = 250  # estimated bytes per cached coin
+
+# reindex
+REINDEX_DECODE_AHEAD = 16  # blocks queued per decoding process
+
+# pruning
+MIN_BLOCKS_TO_KEEP = 288  # recent blocks kept for reorgs
+MIN_PRUNE_TARGET = 550 * 1024 * 1024  # 550Mb
+
+# utxo snapshot
+SNAPSHOT_VALIDATION_POLL = 10  # seconds to wait for missing historical blocks
+
 # size in bytes for tx
 TX_BASE_SIZE = 10
 TX_INPUT_SIZE = 148
@@ -29,6 +45,7 @@ FEE_RATE_SLOW = 100
 
 # p2p constants
 MAX_HEADERS_TO_SEND = 2000
+MAX_BLOCKS_TO_REQUEST = 500
 P2P_TIMEOUT = 120.0
 PING_INTERVAL = 60
 MAX_PEERS = 8
@@ -0,0 +1,51 @@
+import logging
+import multiprocessing
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from io import BytesIO
+
+from src.chain.params import REINDEX_DECODE_AHEAD
+from src.core.block import Block
+
+logger = logging.getLogger(__name__)
+
+
+def decode_block(path, offset, length, block_hash):
+    with open(path, "rb") as f:
+        f.seek(offset)
+        raw_block = f.read(length)
+    block = Block.parse(BytesIO(raw_block))
+    block.BlockHeader.blockHash = block_hash
+    return block
+
+
+def stream_blocks(db, index_entries, workers):
+    """Yields the blocks of index_entries in order, decoding ahead in worker processes
+
+    At most workers * REINDEX_DECODE_AHEAD blocks are held in memory at once.
+    """
+    if workers <= 1:
+        for index_entry in index_entries:
+            yield db.get_block(index_entry.hash)
+        return
+
+    window = workers * REINDEX_DECODE_AHEAD
+    pending = deque()
+    with ProcessPoolExecutor(
+        max_workers=workers, mp_context=multiprocessing.get_context("spawn")
+    ) as executor:
+        for index_entry in index_entries:
+            pending.append(
+                executor.submit(
+                    decode_block,
+                    db.block_file_path(index_entry.file),
+                    index_entry.offset,
+                    index_entry.length,
+                    index_entry.hash,
+                )
+            )
+            if len(pending) >= window:
+                yield pending.popleft().result()
+
+        while pending:
+            yield pending.popleft().result()
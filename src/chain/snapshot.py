@@ -0,0 +1,323 @@
+import hashlib
+import json
+import logging
+import os
+from io import BytesIO
+from threading import Event, Thread
+
+from src.chain.chain_manager import ChainManager
+from src.chain.difficulty import get_expected_bits
+from src.chain.params import SNAPSHOT_VALIDATION_POLL
+from src.chain.validator import check_pow
+from src.core.blockheader import BlockHeader
+from src.core.coin import Coin
+from src.core.genesis import GENESIS_BLOCK_HASH
+from src.database.db_manager import (UTXODB, AddressIndexDB, ChainStatsDB,
+                                     TxIndexDB)
+from src.database.kvstore import (ADDRINDEX, COINS, META, TXINDEX, KVStore,
+                                  WriteBatch)
+from src.database.utxo_cache import UTXOCache
+from src.utils.serialization import (encode_varint, int_to_little_endian,
+                                     little_endian_to_int, read_varint)
+
+logger = logging.getLogger(__name__)
+
+SNAPSHOT_MAGIC = b"KUTX"
+SNAPSHOT_VERSION = 1
+SNAPSHOT_META_KEY = "snapshot"
+SNAPSHOT_VALIDATION_FILE = os.path.join("data", "snapshot_validation.sqlite")
+
+# File layout:
+#   magic, version, base block hash, base height (4 LE), coin count (8 LE)
+#   the 80-byte headers of the active chain from genesis to the base block
+#   per coin: varint key length, key, varint coin length, serialized Coin
+#   commitment: hash256 over every key + coin, in key order
+
+
+class SnapshotError(Exception):
+    pass
+
+
+def get_snapshot_info(db):
+    value = db.store.get(META, SNAPSHOT_META_KEY)
+    return json.loads(value) if value is not None else None
+
+
+def set_snapshot_info(db, info):
+    db.store.put(META, SNAPSHOT_META_KEY, json.dumps(info))
+
+
+def clear_snapshot_info(db):
+    db.store.delete(META, SNAPSHOT_META_KEY)
+
+
+def compute_commitment(store):
+    """hash256 of the UTXO set of a store, the same value a snapshot file ends with"""
+    hasher = hashlib.sha256()
+    for key, value in store.items(COINS):
+        hasher.update(key)
+        hasher.update(value)
+    return hashlib.sha256(hasher.digest()).digest()
+
+
+def dump_snapshot(chain_manager, path):
+    """Writes the UTXO set at the current tip to path"""
+    db = chain_manager.db
+    with chain_manager.chain_lock:
+        chain_manager.flush_state(force=True)
+        tip = db.get_main_chain_tip()
+        if not tip:
+            raise SnapshotError("No chain to dump")
+
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        tmp_path = path + ".tmp"
+        hasher = hashlib.sha256()
+        coin_count = 0
+        with open(tmp_path, "wb") as f:
+            f.write(SNAPSHOT_MAGIC + bytes([SNAPSHOT_VERSION]))
+            f.write(bytes.fromhex(tip.hash))
+            f.write(int_to_little_endian(tip.height, 4))
+            count_pos = f.tell()
+            f.write(int_to_little_endian(0, 8))
+            for index_entry in db.active_chain[: tip.height + 1]:
+                f.write(index_entry.header)
+
+            for key, value in db.store.items(COINS):
+                f.write(encode_varint(len(key)) + key)
+                f.write(encode_varint(len(value)) + value)
+                hasher.update(key)
+                hasher.update(value)
+                coin_count += 1
+
+            commitment = hashlib.sha256(hasher.digest()).digest()
+            f.write(commitment)
+            f.seek(count_pos)
+            f.write(int_to_little_endian(coin_count, 8))
+        os.replace(tmp_path, path)
+
+    logger.info(f"Dumped {coin_count} UTXOs at height {tip.height} to {path}")
+    return {
+        "path": path,
+        "height": tip.height,
+        "base_hash": tip.hash,
+        "coins": coin_count,
+        "commitment": commitment.hex(),
+    }
+
+
+def read_headers(f, base_hash, height):
+    headers = []
+    prev_hash = None
+    for i in range(height + 1):
+        block_header = BlockHeader.parse(f)
+        block_hash = block_header.generateBlockHash()
+        if i == 0 and block_hash != GENESIS_BLOCK_HASH:
+            raise SnapshotError("Snapshot does not start at our genesis block")
+        if i > 0 and block_header.prevBlockHash.hex() != prev_hash:
+            raise SnapshotError(f"Snapshot header {i} does not link to its parent")
+        if block_header.bits != get_expected_bits(headers, i):
+            raise SnapshotError(f"Snapshot header {i} has an unexpected difficulty")
+        if not check_pow(block_header):
+            raise SnapshotError(f"Snapshot header {i} has an invalid proof of work")
+        headers.append(block_header)
+        prev_hash = block_hash
+
+    if prev_hash != base_hash:
+        raise SnapshotError("Snapshot headers do not end at its base block")
+    return headers
+
+
+def load_snapshot(chain_manager, path, expected_commitment=None):
+    """Replaces the UTXO set of a node without blocks by the one in a snapshot file
+
+    The chain tip moves to the snapshot base block. Its headers are indexed
+    without block data, those blocks are downloaded and checked later by
+    SnapshotValidator.
+    """
+    db = chain_manager.db
+    utxos = chain_manager.utxos
+    with chain_manager.chain_lock:
+        if db.get_chain_height() > 0:
+            raise SnapshotError(
+                "A snapshot can only be loaded on a node without blocks"
+            )
+
+        with open(path, "rb") as f:
+            if f.read(5) != SNAPSHOT_MAGIC + bytes([SNAPSHOT_VERSION]):
+                raise SnapshotError(f"{path} is not a UTXO snapshot")
+            base_hash = f.read(32).hex()
+            height = little_endian_to_int(f.read(4))
+            coin_count = little_endian_to_int(f.read(8))
+
+            db.write_headers(read_headers(f, base_hash, height), 0)
+            logger.info(f"Loading {coin_count} UTXOs at height {height} from {path}")
+
+            utxos.clear()
+            chain_manager.txindex.clear()
+            if chain_manager.addrindex is not None:
+                chain_manager.addrindex.clear()
+            if chain_manager.chainstats is not None:
+                # Blocks below the base are added once validated
+                chain_manager.chainstats.clear()
+                chain_manager.chainstats.complete = True
+            hasher = hashlib.sha256()
+            for _ in range(coin_count):
+                key = f.read(read_varint(f))
+                value = f.read(read_varint(f))
+                hasher.update(key)
+                hasher.update(value)
+                utxos[key] = Coin.parse(BytesIO(value))
+                if utxos.memory_usage() >= utxos.max_memory:
+                    chain_manager.flush_state(force=True)
+
+            commitment = hashlib.sha256(hasher.digest()).digest().hex()
+            if f.read(32).hex() != commitment or (
+                expected_commitment and expected_commitment != commitment
+            ):
+                utxos.clear()
+                raise SnapshotError(f"Snapshot commitment mismatch for {path}")
+
+        db.set_main_chain_tip(base_hash)
+        utxos.set_meta("last_block_hash", base_hash)
+        chain_manager.flush_state(force=True)
+        set_snapshot_info(
+            db,
+            {
+                "base_hash": base_hash,
+                "height": height,
+                "commitment": commitment,
+                "validated": False,
+            },
+        )
+
+    logger.info(f"Snapshot loaded, chain tip is now block {height} ({base_hash})")
+    return commitment
+
+
+class SnapshotValidator:
+    """Connects the blocks below a loaded snapshot in a separate UTXO set
+
+    Blocks are connected as soon as their data is downloaded. Once the base
+    block is reached, the UTXO set it built must match the snapshot commitment.
+    Progress is kept in its own store so a restart resumes where it stopped.
+    A snapshot that fails is marked invalid and on_invalid is called, the
+    node must not keep using the chain state it was loaded into.
+    """
+
+    def __init__(self, chain_manager, path=SNAPSHOT_VALIDATION_FILE, on_invalid=None):
+        self.chain_manager = chain_manager
+        self.db = chain_manager.db
+        self.path = path
+        self.on_invalid = on_invalid
+        self.stop_event = Event()
+        self.thread = None
+        # Blocks are pruned only once connected here
+        chain_manager.prune_limit = -1
+
+    def start(self):
+        self.thread = Thread(target=self.run, name="SnapshotValidator", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        if self.thread:
+            self.thread.join()
+
+    def run(self):
+        info = get_snapshot_info(self.db)
+        store = KVStore(self.path)
+        utxos = UTXOCache(UTXODB(store))
+        addrindex = None
+        if self.chain_manager.addrindex is not None:
+            addrindex = AddressIndexDB(store)
+        chainstats = None
+        if self.chain_manager.chainstats is not None:
+            chainstats = ChainStatsDB(store)
+        # Own mempool so connecting old blocks leaves the node mempool alone
+        background = ChainManager(
+            self.db, utxos, {}, TxIndexDB(store), Event(), addrindex, chainstats
+        )
+
+        last_entry = self.db.get_index(utxos.get_meta("last_block_hash"))
+        height = last_entry.height + 1 if last_entry else 0
+        self.chain_manager.prune_limit = height - 1
+        logger.info(
+            f"Validating snapshot {info['base_hash']} in the background from block {height}"
+        )
+
+        while height <= info["height"] and not self.stop_event.is_set():
+            index_entry = self.db.get_index_at_height(height)
+            block = self.db.get_block(index_entry.hash)
+            if block is None:
+                self.stop_event.wait(SNAPSHOT_VALIDATION_POLL)
+                continue
+
+            if not background.connect_block(block):
+                store.close()
+                self.invalidate(info, f"block {height} does not connect")
+                return
+            utxos.set_meta("last_block_hash", index_entry.hash)
+            utxos.commit()
+            if utxos.needs_flush():
+                self.flush(store, background)
+                self.chain_manager.prune_limit = height
+            height += 1
+
+        self.flush(store, background)
+        if height <= info["height"]:
+            store.close()
+            return
+
+        validated = compute_commitment(store).hex() == info["commitment"]
+        if validated:
+            self.import_indexes(store, background)
+            info["validated"] = True
+            set_snapshot_info(self.db, info)
+            self.chain_manager.prune_limit = None
+            logger.info(f"Snapshot {info['base_hash']} validated")
+        store.close()
+        for suffix in ("", "-wal", "-shm"):
+            if os.path.exists(self.path + suffix):
+                os.remove(self.path + suffix)
+        if not validated:
+            self.invalidate(info, f"UTXO set at block {info['height']} does not match")
+
+    def invalidate(self, info, reason):
+        info["validated"] = False
+        info["invalid"] = True
+        set_snapshot_info(self.db, info)
+        logger.error(
+            f"Snapshot validation failed: {reason}. Its chain state cannot be used, restart with -reindex once all blocks are stored"
+        )
+        if self.on_invalid:
+            self.on_invalid()
+
+    def flush(self, store, background):
+        batch = WriteBatch()
+        background.txindex.write_batch(batch)
+        if background.addrindex is not None:
+            background.addrindex.write_batch(
+                batch, background.utxos.get_meta("last_block_hash")
+            )
+        if background.chainstats is not None:
+            background.chainstats.write_batch(
+                batch, background.utxos.get_meta("last_block_hash")
+            )
+        background.utxos.write_batch(batch)
+        store.write(batch)
+
+    def import_indexes(self, store, background):
+        # Blocks below the base were only indexed in the validation store
+        batch = WriteBatch()
+        for key, value in store.items(TXINDEX):
+            batch.put(TXINDEX, key, value)
+        if self.chain_manager.addrindex is not None:
+            # Outputs spent after the base are already indexed as spent
+            for key, value in store.items(ADDRINDEX):
+                if not self.db.store.contains(ADDRINDEX, key):
+                    batch.put(ADDRINDEX, key, value)
+        self.db.store.write(batch)
+        if background.chainstats is not None:
+            with self.chain_manager.chain_lock:
+                self.chain_manager.chainstats.add_stats(background.chainstats)
+                self.chain_manager.flush_state(force=True)
@@ -3,6 +3,7 @@ import time
 
 logger = logging.getLogger(__name__)
 from src.chain.params import MAX_BLOCK_SIZE
+from src.core.coin import outpoint_key
 from src.core.coinbase_tx import CoinbaseTx
 from src.core.transaction import Tx
 from src.utils.crypto_hash import hash256
@@ -29,7 +30,7 @@ class Validator:
         input_sum = 0
         for tx_in in tx.tx_ins:
             prev_tx_hex = tx_in.prev_tx.hex()
-            key = f"{prev_tx_hex}_{tx_in.prev_index}"
+            key = outpoint_key(tx_in.prev_tx, tx_in.prev_index)
 
             if not is_in_block:
                 for mempool_tx in self.mempool.values():
@@ -47,13 +48,15 @@ class Validator:
 
             if key not in self.utxos:
                 logger.error(
-                    f"Validation Error (tx: {tx_id}): UTXO {key} not in set or already spent"
+                    f"Validation Error (tx: {tx_id}): UTXO {prev_tx_hex}:{tx_in.prev_index} not in set or already spent"
                 )
                 return False
 
             output_to_spend = self.utxos.get(key)
             if output_to_spend is None:
-                logger.error(f"Validation Error (tx: {tx_id}): UTXO {key} is None")
+                logger.error(
+                    f"Validation Error (tx: {tx_id}): UTXO {prev_tx_hex}:{tx_in.prev_index} is None"
+                )
                 return False
 
             input_sum += output_to_spend.amount
@@ -66,7 +69,7 @@ class Validator:
             return False
 
         for i, tx_in in enumerate(tx.tx_ins):
-            key = f"{tx_in.prev_tx.hex()}_{tx_in.prev_index}"
+            key = outpoint_key(tx_in.prev_tx, tx_in.prev_index)
             output_to_spend = self.utxos[key]
 
             script_pubkey = output_to_spend.script_pubkey
@@ -77,7 +80,7 @@ class Validator:
                 return False
         return True
 
-    def validate_block_header(self, block_header, db):
+    def validate_block_header(self, block_header, db, height):
         if not check_pow(block_header):
             logger.error(f"Header validation failed: Invalid Proof of Work")
             return False
@@ -98,14 +101,21 @@ class Validator:
             return False
 
         if prev_hash != "00" * 32:
-            parent_block = db.get_block(prev_hash)
-            if not parent_block:
+            parent_index = db.get_index(prev_hash)
+            if not parent_index:
                 logger.error(
                     f"Header validation failed: Could not retrieve parent block {prev_hash[:10]} for timestamp check"
                 )
                 return False
 
-            parent_timestamp = parent_block["BlockHeader"]["timestamp"]
+            # The active chain and skip pointers are placed by height
+            if height != parent_index.height + 1:
+                logger.error(
+                    f"Header validation failed: Block height {height} does not follow parent height {parent_index.height}"
+                )
+                return False
+
+            parent_timestamp = parent_index.timestamp
 
             if (
                 block_header.timestamp < parent_timestamp
@@ -116,6 +126,11 @@ class Validator:
                 )
                 return False
             # TODO: Replace paren_timestamp with a real Median Time Past, we keep this for now
+        elif height != 0:
+            logger.error(
+                f"Header validation failed: Block without parent at height {height}"
+            )
+            return False
         return True
 
     def validate_block_body(self, block, db):
@@ -180,7 +195,7 @@ class Validator:
         spent_utxos_in_block = set()
         for tx in block.Txs[1:]:
             for tx_in in tx.tx_ins:
-                utxo_id = f"{tx_in.prev_tx.hex()}_{tx_in.prev_index}"
+                utxo_id = f"{tx_in.prev_tx.hex()}:{tx_in.prev_index}"
                 if utxo_id in spent_utxos_in_block:
                     logger.error(
                         f"Block validation failed (Block {block.Height}): Double spend inside the same block for UTXO {utxo_id}"
@@ -209,12 +224,12 @@ class Validator:
             output_sum = 0
 
             for tx_in in tx.tx_ins:
-                key = f"{tx_in.prev_tx.hex()}_{tx_in.prev_index}"
+                key = outpoint_key(tx_in.prev_tx, tx_in.prev_index)
                 output_to_spend = self.utxos.get(key)
 
                 if not output_to_spend:
                     logger.error(
-                        f"Block validation failed (Block {block.Height}): Could not find UTXO {key} for fee calculation"
+                        f"Block validation failed (Block {block.Height}): Could not find UTXO {tx_in.prev_tx.hex()}:{tx_in.prev_index} for fee calculation"
                     )
                     return False
 
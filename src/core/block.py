@@ -65,6 +65,11 @@ class Block:
 
     def to_dict(self):
         self.BlockHeader.to_hex()
-        self.BlockHeader = self.BlockHeader.__dict__
-        self.Txs = [tx.to_dict() for tx in self.Txs]
-        return self.__dict__
+        tx_json_list = [tx.to_dict() for tx in self.Txs]
+        return {
+            "Height": self.Height,
+            "Blocksize": self.Blocksize,
+            "BlockHeader": self.BlockHeader.__dict__,
+            "TxCount": len(tx_json_list),
+            "Txs": tx_json_list,
+        }
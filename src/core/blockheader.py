@@ -1,4 +1,3 @@
-from src.database.db_manager import BlockchainDB
 from src.utils.crypto_hash import hash256
 from src.utils.serialization import int_to_little_endian, little_endian_to_int
 
@@ -0,0 +1,77 @@
+from io import BytesIO
+
+from src.scripts.script import Script
+from src.utils.serialization import encode_varint, read_varint
+
+SCRIPT_P2PKH = 0
+SCRIPT_RAW = 1
+
+
+def outpoint_key(tx_id_bytes, index):
+    """Binary key of an output in the UTXO set: 32-byte txid + varint index"""
+    return bytes(tx_id_bytes) + encode_varint(index)
+
+
+def parse_outpoint_key(key):
+    return key[:32], read_varint(BytesIO(key[32:]))
+
+
+def is_p2pkh(cmds):
+    return (
+        len(cmds) == 5
+        and cmds[0] == 0x76
+        and cmds[1] == 0xA9
+        and isinstance(cmds[2], bytes)
+        and len(cmds[2]) == 20
+        and cmds[3] == 0x88
+        and cmds[4] == 0xAC
+    )
+
+
+def p2pkh_h160(script_pubkey):
+    """hash160 paid by a P2PKH script, None for any other script"""
+    if is_p2pkh(script_pubkey.cmds):
+        return script_pubkey.cmds[2]
+    return None
+
+
+def compress_script(script_pubkey):
+    if is_p2pkh(script_pubkey.cmds):
+        return bytes([SCRIPT_P2PKH]) + script_pubkey.cmds[2]
+    return bytes([SCRIPT_RAW]) + script_pubkey.serialize()
+
+
+def decompress_script(s):
+    script_type = s.read(1)[0]
+    if script_type == SCRIPT_P2PKH:
+        return Script.p2pkh_script(s.read(20))
+    return Script.parse(s)
+
+
+class Coin:
+    """Unspent output as stored in the UTXO set"""
+
+    __slots__ = ("amount", "script_pubkey", "height", "is_coinbase")
+
+    def __init__(self, amount, script_pubkey, height=0, is_coinbase=False):
+        self.amount = amount
+        self.script_pubkey = script_pubkey
+        self.height = height
+        self.is_coinbase = is_coinbase
+
+    @classmethod
+    def from_tx_out(cls, tx_out, height, is_coinbase):
+        return cls(tx_out.amount, tx_out.script_pubkey, height, is_coinbase)
+
+    def serialize(self):
+        result = encode_varint(self.height * 2 + int(self.is_coinbase))
+        result += encode_varint(self.amount)
+        result += compress_script(self.script_pubkey)
+        return result
+
+    @classmethod
+    def parse(cls, s):
+        code = read_varint(s)
+        amount = read_varint(s)
+        script_pubkey = decompress_script(s)
+        return cls(amount, script_pubkey, code >> 1, bool(code & 1))
@@ -0,0 +1,143 @@
+from io import BytesIO
+
+from src.core.blockheader import BlockHeader
+from src.utils.serialization import little_endian_to_int
+
+
+class BlockIndexEntry:
+    """In-memory node of the header tree, linked to its parent"""
+
+    __slots__ = (
+        "hash",
+        "height",
+        "prev",
+        "skip",
+        "total_work",
+        "status",
+        "file",
+        "offset",
+        "length",
+        "undo_offset",
+        "undo_length",
+        "header",
+    )
+
+    def __init__(
+        self,
+        block_hash,
+        height,
+        prev,
+        total_work,
+        status,
+        header,
+        file=None,
+        offset=None,
+        length=None,
+        undo_offset=None,
+        undo_length=None,
+    ):
+        self.hash = block_hash
+        self.height = height
+        self.prev = prev
+        self.skip = None
+        self.total_work = total_work
+        self.status = status
+        self.header = header
+        self.file = file
+        self.offset = offset
+        self.length = length
+        self.undo_offset = undo_offset
+        self.undo_length = undo_length
+        if prev:
+            self.skip = prev.get_ancestor(get_skip_height(height))
+
+    @property
+    def prev_hash(self):
+        return self.header[4:36][::-1].hex()
+
+    @property
+    def timestamp(self):
+        return little_endian_to_int(self.header[68:72])
+
+    @property
+    def bits(self):
+        return self.header[72:76]
+
+    def get_ancestor(self, height):
+        """Returns the ancestor at height on this entry's branch, using skip pointers"""
+        if height > self.height or height < 0:
+            return None
+
+        entry = self
+        while entry and entry.height > height:
+            skip_height = get_skip_height(entry.height)
+            skip_height_prev = get_skip_height(entry.height - 1)
+            if entry.skip and (
+                skip_height == height
+                or (
+                    skip_height > height
+                    and not (
+                        skip_height_prev < skip_height - 2
+                        and skip_height_prev >= height
+                    )
+                )
+            ):
+                entry = entry.skip
+            else:
+                entry = entry.prev
+        return entry
+
+    def get_header(self):
+        block_header = BlockHeader.parse(BytesIO(self.header))
+        block_header.blockHash = self.hash
+        return block_header
+
+    def has_data(self):
+        return self.file is not None
+
+    def has_undo(self):
+        return self.undo_offset is not None
+
+    def to_dict(self):
+        return {
+            "hash": self.hash,
+            "height": self.height,
+            "prev_hash": self.prev_hash,
+            "total_work": self.total_work,
+            "status": self.status,
+            "file": self.file,
+            "offset": self.offset,
+            "length": self.length,
+            "undo_offset": self.undo_offset,
+            "undo_length": self.undo_length,
+            "header": self.header.hex(),
+        }
+
+
+def invert_lowest_one(n):
+    return n & (n - 1)
+
+
+def get_skip_height(height):
+    """Height the skip pointer of an entry at height points to (same scheme as Bitcoin)"""
+    if height < 2:
+        return 0
+    if height & 1:
+        return invert_lowest_one(invert_lowest_one(height - 1)) + 1
+    return invert_lowest_one(height)
+
+
+def find_fork(entry_a, entry_b):
+    """Returns the last common ancestor of two entries of the header tree"""
+    if not entry_a or not entry_b:
+        return None
+
+    if entry_a.height > entry_b.height:
+        entry_a = entry_a.get_ancestor(entry_b.height)
+    elif entry_b.height > entry_a.height:
+        entry_b = entry_b.get_ancestor(entry_a.height)
+
+    while entry_a and entry_b and entry_a is not entry_b:
+        entry_a = entry_a.prev
+        entry_b = entry_b.prev
+    return entry_a if entry_a is entry_b else None
@@ -2,15 +2,46 @@ import logging
 
 logger = logging.getLogger(__name__)
 
+import heapq
 import json
+import mmap
 import os
 import time
+from datetime import datetime, timezone
+from io import BytesIO
+from threading import RLock
 
 from sqlitedict import SqliteDict
 
-from src.core.transaction import Tx, TxOut
-from src.scripts.script import Script
-from src.utils.serialization import bits_to_target
+from src.chain.params import MAX_BLOCKFILE_SIZE
+from src.core.block import Block
+from src.core.coin import Coin, p2pkh_h160
+from src.core.transaction import Tx
+from src.database.block_index import BlockIndexEntry, find_fork
+from src.database.kvstore import (ADDRESS_OUTPUTS, ADDRINDEX, BLOCK_INDEX,
+                                  BLOCK_STATS, COIN_OWNERS, COINS, META,
+                                  TXINDEX, WriteBatch, open_store)
+from src.database.undo import BlockUndo
+from src.utils.serialization import (bits_to_target, encode_varint,
+                                     int_to_little_endian, read_varint)
+
+BLOCK_FILE_MAGIC = b"\xf9\xbe\xb4\xd9"
+# Tells a missing pending entry from a pending delete (None)
+MISSING = object()
+
+
+def new_utxo_stats():
+    return {"coin_count": 0, "total_amount": 0, "serialized_size": 0}
+
+
+def new_chain_totals():
+    return {
+        "best_block": None,
+        "transactions": 0,
+        "fees": 0,
+        "active_addresses": 0,
+        "daily_transactions": {},
+    }
 
 
 class BaseDB:
@@ -20,113 +51,533 @@ class BaseDB:
 
 
 class BlockchainDB(BaseDB):
-    def __init__(self):
+    def __init__(self, store=None, prune_target=0):
         self.basepath = "data"
-        self.blocks_db_file = os.path.join(self.basepath, "blockchain.sqlite")
-        self.index_db_file = os.path.join(self.basepath, "block_index.sqlite")
-        self.db = SqliteDict(self.blocks_db_file, autocommit=False)
-        self.index_db = SqliteDict(self.index_db_file, autocommit=True)
-        self.MAIN_TIP_KEY = "_MAIN_CHAIN_TIP"
-
-    def read(self):
-        blocks = []
-        current_hash = self.get_main_chain_tip_hash()
-
-        while current_hash:
-            block = self.get_block(current_hash)
-            if not block:
-                break
-            blocks.append(block)
-            current_hash = block["BlockHeader"]["prevBlockHash"]
-
-            if current_hash == "00" * 32:
-                break
+        self.blocks_dir = os.path.join(self.basepath, "blocks")
+        self.legacy_blocks_db_file = os.path.join(self.basepath, "blockchain.sqlite")
+        self.legacy_index_db_file = os.path.join(self.basepath, "block_index.sqlite")
+        os.makedirs(self.blocks_dir, exist_ok=True)
+        self.store = store or open_store()
+        self.MAIN_TIP_KEY = "main_chain_tip"
+        self.PRUNED_HEIGHT_KEY = "pruned_height"
+        self.prune_target = prune_target
+        self.write_lock = RLock()
+        self.block_file_maps = {}
+        self.maps_lock = RLock()
+
+        self.current_file = self.find_last_block_file()
+        self.block_index = {}
+        self.active_chain = []
+        self.main_tip_hash = None
+        self.dirty_entries = set()
+        self.tip_dirty = False
+        if os.path.exists(self.legacy_index_db_file):
+            self.import_legacy_index()
+        self.load_block_index()
+        if os.path.exists(self.legacy_blocks_db_file):
+            self.import_legacy_blocks()
+        self.pruned_height = json.loads(
+            self.store.get(META, self.PRUNED_HEIGHT_KEY, "-1")
+        )
+        stored_tip = self.store.get(META, self.MAIN_TIP_KEY)
+        self.update_active_chain(json.loads(stored_tip) if stored_tip else None)
 
-        return list(reversed(blocks))
+    def load_block_index(self):
+        stored_entries = sorted(
+            (json.loads(value) for _, value in self.store.items(BLOCK_INDEX)),
+            key=lambda entry: entry["height"],
+        )
+        for stored in stored_entries:
+            self.add_stored_entry(stored)
+        logging.debug(f"Loaded {len(self.block_index)} block index entries")
+
+    def add_stored_entry(self, stored):
+        header = stored.get("header")
+        if header:
+            header = bytes.fromhex(header)
+        elif stored.get("file") is not None:
+            header = self.read_stored_header(stored)
+        if not header:
+            logging.debug(f"Block index entry {stored['hash']} has no header")
+            return None
 
-    def write(self, items):
+        index_entry = BlockIndexEntry(
+            stored["hash"],
+            stored["height"],
+            self.block_index.get(stored["prev_hash"]),
+            stored["total_work"],
+            stored["status"],
+            header,
+            stored.get("file"),
+            stored.get("offset"),
+            stored.get("length"),
+            stored.get("undo_offset"),
+            stored.get("undo_length"),
+        )
+        self.block_index[stored["hash"]] = index_entry
+        return index_entry
+
+    def refresh(self):
+        """Follows the chain state another process flushed to the store
+
+        Used by read-only views of the chain. Loads the index entries of new
+        blocks and moves the active chain to the stored tip. Returns the
+        entries that left the active chain (tip first) and those that joined
+        it (lowest first).
+        """
+        with self.write_lock:
+            stored_tip = self.store.get(META, self.MAIN_TIP_KEY)
+            stored_tip = json.loads(stored_tip) if stored_tip else None
+            pruned_height = json.loads(
+                self.store.get(META, self.PRUNED_HEIGHT_KEY, "-1")
+            )
+
+            # Pruned entries lost their block data
+            pruned = self.active_chain[self.pruned_height + 1 : pruned_height + 1]
+            for index_entry in pruned:
+                self.reload_entry(index_entry)
+            self.pruned_height = pruned_height
+            if stored_tip == self.main_tip_hash:
+                return [], []
+
+            new_entries = []
+            block_hash = stored_tip
+            while block_hash and block_hash not in self.block_index:
+                value = self.store.get(BLOCK_INDEX, block_hash)
+                if value is None:
+                    logging.error(f"Stored chain tip {stored_tip} has no index entry")
+                    return [], []
+                new_entries.append(json.loads(value))
+                block_hash = new_entries[-1]["prev_hash"]
+            for stored in reversed(new_entries):
+                self.add_stored_entry(stored)
+
+            fork = find_fork(self.get_main_chain_tip(), self.get_index(stored_tip))
+            fork_height = fork.height if fork else -1
+            disconnected = self.active_chain[fork_height + 1 :][::-1]
+            self.update_active_chain(stored_tip)
+            connected = self.active_chain[fork_height + 1 :]
+            # Known entries may have got their block or undo data since loaded
+            for index_entry in connected:
+                self.reload_entry(index_entry)
+            return disconnected, connected
+
+    def reload_entry(self, index_entry):
+        value = self.store.get(BLOCK_INDEX, index_entry.hash)
+        if value is None:
+            return
+        stored = json.loads(value)
+        index_entry.file = stored.get("file")
+        index_entry.offset = stored.get("offset")
+        index_entry.length = stored.get("length")
+        index_entry.undo_offset = stored.get("undo_offset")
+        index_entry.undo_length = stored.get("undo_length")
+
+    def read_stored_header(self, stored):
+        # Entries written before headers were indexed: read it from the block file
         try:
-            for block_dict in items:
-                block_hash = block_dict["BlockHeader"]["blockHash"]
-                self.db[block_hash] = block_dict
-                self.write_index(block_hash, block_dict)
+            with open(self.block_file_path(stored["file"]), "rb") as f:
+                f.seek(stored["offset"] + 8)
+                return f.read(80)
+        except OSError as e:
+            logging.error(f"Could not read header of block {stored['hash']}: {e}")
+            return None
 
-            self.db.commit()
-        except Exception as e:
-            logging.error(f"Error when writing to db: {e}")
-            self.db.rollback()
+    def block_file_path(self, file_number):
+        return os.path.join(self.blocks_dir, f"blk{file_number:05d}.dat")
+
+    def undo_file_path(self, file_number):
+        return os.path.join(self.blocks_dir, f"rev{file_number:05d}.dat")
 
-    def write_block(self, block_dict):
+    def find_last_block_file(self):
+        file_numbers = [
+            int(name[3:8])
+            for name in os.listdir(self.blocks_dir)
+            if name.startswith("blk") and name.endswith(".dat")
+        ]
+        return max(file_numbers) if file_numbers else 0
+
+    def append_to_block_file(self, raw_block):
+        record_size = len(BLOCK_FILE_MAGIC) + 4 + len(raw_block)
+        path = self.block_file_path(self.current_file)
+        if (
+            os.path.exists(path)
+            and os.path.getsize(path) + record_size > MAX_BLOCKFILE_SIZE
+        ):
+            self.current_file += 1
+            path = self.block_file_path(self.current_file)
+
+        return self.current_file, self.append_record(path, raw_block)
+
+    def append_record(self, path, payload):
+        with open(path, "ab") as f:
+            f.write(BLOCK_FILE_MAGIC)
+            f.write(int_to_little_endian(len(payload), 4))
+            offset = f.tell()
+            f.write(payload)
+            f.flush()
+            os.fsync(f.fileno())
+        return offset
+
+    def write_block(self, block_obj):
+        block_hash = block_obj.BlockHeader.generateBlockHash()
         try:
-            block_hash = block_dict["BlockHeader"]["blockHash"]
-            self.db[block_hash] = block_dict
-            self.db.commit()
-            self.write_index(block_hash, block_dict)
+            raw_block = block_obj.serialize()
+            with self.write_lock:
+                file_number, offset = self.append_to_block_file(raw_block)
+                self.write_index(
+                    block_hash,
+                    block_obj.BlockHeader,
+                    block_obj.Height,
+                    file_number,
+                    offset,
+                    len(raw_block),
+                )
             return True
 
         except Exception as e:
             logging.error(f"Error when writing block {block_hash} to db: {e}")
-            self.db.rollback()
             return False
 
-    def write_index(self, block_hash, block_dict):
-        prev_hash = block_dict["BlockHeader"]["prevBlockHash"]
-        prev_index = self.get_index(prev_hash)
-        if prev_index:
-            total_work = prev_index["total_work"] + self.calculate_work(block_dict)
+    def write_headers(self, block_headers, start_height):
+        """Indexes consecutive headers whose blocks are not stored (yet)"""
+        batch = WriteBatch()
+        with self.write_lock:
+            for height, block_header in enumerate(block_headers, start_height):
+                block_hash = block_header.generateBlockHash()
+                if block_hash not in self.block_index:
+                    self.write_index(block_hash, block_header, height, batch=batch)
+            self.store.write(batch)
+
+    def write_index(
+        self,
+        block_hash,
+        block_header,
+        height,
+        file_number=None,
+        offset=None,
+        length=None,
+        batch=None,
+    ):
+        index_entry = self.get_index(block_hash)
+        if index_entry:
+            # Header-only entry, its block data just arrived
+            index_entry.file = file_number
+            index_entry.offset = offset
+            index_entry.length = length
         else:
-            total_work = self.calculate_work(block_dict)
-
-        index_entry = {
-            "hash": block_hash,
-            "height": block_dict["Height"],
-            "prev_hash": prev_hash,
-            "total_work": total_work,
-            "status": "valid-header",
-        }
-        self.index_db[block_hash] = index_entry
+            prev_index = self.get_index(block_header.prevBlockHash.hex())
+            total_work = self.calculate_work(block_header.bits)
+            if prev_index:
+                total_work += prev_index.total_work
+
+            index_entry = BlockIndexEntry(
+                block_hash,
+                height,
+                prev_index,
+                total_work,
+                "valid-header",
+                block_header.serialize(),
+                file_number,
+                offset,
+                length,
+            )
+            self.block_index[block_hash] = index_entry
+
+        if batch is not None:
+            batch.put(BLOCK_INDEX, block_hash, json.dumps(index_entry.to_dict()))
+        else:
+            self.store.put(BLOCK_INDEX, block_hash, json.dumps(index_entry.to_dict()))
+        return index_entry
 
-    def calculate_work(self, block_dict):
+    def calculate_work(self, bits):
         try:
-            bits_hex = block_dict["BlockHeader"]["bits"]
-            target = bits_to_target(bytes.fromhex(bits_hex))
+            if isinstance(bits, str):
+                bits = bytes.fromhex(bits)
+            target = bits_to_target(bits)
             return (2**256) // (target + 1)
         except Exception as e:
             logging.error(f"Error calculating work: {e}. Defaulting to 0")
             return 0
 
+    def write_undo(self, block_hash, block_undo):
+        """Stores the coins spent by a block in the rev file paired with its blk file"""
+        index_entry = self.get_index(block_hash)
+        if not index_entry or not index_entry.has_data():
+            logging.error(f"Cannot write undo data of unknown block {block_hash}")
+            return False
+        if index_entry.has_undo():
+            return True
+
+        raw_undo = block_undo.serialize()
+        try:
+            with self.write_lock:
+                index_entry.undo_offset = self.append_record(
+                    self.undo_file_path(index_entry.file), raw_undo
+                )
+                index_entry.undo_length = len(raw_undo)
+                self.dirty_entries.add(block_hash)
+            return True
+        except Exception as e:
+            logging.error(f"Error when writing undo data of block {block_hash}: {e}")
+            return False
+
+    def get_block_undo(self, block_hash):
+        index_entry = self.get_index(block_hash)
+        if not index_entry or not index_entry.has_undo():
+            return None
+        try:
+            with open(self.undo_file_path(index_entry.file), "rb") as f:
+                f.seek(index_entry.undo_offset)
+                raw_undo = f.read(index_entry.undo_length)
+            return BlockUndo.parse(BytesIO(raw_undo))
+        except Exception as e:
+            logging.error(f"Error when reading undo data of block {block_hash}: {e}")
+            return None
+
+    def get_tx_undo(self, block_hash, offset, length):
+        """Coins spent by one tx, read from its slice of the block undo data"""
+        index_entry = self.get_index(block_hash)
+        if not index_entry or not index_entry.has_undo():
+            return None
+        try:
+            with open(self.undo_file_path(index_entry.file), "rb") as f:
+                f.seek(index_entry.undo_offset + offset)
+                s = BytesIO(f.read(length))
+            return [Coin.parse(s) for _ in range(read_varint(s))]
+        except Exception as e:
+            logging.error(f"Error when reading undo data of block {block_hash}: {e}")
+            return None
+
+    def get_block_file_map(self, file_number, min_size):
+        with self.maps_lock:
+            block_map = self.block_file_maps.get(file_number)
+            if block_map is None or len(block_map) < min_size:
+                # Block files only grow: remap and leave the old map to its views
+                with open(self.block_file_path(file_number), "rb") as f:
+                    block_map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                self.block_file_maps[file_number] = block_map
+            return block_map
+
+    def get_block_files_size(self):
+        return sum(
+            os.path.getsize(os.path.join(self.blocks_dir, name))
+            for name in os.listdir(self.blocks_dir)
+            if name.endswith(".dat")
+        )
+
+    def prune_block_files(self, max_height):
+        """Deletes the oldest blk/rev file pairs until block storage fits prune_target
+
+        Only files without blocks above max_height are removed. Their index
+        entries keep the header, like blocks whose data was never downloaded.
+        Returns the numbers of the pruned files.
+        """
+        if not self.prune_target:
+            return []
+
+        with self.write_lock:
+            total_size = self.get_block_files_size()
+            if total_size <= self.prune_target:
+                return []
+
+            file_entries = {}
+            for index_entry in self.block_index.values():
+                if index_entry.has_data():
+                    file_entries.setdefault(index_entry.file, []).append(index_entry)
+
+            batch = WriteBatch()
+            pruned_files = []
+            pruned_height = self.pruned_height
+            # The file being appended to is never pruned
+            for file_number in range(self.current_file):
+                if total_size <= self.prune_target:
+                    break
+                paths = [
+                    self.block_file_path(file_number),
+                    self.undo_file_path(file_number),
+                ]
+                entries = file_entries.get(file_number, [])
+                if not entries and not any(os.path.exists(path) for path in paths):
+                    continue
+                if any(index_entry.height > max_height for index_entry in entries):
+                    break
+
+                for index_entry in entries:
+                    index_entry.file = None
+                    index_entry.offset = None
+                    index_entry.length = None
+                    index_entry.undo_offset = None
+                    index_entry.undo_length = None
+                    batch.put(
+                        BLOCK_INDEX, index_entry.hash, json.dumps(index_entry.to_dict())
+                    )
+                    pruned_height = max(pruned_height, index_entry.height)
+                total_size -= sum(
+                    os.path.getsize(path) for path in paths if os.path.exists(path)
+                )
+                pruned_files.append((file_number, paths))
+
+            if not pruned_files:
+                return []
+
+            # Index first: a crash before the deletes only leaves unused files
+            batch.put(META, self.PRUNED_HEIGHT_KEY, json.dumps(pruned_height))
+            self.store.write(batch)
+            self.pruned_height = pruned_height
+            for file_number, paths in pruned_files:
+                with self.maps_lock:
+                    # Open views keep their map, the file just goes away
+                    self.block_file_maps.pop(file_number, None)
+                for path in paths:
+                    if os.path.exists(path):
+                        os.remove(path)
+
+        logging.info(
+            f"Pruned {len(pruned_files)} block files up to height {pruned_height}"
+        )
+        return [file_number for file_number, _ in pruned_files]
+
+    def is_pruned(self, block_hash):
+        index_entry = self.get_index(block_hash)
+        return (
+            bool(index_entry)
+            and not index_entry.has_data()
+            and index_entry.height <= self.pruned_height
+        )
+
+    def get_block_view(self, block_hash):
+        """Returns a memoryview of the serialized block straight from the mapped file"""
+        index_entry = self.get_index(block_hash)
+        if not index_entry or not index_entry.has_data():
+            return None
+
+        start = index_entry.offset
+        end = start + index_entry.length
+        try:
+            block_map = self.get_block_file_map(index_entry.file, end)
+        except (OSError, ValueError) as e:
+            logging.error(f"Error when mapping block {block_hash} from disk: {e}")
+            return None
+
+        if len(block_map) < end:
+            logging.error(f"Block {block_hash} is truncated on disk")
+            return None
+        return memoryview(block_map)[start:end]
+
+    def get_raw_block(self, block_hash):
+        block_view = self.get_block_view(block_hash)
+        if block_view is None:
+            return None
+        return block_view.tobytes()
+
+    def get_block_tx(self, block_hash, offset, length):
+        """Parses one tx out of a block record, without reading the rest of it"""
+        block_view = self.get_block_view(block_hash)
+        if block_view is None or len(block_view) < offset + length:
+            return None
+        tx = Tx.parse(BytesIO(block_view[offset : offset + length].tobytes()))
+        tx.TxId = tx.id()
+        return tx
+
     def get_block(self, block_hash):
-        return self.db.get(block_hash)
+        raw_block = self.get_raw_block(block_hash)
+        if raw_block is None:
+            return None
+        block = Block.parse(BytesIO(raw_block))
+        block.BlockHeader.blockHash = block_hash
+        return block
+
+    def has_block(self, block_hash):
+        index_entry = self.get_index(block_hash)
+        return bool(index_entry) and index_entry.has_data()
 
     def get_index(self, block_hash):
-        if block_hash == "00" * 32:
-            return None
-        return self.index_db.get(block_hash)
+        return self.block_index.get(block_hash)
 
     def set_main_chain_tip(self, block_hash):
-        self.index_db[self.MAIN_TIP_KEY] = block_hash
+        self.update_active_chain(block_hash)
+        self.tip_dirty = True
         logging.debug(f"New main chain tip set to: {block_hash}")
 
-    def get_main_chain_tip_hash(self):
-        return self.index_db.get(self.MAIN_TIP_KEY)
+    def write_batch(self, batch):
+        """Adds the updated index entries and the chain tip to a chain state batch"""
+        with self.write_lock:
+            for block_hash in self.dirty_entries:
+                index_entry = self.get_index(block_hash)
+                batch.put(BLOCK_INDEX, block_hash, json.dumps(index_entry.to_dict()))
+            if self.tip_dirty:
+                batch.put(META, self.MAIN_TIP_KEY, json.dumps(self.main_tip_hash))
+            flushed_entries = set(self.dirty_entries)
+
+        def on_commit():
+            with self.write_lock:
+                self.dirty_entries -= flushed_entries
+                self.tip_dirty = False
+
+        batch.on_commit(on_commit)
+
+    def update_active_chain(self, block_hash):
+        """Moves the height -> entry vector to a new tip, touching only the changed part"""
+        with self.write_lock:
+            new_entries = []
+            entry = self.get_index(block_hash)
+            if block_hash and not entry:
+                logging.error(f"Cannot move active chain to unknown block {block_hash}")
+                return
+            while entry and not self.is_in_active_chain(entry):
+                new_entries.append(entry)
+                entry = entry.prev
+
+            fork_height = entry.height if entry else -1
+            del self.active_chain[fork_height + 1 :]
+            self.active_chain.extend(reversed(new_entries))
+            self.main_tip_hash = block_hash if self.active_chain else None
+
+    def is_in_active_chain(self, index_entry):
+        height = index_entry.height
+        return (
+            height < len(self.active_chain) and self.active_chain[height] is index_entry
+        )
 
-    def update(self, data):
-        try:
-            self.db.clear()
-            self.db.commit()
-            self.index_db.clear()
-            self.index_db[self.MAIN_TIP_KEY] = None
-            self.write(data)
-
-            if data:
-                last_block_dict = data[-1]
-                last_hash = last_block_dict["BlockHeader"]["blockHash"]
-                self.set_main_chain_tip(last_hash)
-            return True
-        except Exception as e:
-            logging.error(f"Error when updating db: {e}")
-            self.db.rollback()
-            return False
+    def get_index_at_height(self, height):
+        if 0 <= height < len(self.active_chain):
+            return self.active_chain[height]
+        return None
+
+    def get_hash_at_height(self, height):
+        index_entry = self.get_index_at_height(height)
+        return index_entry.hash if index_entry else None
+
+    def get_chain_height(self):
+        return len(self.active_chain) - 1
+
+    def get_main_chain_tip_hash(self):
+        return self.main_tip_hash
+
+    def get_main_chain_tip(self):
+        return self.get_index(self.main_tip_hash)
+
+    def get_missing_blocks(self, start_height, limit):
+        """Active chain entries from start_height on whose block data is not stored"""
+        missing = []
+        start_height = max(start_height, self.pruned_height + 1)
+        for index_entry in self.active_chain[start_height:]:
+            if not index_entry.has_data():
+                missing.append(index_entry)
+                if len(missing) >= limit:
+                    break
+        return missing
+
+    def get_best_stored_tip(self):
+        """Entry with the most work among the blocks stored on disk"""
+        best_entry = None
+        for index_entry in self.block_index.values():
+            if index_entry.has_data() and (
+                best_entry is None or index_entry.total_work > best_entry.total_work
+            ):
+                best_entry = index_entry
+        return best_entry
 
     def lastBlock(self):
         tip_hash = self.get_main_chain_tip_hash()
@@ -134,65 +585,160 @@ class BlockchainDB(BaseDB):
             return None
         return self.get_block(tip_hash)
 
+    def import_legacy_index(self):
+        """Moves the block index and tip out of block_index.sqlite into the store"""
+        legacy_db = SqliteDict(self.legacy_index_db_file, flag="r")
+        try:
+            batch = WriteBatch()
+            for key, value in legacy_db.items():
+                if key == "_MAIN_CHAIN_TIP":
+                    batch.put(META, self.MAIN_TIP_KEY, json.dumps(value))
+                else:
+                    batch.put(BLOCK_INDEX, key, json.dumps(value))
+            logging.info(f"Importing {len(batch)} block index records...")
+            self.store.write(batch)
+        finally:
+            legacy_db.close()
+        os.replace(self.legacy_index_db_file, f"{self.legacy_index_db_file}.old")
+
+    def import_legacy_blocks(self):
+        """Moves blocks stored as dicts in blockchain.sqlite into the block files"""
+        legacy_db = SqliteDict(self.legacy_blocks_db_file, flag="r")
+        try:
+            block_dicts = sorted(legacy_db.values(), key=lambda b: b["Height"])
+            logging.info(f"Importing {len(block_dicts)} blocks from legacy database...")
+            for block_dict in block_dicts:
+                block_hash = block_dict["BlockHeader"]["blockHash"]
+                if not self.has_block(block_hash):
+                    self.write_block(Block.to_obj(block_dict))
+        finally:
+            legacy_db.close()
+        os.replace(self.legacy_blocks_db_file, f"{self.legacy_blocks_db_file}.old")
+
 
 class UTXODB(BaseDB):
-    def __init__(self):
-        self.basepath = "data"
-        self.db_file = os.path.join(self.basepath, "utxos.sqlite")
-        self.db = SqliteDict(self.db_file, autocommit=False)
-        self.meta_key_prefix = "_meta_"
-        self.TxOut = TxOut
-        self.Script = Script
+    """Coins keyed by binary outpoint, stored in the compact Coin format
+
+    COIN_OWNERS indexes the P2PKH coins by hash160 + outpoint with their
+    amount, so the coins of one address are a range scan.
+    """
+
+    def __init__(self, store=None):
+        self.store = store or open_store()
+        self.meta_key_prefix = "utxo_"
+        if not self.get_meta("owners_indexed"):
+            self.index_owners()
+
+    def index_owners(self):
+        # Chain states written before the owner index existed
+        batch = WriteBatch()
+        for key, value in self.store.items(COINS):
+            self.write_owner(batch, key, Coin.parse(BytesIO(value)))
+        self.write_meta(batch, "owners_indexed", True)
+        self.store.write(batch)
+        logger.debug(f"Indexed owners of {len(batch) - 1} coins")
 
     def get_meta(self, key):
-        return self.db.get(f"{self.meta_key_prefix}{key}")
+        value = self.store.get(META, f"{self.meta_key_prefix}{key}")
+        return json.loads(value) if value is not None else None
 
     def set_meta(self, key, value):
-        self.db[f"{self.meta_key_prefix}{key}"] = value
+        batch = WriteBatch()
+        self.write_meta(batch, key, value)
+        self.store.write(batch)
+
+    def write_meta(self, batch, key, value):
+        batch.put(META, f"{self.meta_key_prefix}{key}", json.dumps(value))
+
+    def write_coin(self, batch, key, coin, spent_coin=None):
+        """Adds a coin, or its deletion when coin is None, to a batch
+
+        spent_coin is the deleted coin, read from the set when not given.
+        """
+        if coin is None:
+            spent_coin = spent_coin or self.get(key)
+            batch.delete(COINS, key)
+            h160 = p2pkh_h160(spent_coin.script_pubkey) if spent_coin else None
+            if h160:
+                batch.delete(COIN_OWNERS, h160 + key)
+        else:
+            batch.put(COINS, key, coin.serialize())
+            self.write_owner(batch, key, coin)
+
+    def write_owner(self, batch, key, coin):
+        h160 = p2pkh_h160(coin.script_pubkey)
+        if h160:
+            batch.put(COIN_OWNERS, h160 + key, encode_varint(coin.amount))
+
+    def get_owned_coins(self, h160):
+        """outpoint key -> amount of the coins paying h160"""
+        return {
+            key[len(h160) :]: read_varint(BytesIO(value))
+            for key, value in self.store.scan(COIN_OWNERS, h160)
+        }
 
-    def commit(self):
-        self.db.commit()
+    def get_stats(self):
+        """Coin count, total amount and serialized size, kept up to date by UTXOCache"""
+        stats = self.get_meta("stats")
+        if stats is None:
+            stats = self.count_stats()
+            self.set_stats(stats)
+        return stats
+
+    def set_stats(self, stats):
+        self.set_meta("stats", stats)
+
+    def count_stats(self):
+        logger.info("UTXO set statistics missing, counting coins...")
+        stats = new_utxo_stats()
+        for k, value in self.store.items(COINS):
+            coin = Coin.parse(BytesIO(value))
+            stats["coin_count"] += 1
+            stats["total_amount"] += coin.amount
+            stats["serialized_size"] += len(k) + len(value)
+        return stats
 
     def clear(self):
-        keys_to_delete = [
-            k for k in self.db.keys() if not k.startswith(self.meta_key_prefix)
-        ]
-        for k in keys_to_delete:
-            del self.db[k]
-
-    def __setitem__(self, key, tx_out_obj):
-        self.db[key] = tx_out_obj.to_dict()
+        # The set no longer describes any block, so its best block goes too
+        self.store.clear(COINS)
+        self.store.clear(COIN_OWNERS)
+        batch = WriteBatch()
+        batch.delete(META, f"{self.meta_key_prefix}last_block_hash")
+        self.write_meta(batch, "stats", new_utxo_stats())
+        self.store.write(batch)
+
+    def __setitem__(self, key, coin):
+        batch = WriteBatch()
+        self.write_coin(batch, key, coin)
+        self.store.write(batch)
 
     def __getitem__(self, key):
-        tx_out_dict = self.db.get(key)
-        if tx_out_dict:
-            return self.TxOut.from_dict(tx_out_dict)
-        raise KeyError(f"UTXO key {key} not in set")
+        value = self.store.get(COINS, key)
+        if value is None:
+            raise KeyError(f"UTXO key {key.hex()} not in set")
+        return Coin.parse(BytesIO(value))
 
     def __delitem__(self, key):
-        if key in self.db:
-            del self.db[key]
-        else:
-            pass
+        batch = WriteBatch()
+        self.write_coin(batch, key, None)
+        self.store.write(batch)
 
     def __contains__(self, key):
-        return key in self.db
+        return self.store.contains(COINS, key)
 
     def __len__(self):
-        return len(
-            [k for k in self.db.keys() if not k.startswith(self.meta_key_prefix)]
-        )
+        return self.get_stats()["coin_count"]
 
     def keys(self):
-        return (k for k in self.db.keys() if not k.startswith(self.meta_key_prefix))
+        return self.store.keys(COINS)
 
     def values(self):
-        for k in self.keys():
-            yield self[k]  # Use __getitem__ to deserialize
+        for k, coin in self.items():
+            yield coin
 
     def items(self):
-        for k in self.keys():
-            yield (k, self[k])
+        for k, value in self.store.items(COINS):
+            yield (k, Coin.parse(BytesIO(value)))
 
     def get(self, key, default=None):
         try:
@@ -201,26 +747,10 @@ class UTXODB(BaseDB):
             return default
 
     def get_balances(self, wallet_h160_list):
-        balances = {h160.hex(): 0 for h160 in wallet_h160_list}
-        wallet_h160_set = set(wallet_h160_list)
-        for tx_out_dict in self.db.values():
-            if not isinstance(tx_out_dict, dict) or "script_pubkey" not in tx_out_dict:
-                continue
-
-            try:
-                pubKeyHash_hex = tx_out_dict["script_pubkey"]["cmds"][2]
-                pubKeyHash_bytes = bytes.fromhex(pubKeyHash_hex)
-                if pubKeyHash_bytes in wallet_h160_set:
-                    balances[pubKeyHash_hex] += tx_out_dict["amount"]
-            except (
-                AttributeError,
-                IndexError,
-                KeyError,
-                TypeError,
-                ValueError,
-            ):
-                continue
-        return balances
+        return {
+            h160.hex(): sum(self.get_owned_coins(h160).values())
+            for h160 in wallet_h160_list
+        }
 
 
 class MempoolDB(BaseDB):
@@ -228,6 +758,8 @@ class MempoolDB(BaseDB):
         self.basepath = "data"
         self.db_file = os.path.join(self.basepath, "mempool.sqlite")
         self.db = SqliteDict(self.db_file, autocommit=True)
+        # Bumped on every change, lets readers tell the mempool changed
+        self.sequence = 0
 
     def __setitem__(self, tx_id_hex, tx_obj):
         store_data = {
@@ -236,6 +768,7 @@ class MempoolDB(BaseDB):
             "received_time": getattr(tx_obj, "receivedTime", time.time()),
         }
         self.db[tx_id_hex] = store_data
+        self.sequence += 1
 
     def __getitem__(self, tx_id_hex):
         stored = self.db.get(tx_id_hex)
@@ -249,6 +782,7 @@ class MempoolDB(BaseDB):
     def __delitem__(self, tx_id_hex):
         if tx_id_hex in self.db:
             del self.db[tx_id_hex]
+            self.sequence += 1
 
     def __contains__(self, tx_id_hex):
         return tx_id_hex in self.db
@@ -270,6 +804,7 @@ class MempoolDB(BaseDB):
     def clear(self):
         self.db.clear()
         self.db.commit()
+        self.sequence += 1
 
 
 class AccountDB:
@@ -300,29 +835,388 @@ class AccountDB:
 
 
 class TxIndexDB(BaseDB):
-    def __init__(self):
-        self.basepath = "data"
-        self.db_file = os.path.join(self.basepath, "tx_index.sqlite")
-        self.db = SqliteDict(self.db_file, autocommit=True)
+    """tx_id -> block_hash and where the tx and the coins it spent are stored
+
+    Values are the block hash followed by varints: position, offset and
+    length of the tx in the block record, then offset and length of its
+    spent coins in the block undo data. Entries written before positions
+    were stored only hold the block hash.
+    """
 
-    def __setitem__(self, tx_id_hex, block_hash_hex):
-        """Stores tx_id -> block_hash mapping"""
-        self.db[tx_id_hex] = block_hash_hex
+    def __init__(self, store=None):
+        self.store = store or open_store()
+        self.pending = {}
+
+    def write_batch(self, batch):
+        flushed = dict(self.pending)
+        for tx_id_hex, location in flushed.items():
+            if location is None:
+                batch.delete(TXINDEX, bytes.fromhex(tx_id_hex))
+            else:
+                batch.put(TXINDEX, bytes.fromhex(tx_id_hex), encode_location(location))
+
+        def on_commit():
+            for tx_id_hex, location in flushed.items():
+                if self.pending.get(tx_id_hex, location) == location:
+                    self.pending.pop(tx_id_hex, None)
+
+        batch.on_commit(on_commit)
+
+    def add(self, tx_id_hex, block_hash_hex, position, offset, length, undo=(0, 0)):
+        """Stores the block of a tx, where the tx is in it and where its undo data is"""
+        self.pending[tx_id_hex] = (block_hash_hex, position, offset, length) + undo
 
     def __getitem__(self, tx_id_hex):
         """Retrieves block_hash for a given tx_id"""
-        return self.db[tx_id_hex]
+        block_hash_hex = self.get(tx_id_hex)
+        if block_hash_hex is None:
+            raise KeyError(tx_id_hex)
+        return block_hash_hex
 
     def __delitem__(self, tx_id_hex):
-        if tx_id_hex in self.db:
-            del self.db[tx_id_hex]
+        self.pending[tx_id_hex] = None
 
     def __contains__(self, tx_id_hex):
-        return tx_id_hex in self.db
+        return self.get_location(tx_id_hex) is not None
 
     def get(self, tx_id_hex, default=None):
-        return self.db.get(tx_id_hex, default)
+        location = self.get_location(tx_id_hex)
+        return location[0] if location is not None else default
+
+    def get_location(self, tx_id_hex):
+        """(block_hash, position, offset, length, undo_offset, undo_length) of a tx
+
+        None if the tx is not indexed.
+        """
+        # One lookup, a flush on the chain thread may pop the entry meanwhile
+        location = self.pending.get(tx_id_hex, MISSING)
+        if location is not MISSING:
+            return location
+        value = self.store.get(TXINDEX, bytes.fromhex(tx_id_hex))
+        return decode_location(value) if value else None
 
     def clear(self):
-        self.db.clear()
-        self.db.commit()
+        self.pending.clear()
+        self.store.clear(TXINDEX)
+
+
+def encode_location(location):
+    value = bytes.fromhex(location[0])
+    if location[1] is not None:
+        value += b"".join(encode_varint(n) for n in location[1:])
+    return value
+
+
+def decode_location(value):
+    if len(value) == 32:
+        return value.hex(), None, None, None, None, None
+    s = BytesIO(value[32:])
+    return (value[:32].hex(),) + tuple(read_varint(s) for _ in range(5))
+
+
+def encode_block_record(block, block_hash):
+    miner = b""
+    if block.Txs and block.Txs[0].is_coinbase():
+        miner = p2pkh_h160(block.Txs[0].tx_outs[0].script_pubkey) or b""
+    return (
+        bytes.fromhex(block_hash)
+        + encode_varint(block.BlockHeader.timestamp)
+        + encode_varint(len(block.Txs))
+        + encode_varint(block.Blocksize)
+        + miner
+    )
+
+
+def decode_block_record(value):
+    """(block hash, timestamp, tx count, size, miner hash160 or None)"""
+    s = BytesIO(value[32:])
+    timestamp, tx_count, size = (read_varint(s) for _ in range(3))
+    return value[:32].hex(), timestamp, tx_count, size, s.read() or None
+
+
+class AddressIndexDB(BaseDB):
+    """hash160 -> outputs paying it, each with the tx that spent it
+
+    Keys are hash160 + height (4 bytes big endian) + outpoint, so the history
+    of an address is a single range scan in chain order. Values are the
+    varint amount, followed by the spending txid and varint height once spent.
+
+    The best block is only stored while the index covers the whole chain,
+    which starts with a full build (see ChainManager.reindex).
+    """
+
+    BEST_BLOCK_KEY = "addrindex_best_block"
+
+    def __init__(self, store=None):
+        self.store = store or open_store()
+        self.pending = {}
+        self.complete = self.get_best_block() is not None
+
+    @staticmethod
+    def entry_key(h160, height, tx_id_bytes, index):
+        return (
+            h160 + height.to_bytes(4, "big") + bytes(tx_id_bytes) + encode_varint(index)
+        )
+
+    def get_best_block(self):
+        value = self.store.get(META, self.BEST_BLOCK_KEY)
+        return json.loads(value) if value is not None else None
+
+    def write_batch(self, batch, best_block_hash):
+        flushed = dict(self.pending)
+        for key, value in flushed.items():
+            if value is None:
+                batch.delete(ADDRINDEX, key)
+            else:
+                batch.put(ADDRINDEX, key, value)
+        if self.complete:
+            batch.put(META, self.BEST_BLOCK_KEY, json.dumps(best_block_hash))
+
+        def on_commit():
+            for key, value in flushed.items():
+                if self.pending.get(key, value) == value:
+                    self.pending.pop(key, None)
+
+        batch.on_commit(on_commit)
+
+    def add_output(self, h160, height, tx_id_bytes, index, amount):
+        key = self.entry_key(h160, height, tx_id_bytes, index)
+        self.pending[key] = encode_varint(amount)
+
+    def spend_output(
+        self, h160, height, tx_id_bytes, index, amount, spent_by, spent_height
+    ):
+        key = self.entry_key(h160, height, tx_id_bytes, index)
+        self.pending[key] = (
+            encode_varint(amount) + bytes(spent_by) + encode_varint(spent_height)
+        )
+
+    def remove_output(self, h160, height, tx_id_bytes, index):
+        self.pending[self.entry_key(h160, height, tx_id_bytes, index)] = None
+
+    def get_entries(self, h160):
+        return list(self.iter_entries(h160))
+
+    def iter_entries(self, h160, reverse=False):
+        """Entries of h160 in key order (newest first if reverse), read lazily"""
+        # Unflushed changes win over the stored rows with the same key
+        pending_first = 1 if reverse else 0
+        pending = sorted(
+            (key, pending_first, value)
+            for key, value in list(self.pending.items())
+            if key.startswith(h160)
+        )
+        if reverse:
+            pending.reverse()
+        stored = (
+            (key, 1 - pending_first, value)
+            for key, value in self.store.iter_scan(ADDRINDEX, h160, reverse)
+        )
+
+        last_key = None
+        for key, _, value in heapq.merge(pending, stored, reverse=reverse):
+            if key == last_key:
+                continue
+            last_key = key
+            if value is None:
+                continue
+            key_stream = BytesIO(key[24:])
+            value_stream = BytesIO(value)
+            entry = {
+                "height": int.from_bytes(key[20:24], "big"),
+                "txid": key_stream.read(32).hex(),
+                "vout": read_varint(key_stream),
+                "amount": read_varint(value_stream),
+                "spent_by": None,
+                "spent_height": None,
+            }
+            spent_by = value_stream.read(32)
+            if spent_by:
+                entry["spent_by"] = spent_by.hex()
+                entry["spent_height"] = read_varint(value_stream)
+            yield entry
+
+    def clear(self):
+        self.complete = False
+        self.pending.clear()
+        self.store.clear(ADDRINDEX)
+        self.store.delete(META, self.BEST_BLOCK_KEY)
+
+
+class ChainStatsDB(BaseDB):
+    """Explorer totals of the active chain, updated as blocks are connected
+
+    ChainManager writes them in the same batch as the UTXO set, so they
+    also count blocks that were pruned since. ADDRESS_OUTPUTS holds the
+    number of outputs paying each hash160, an address is active while it
+    has one. BLOCK_STATS holds a record per active block keyed by height
+    (4 bytes big endian), so the explorer lists blocks without reading them.
+    The best block is only stored while the totals cover the whole chain,
+    see ChainManager.build_chain_stats.
+    """
+
+    TOTALS_KEY = "chainstats_totals"
+
+    def __init__(self, store=None):
+        self.store = store or open_store()
+        self.lock = RLock()
+        self.pending_outputs = {}
+        # height -> block record, None once disconnected
+        self.pending_records = {}
+        self.totals = self.load_totals()
+        self.complete = self.totals["best_block"] is not None
+
+    def load_totals(self):
+        value = self.store.get(META, self.TOTALS_KEY)
+        return json.loads(value) if value is not None else new_chain_totals()
+
+    def reload(self):
+        """Reads the totals another process flushed"""
+        with self.lock:
+            self.totals = self.load_totals()
+
+    def get_best_block(self):
+        return self.load_totals()["best_block"]
+
+    def get_totals(self):
+        with self.lock:
+            return dict(
+                self.totals, daily_transactions=dict(self.totals["daily_transactions"])
+            )
+
+    def get_output_count(self, h160):
+        count = self.pending_outputs.get(h160, MISSING)
+        if count is MISSING:
+            value = self.store.get(ADDRESS_OUTPUTS, h160)
+            count = read_varint(BytesIO(value)) if value else 0
+        return count
+
+    def get_record(self, height):
+        value = self.pending_records.get(height, MISSING)
+        if value is MISSING:
+            value = self.store.get(BLOCK_STATS, height.to_bytes(4, "big"))
+        return decode_block_record(value) if value else None
+
+    def iter_records(self):
+        """(height, record) of the active blocks, in height order"""
+        with self.lock:
+            pending = dict(self.pending_records)
+        for key, value in self.store.items(BLOCK_STATS):
+            height = int.from_bytes(key, "big")
+            value = pending.pop(height, value)
+            if value:
+                yield height, decode_block_record(value)
+        for height in sorted(pending):
+            if pending[height]:
+                yield height, decode_block_record(pending[height])
+
+    def connect_block(self, block, block_undo):
+        with self.lock:
+            self.pending_records[block.Height] = encode_block_record(
+                block, block.BlockHeader.generateBlockHash()
+            )
+            self.update(block, block_undo, 1)
+
+    def disconnect_block(self, block, block_undo):
+        with self.lock:
+            self.pending_records[block.Height] = None
+            self.update(block, block_undo, -1)
+
+    def update(self, block, block_undo, sign):
+        """Adds (sign 1) or removes (sign -1) a block from the totals"""
+        with self.lock:
+            totals = self.totals
+            totals["transactions"] += sign * len(block.Txs)
+            daily = totals["daily_transactions"]
+            day = (
+                datetime.fromtimestamp(block.BlockHeader.timestamp, timezone.utc)
+                .date()
+                .isoformat()
+            )
+            daily[day] = daily.get(day, 0) + sign * len(block.Txs)
+            if daily[day] <= 0:
+                del daily[day]
+
+            created = 0
+            for tx in block.Txs:
+                for tx_out in tx.tx_outs:
+                    created += tx_out.amount
+                    h160 = p2pkh_h160(tx_out.script_pubkey)
+                    if h160:
+                        self.add_outputs(h160, sign)
+
+            spent = 0
+            if block_undo:
+                spent = sum(
+                    coin.amount
+                    for tx_undo in block_undo.tx_undos
+                    for coin in tx_undo
+                    if coin
+                )
+            coinbase_out = sum(tx_out.amount for tx_out in block.Txs[0].tx_outs)
+            totals["fees"] += sign * (spent - (created - coinbase_out))
+
+    def add_outputs(self, h160, count):
+        previous = self.get_output_count(h160)
+        current = max(previous + count, 0)
+        if previous == 0 and current > 0:
+            self.totals["active_addresses"] += 1
+        elif previous > 0 and current == 0:
+            self.totals["active_addresses"] -= 1
+        self.pending_outputs[h160] = current
+
+    def write_batch(self, batch, best_block_hash):
+        with self.lock:
+            flushed = dict(self.pending_outputs)
+            flushed_records = dict(self.pending_records)
+            totals = dict(
+                self.totals, best_block=best_block_hash if self.complete else None
+            )
+        for h160, count in flushed.items():
+            if count:
+                batch.put(ADDRESS_OUTPUTS, h160, encode_varint(count))
+            else:
+                batch.delete(ADDRESS_OUTPUTS, h160)
+        for height, value in flushed_records.items():
+            if value:
+                batch.put(BLOCK_STATS, height.to_bytes(4, "big"), value)
+            else:
+                batch.delete(BLOCK_STATS, height.to_bytes(4, "big"))
+        batch.put(META, self.TOTALS_KEY, json.dumps(totals))
+
+        def on_commit():
+            with self.lock:
+                for h160, count in flushed.items():
+                    if self.pending_outputs.get(h160, count) == count:
+                        self.pending_outputs.pop(h160, None)
+                for height, value in flushed_records.items():
+                    if self.pending_records.get(height, value) == value:
+                        self.pending_records.pop(height, None)
+
+        batch.on_commit(on_commit)
+
+    def add_stats(self, other):
+        """Adds the flushed totals of other, kept for blocks this one never had"""
+        with self.lock:
+            other_totals = other.load_totals()
+            self.totals["transactions"] += other_totals["transactions"]
+            self.totals["fees"] += other_totals["fees"]
+            daily = self.totals["daily_transactions"]
+            for day, count in other_totals["daily_transactions"].items():
+                daily[day] = daily.get(day, 0) + count
+            for h160, value in other.store.items(ADDRESS_OUTPUTS):
+                self.add_outputs(h160, read_varint(BytesIO(value)))
+            for key, value in other.store.items(BLOCK_STATS):
+                height = int.from_bytes(key, "big")
+                if self.get_record(height) is None:
+                    self.pending_records[height] = value
+
+    def clear(self):
+        with self.lock:
+            self.complete = False
+            self.pending_outputs.clear()
+            self.pending_records.clear()
+            self.totals = new_chain_totals()
+            self.store.clear(ADDRESS_OUTPUTS)
+            self.store.clear(BLOCK_STATS)
+            self.store.delete(META, self.TOTALS_KEY)
@@ -0,0 +1,192 @@
+import logging
+import os
+import sqlite3
+from threading import Lock, RLock
+
+logger = logging.getLogger(__name__)
+
+CHAINSTATE_FILE = os.path.join("data", "chainstate.sqlite")
+
+BLOCK_INDEX = "block_index"
+COINS = "coins"
+TXINDEX = "txindex"
+META = "meta"
+ADDRINDEX = "addrindex"
+COIN_OWNERS = "coin_owners"
+ADDRESS_OUTPUTS = "address_outputs"
+BLOCK_STATS = "block_stats"
+CHAINSTATE_TABLES = (
+    BLOCK_INDEX,
+    COINS,
+    TXINDEX,
+    META,
+    ADDRINDEX,
+    COIN_OWNERS,
+    ADDRESS_OUTPUTS,
+    BLOCK_STATS,
+)
+
+_stores = {}
+_stores_lock = Lock()
+
+
+def open_store(path=CHAINSTATE_FILE):
+    """Returns the store for path, shared by every database class using it"""
+    with _stores_lock:
+        store = _stores.get(path)
+        if store is None:
+            store = KVStore(path)
+            _stores[path] = store
+        return store
+
+
+def prefix_upper_bound(prefix):
+    # Smallest key greater than every key starting with prefix
+    prefix = prefix.rstrip(b"\xff")
+    if not prefix:
+        return None
+    return prefix[:-1] + bytes([prefix[-1] + 1])
+
+
+class WriteBatch:
+    """Puts and deletes applied to a KVStore in a single transaction"""
+
+    def __init__(self):
+        self.ops = []
+        self.callbacks = []
+
+    def put(self, table, key, value):
+        self.ops.append((table, key, value))
+
+    def delete(self, table, key):
+        self.ops.append((table, key, None))
+
+    def on_commit(self, callback):
+        self.callbacks.append(callback)
+
+    def __len__(self):
+        return len(self.ops)
+
+
+class KVStore:
+    """Key-value tables of the chain state, kept in one SQLite database"""
+
+    def __init__(self, path, tables=CHAINSTATE_TABLES, readonly=False):
+        self.path = path
+        self.lock = RLock()
+        # Read-only stores follow a database another process writes
+        self.uri = f"file:{path}?mode=ro" if readonly else path
+        if readonly:
+            self.conn = sqlite3.connect(
+                self.uri, uri=True, check_same_thread=False, isolation_level=None
+            )
+            return
+
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        for table in tables:
+            self.conn.execute(
+                f'CREATE TABLE IF NOT EXISTS "{table}" '
+                "(key PRIMARY KEY, value BLOB) WITHOUT ROWID"
+            )
+
+    def get(self, table, key, default=None):
+        with self.lock:
+            row = self.conn.execute(
+                f'SELECT value FROM "{table}" WHERE key = ?', (key,)
+            ).fetchone()
+        return row[0] if row else default
+
+    def contains(self, table, key):
+        with self.lock:
+            row = self.conn.execute(
+                f'SELECT 1 FROM "{table}" WHERE key = ?', (key,)
+            ).fetchone()
+        return row is not None
+
+    def count(self, table):
+        with self.lock:
+            return self.conn.execute(f'SELECT COUNT(*) FROM "{table}"').fetchone()[0]
+
+    def put(self, table, key, value):
+        batch = WriteBatch()
+        batch.put(table, key, value)
+        self.write(batch)
+
+    def delete(self, table, key):
+        batch = WriteBatch()
+        batch.delete(table, key)
+        self.write(batch)
+
+    def clear(self, table):
+        with self.lock:
+            self.conn.execute(f'DELETE FROM "{table}"')
+
+    def items(self, table):
+        # A separate connection reads a committed snapshot without holding the lock
+        conn = sqlite3.connect(self.uri, uri=self.uri != self.path)
+        try:
+            for key, value in conn.execute(
+                f'SELECT key, value FROM "{table}" ORDER BY key'
+            ):
+                yield key, value
+        finally:
+            conn.close()
+
+    @staticmethod
+    def prefix_query(table, prefix, reverse=False):
+        query = f'SELECT key, value FROM "{table}" WHERE key >= ?'
+        params = [prefix]
+        prefix_end = prefix_upper_bound(prefix)
+        if prefix_end is not None:
+            query += " AND key < ?"
+            params.append(prefix_end)
+        return query + (" ORDER BY key DESC" if reverse else " ORDER BY key"), params
+
+    def scan(self, table, prefix):
+        """Key-ordered rows whose key starts with the bytes prefix"""
+        query, params = self.prefix_query(table, prefix)
+        with self.lock:
+            return self.conn.execute(query, params).fetchall()
+
+    def iter_scan(self, table, prefix, reverse=False):
+        """Like scan, but yields the rows from a committed snapshot one at a time"""
+        query, params = self.prefix_query(table, prefix, reverse)
+        conn = sqlite3.connect(self.uri, uri=self.uri != self.path)
+        try:
+            for key, value in conn.execute(query, params):
+                yield key, value
+        finally:
+            conn.close()
+
+    def keys(self, table):
+        for key, _ in self.items(table):
+            yield key
+
+    def write(self, batch):
+        with self.lock:
+            try:
+                self.conn.execute("BEGIN")
+                for table, key, value in batch.ops:
+                    if value is None:
+                        self.conn.execute(
+                            f'DELETE FROM "{table}" WHERE key = ?', (key,)
+                        )
+                    else:
+                        self.conn.execute(
+                            f'INSERT OR REPLACE INTO "{table}" VALUES (?, ?)',
+                            (key, value),
+                        )
+                self.conn.execute("COMMIT")
+            except Exception:
+                self.conn.execute("ROLLBACK")
+                raise
+            for callback in batch.callbacks:
+                callback()
+        logger.debug(f"Wrote batch of {len(batch)} operations to {self.path}")
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
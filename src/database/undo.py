@@ -0,0 +1,35 @@
+from src.core.coin import Coin
+from src.utils.serialization import encode_varint, read_varint
+
+
+class BlockUndo:
+    """Coins spent by a block, one list per non-coinbase tx in input order"""
+
+    def __init__(self, tx_undos=None):
+        self.tx_undos = tx_undos if tx_undos is not None else []
+
+    def serialize(self):
+        result = encode_varint(len(self.tx_undos))
+        for spent_coins in self.tx_undos:
+            result += encode_varint(len(spent_coins))
+            for coin in spent_coins:
+                result += coin.serialize()
+        return result
+
+    def tx_undo_locations(self):
+        """(offset, length) of the spent coins of each tx in the serialized data"""
+        offset = len(encode_varint(len(self.tx_undos)))
+        locations = []
+        for spent_coins in self.tx_undos:
+            length = len(encode_varint(len(spent_coins)))
+            length += sum(len(coin.serialize()) for coin in spent_coins)
+            locations.append((offset, length))
+            offset += length
+        return locations
+
+    @classmethod
+    def parse(cls, s):
+        tx_undos = []
+        for _ in range(read_varint(s)):
+            tx_undos.append([Coin.parse(s) for _ in range(read_varint(s))])
+        return cls(tx_undos)
@@ -0,0 +1,233 @@
+import logging
+from threading import RLock
+
+from src.chain.params import (UTXO_CACHE_ENTRY_SIZE, UTXO_CACHE_FLUSH_INTERVAL,
+                              UTXO_CACHE_MAX_MEMORY)
+from src.core.coin import p2pkh_h160
+
+logger = logging.getLogger(__name__)
+
+DIRTY = 1  # differs from the UTXODB copy
+FRESH = 2  # not in UTXODB, can be dropped instead of deleted once spent
+
+
+class CacheEntry:
+    # base_coin is the coin as stored in UTXODB, to unindex its owner once spent
+    __slots__ = ("tx_out", "flags", "base_coin")
+
+    def __init__(self, tx_out, flags=0, base_coin=None):
+        self.tx_out = tx_out
+        self.flags = flags
+        self.base_coin = base_coin
+
+
+class UTXOCache:
+    """Write-back cache in front of UTXODB
+
+    Coins created and spent between two flushes never reach the database.
+    Dirty coins and meta values (like last_block_hash) are written together
+    in the chain state batch, so the database always describes one block.
+    """
+
+    def __init__(
+        self,
+        base,
+        max_memory=UTXO_CACHE_MAX_MEMORY,
+        flush_interval=UTXO_CACHE_FLUSH_INTERVAL,
+    ):
+        self.base = base
+        self.max_memory = max_memory
+        self.flush_interval = flush_interval
+        self.entries = {}
+        self.owners = {}  # hash160 -> keys of the cached coins paying it
+        self.pending_meta = {}
+        self.stats = base.get_stats()
+        self.blocks_since_flush = 0
+        self.lock = RLock()
+
+    def memory_usage(self):
+        return len(self.entries) * UTXO_CACHE_ENTRY_SIZE
+
+    def fetch(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            tx_out = self.base.get(key)
+            if tx_out is None:
+                return None
+            entry = CacheEntry(tx_out, base_coin=tx_out)
+            self.entries[key] = entry
+            self.track_owner(key, tx_out)
+        return entry
+
+    def track_owner(self, key, coin):
+        h160 = p2pkh_h160(coin.script_pubkey)
+        if h160:
+            self.owners.setdefault(h160, set()).add(key)
+
+    def untrack_owner(self, key, coin):
+        h160 = p2pkh_h160(coin.script_pubkey)
+        keys = self.owners.get(h160)
+        if keys:
+            keys.discard(key)
+            if not keys:
+                del self.owners[h160]
+
+    def get_meta(self, key):
+        with self.lock:
+            if key in self.pending_meta:
+                return self.pending_meta[key]
+            return self.base.get_meta(key)
+
+    def set_meta(self, key, value):
+        with self.lock:
+            self.pending_meta[key] = value
+
+    def update_stats(self, key, coin, sign):
+        self.stats["coin_count"] += sign
+        self.stats["total_amount"] += sign * coin.amount
+        self.stats["serialized_size"] += sign * (len(key) + len(coin.serialize()))
+
+    def get_stats(self):
+        with self.lock:
+            return dict(self.stats)
+
+    def commit(self):
+        """Marks the end of a connected block"""
+        with self.lock:
+            self.blocks_since_flush += 1
+
+    def needs_flush(self):
+        return (
+            self.blocks_since_flush >= self.flush_interval
+            or self.memory_usage() >= self.max_memory
+        )
+
+    def write_batch(self, batch):
+        """Adds the dirty coins, meta values and statistics to a chain state batch"""
+        with self.lock:
+            dirty_count = 0
+            for key, entry in self.entries.items():
+                if entry.flags & DIRTY:
+                    dirty_count += 1
+                    self.base.write_coin(batch, key, entry.tx_out, entry.base_coin)
+
+            for key, value in self.pending_meta.items():
+                self.base.write_meta(batch, key, value)
+            self.base.write_meta(batch, "stats", self.stats)
+            logger.debug(
+                f"Flushing UTXO cache: {dirty_count} dirty of {len(self.entries)} entries"
+            )
+            batch.on_commit(self.reset)
+
+    def reset(self):
+        # Written entries stay cached as clean copies unless the cache is full
+        with self.lock:
+            if self.memory_usage() >= self.max_memory:
+                self.entries.clear()
+                self.owners.clear()
+            else:
+                for key in [k for k, e in self.entries.items() if e.tx_out is None]:
+                    del self.entries[key]
+                for entry in self.entries.values():
+                    entry.flags = 0
+                    entry.base_coin = entry.tx_out
+            self.pending_meta.clear()
+            self.blocks_since_flush = 0
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.owners.clear()
+            self.pending_meta.clear()
+            self.base.clear()
+            self.stats = self.base.get_stats()
+
+    def __setitem__(self, key, tx_out_obj):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.entries[key] = CacheEntry(tx_out_obj, DIRTY | FRESH)
+            else:
+                if entry.tx_out is not None:
+                    self.update_stats(key, entry.tx_out, -1)
+                    self.untrack_owner(key, entry.tx_out)
+                entry.tx_out = tx_out_obj
+                entry.flags |= DIRTY
+            self.update_stats(key, tx_out_obj, 1)
+            self.track_owner(key, tx_out_obj)
+
+    def __getitem__(self, key):
+        tx_out = self.get(key)
+        if tx_out is None:
+            raise KeyError(f"UTXO key {key} not in set")
+        return tx_out
+
+    def __delitem__(self, key):
+        with self.lock:
+            entry = self.fetch(key)
+            if entry is None or entry.tx_out is None:
+                return
+            self.update_stats(key, entry.tx_out, -1)
+            self.untrack_owner(key, entry.tx_out)
+            if entry.flags & FRESH:
+                del self.entries[key]
+            else:
+                entry.tx_out = None
+                entry.flags |= DIRTY
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def __len__(self):
+        return self.get_stats()["coin_count"]
+
+    def get(self, key, default=None):
+        with self.lock:
+            entry = self.fetch(key)
+            if entry is None or entry.tx_out is None:
+                return default
+            return entry.tx_out
+
+    def keys(self):
+        with self.lock:
+            cached_keys = [k for k, e in self.entries.items() if e.tx_out is not None]
+            stored_keys = [k for k in self.base.keys() if k not in self.entries]
+        return iter(cached_keys + stored_keys)
+
+    def peek(self, key):
+        # Bulk readers go through here so they don't pull the whole set in the cache
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                return entry.tx_out
+            return self.base.get(key)
+
+    def values(self):
+        for k in self.keys():
+            tx_out = self.peek(k)
+            if tx_out is not None:
+                yield tx_out
+
+    def items(self):
+        for k in self.keys():
+            tx_out = self.peek(k)
+            if tx_out is not None:
+                yield (k, tx_out)
+
+    def get_owned_coins(self, h160):
+        """outpoint key -> amount of the unspent coins paying h160"""
+        with self.lock:
+            coins = {
+                key: amount
+                for key, amount in self.base.get_owned_coins(h160).items()
+                if key not in self.entries
+            }
+            for key in self.owners.get(h160, ()):
+                coins[key] = self.entries[key].tx_out.amount
+        return coins
+
+    def get_balances(self, wallet_h160_list):
+        return {
+            h160.hex(): sum(self.get_owned_coins(h160).values())
+            for h160 in wallet_h160_list
+        }
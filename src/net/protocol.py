@@ -35,13 +35,15 @@ class NetworkEnvelope:
 
         return cls(command, payload)
 
-    def serialize(self):
+    def serialize_header(self):
         result = self.magic
         result += self.command + b"\x00" * (12 - len(self.command))
         result += int_to_little_endian(len(self.payload), 4)
         result += hash256(self.payload)[:4]
-        result += self.payload
         return result
 
+    def serialize(self):
+        return self.serialize_header() + self.payload
+
     def stream(self):
         return BytesIO(self.payload)
@@ -1,12 +1,13 @@
 import logging
 import socket
 import time
+import weakref
 from threading import Lock, RLock, Thread
 
 from src.chain.mempool import Mempool
-from src.chain.params import MAX_HEADERS_TO_SEND, MAX_PEERS, PING_INTERVAL
+from src.chain.params import (MAX_BLOCKS_TO_REQUEST, MAX_HEADERS_TO_SEND,
+                              MAX_PEERS, PING_INTERVAL)
 from src.chain.validator import Validator, check_pow
-from src.database.db_manager import BlockchainDB
 from src.database.utxo_manager import UTXOManager
 from src.net.connection import Node
 from src.net.messages import (INV_TYPE_BLOCK, INV_TYPE_TX, Addr, Block,
@@ -36,7 +37,7 @@ class SyncManager:
         self.chain_manager = chain_manager
 
         self.validator = Validator(self.utxos, self.mempool)
-        self.db = BlockchainDB()
+        self.db = chain_manager.db
 
         self.utxo_manager = UTXOManager(self.utxos)
         self.mempool_manager = Mempool(self.mempool, self.utxos)
@@ -48,13 +49,29 @@ class SyncManager:
         self.peers_lock = RLock()
 
         self.last_ping_sent = {}
+        # Handler, ping and broadcast threads write to the same sockets
+        self.send_locks = weakref.WeakKeyDictionary()
+        self.send_locks_lock = Lock()
         self.sync_lock = Lock()
         self.is_syncing = False
+        self.last_missing_block = None
+
+    def get_send_lock(self, sock):
+        with self.send_locks_lock:
+            return self.send_locks.setdefault(sock, Lock())
 
     def send_message(self, sock, message):
         envelope = NetworkEnvelope(message.command, message.serialize())
-        sock.sendall(envelope.serialize())
-        pass
+        with self.get_send_lock(sock):
+            sock.sendall(envelope.serialize())
+
+    def send_raw_message(self, sock, command, payload):
+        envelope = NetworkEnvelope(command, payload)
+        # Header and payload are sent separately so a mapped payload is never
+        # copied, the lock keeps other messages from landing between them
+        with self.get_send_lock(sock):
+            sock.sendall(envelope.serialize_header())
+            sock.sendall(envelope.payload)
 
     def connect_to_peer(self, host, port):
         peer_id = f"{host}:{port}"
@@ -71,8 +88,8 @@ class SyncManager:
             peer_node = Node(host, port)
             client_socket = peer_node.connect(self.port)
 
-            last_block = self.db.lastBlock()
-            start_height = last_block["Height"] if last_block else 0
+            tip_index = self.db.get_main_chain_tip()
+            start_height = tip_index.height if tip_index else 0
             version_msg = Version(start_height=start_height)
             self.send_message(client_socket, version_msg)
 
@@ -147,8 +164,8 @@ class SyncManager:
                             f"Peer {peer_id_str} version: {peer_version.version}, height: {peer_version.start_height}"
                         )
 
-                        last_block = self.db.lastBlock()
-                        our_height = last_block["Height"] if last_block else 0
+                        tip_index = self.db.get_main_chain_tip()
+                        our_height = tip_index.height if tip_index else 0
                         if self.peer_handshake_status.get(peer_id_str) is None:
                             version_msg = Version(start_height=our_height)
                             self.send_message(conn, version_msg)
@@ -250,65 +267,70 @@ class SyncManager:
             self.is_syncing = True
 
         logger.debug("Starting blockchain synchronization...")
-        last_block = self.db.lastBlock()
+        tip_index = self.db.get_main_chain_tip()
 
-        if not last_block:
+        if not tip_index:
             from src.core.genesis import GENESIS_BLOCK_HASH
 
             start_block_hash = bytes.fromhex(GENESIS_BLOCK_HASH)
         else:
-            start_block_hash = bytes.fromhex(last_block["BlockHeader"]["blockHash"])
+            start_block_hash = bytes.fromhex(tip_index.hash)
 
         getheaders_msg = GetHeaders(start_block=start_block_hash)
         self.send_message(conn, getheaders_msg)
+        self.request_missing_blocks(conn)
 
-    def handle_getheaders(self, conn, getheaders_msg):
-        logger.debug(
-            f"Received getheaders request starting from {getheaders_msg.start_block.hex()}"
+    def request_missing_blocks(self, conn, start_height=0):
+        """Asks for the blocks of the active chain we only have headers of
+
+        These are the blocks below a loaded UTXO snapshot. They are requested
+        by windows, the next one when the last block of a window arrives.
+        """
+        missing = self.db.get_missing_blocks(start_height, MAX_BLOCKS_TO_REQUEST)
+        if not missing:
+            self.last_missing_block = None
+            return
+
+        logger.info(
+            f"Requesting {len(missing)} historical blocks from height {missing[0].height}"
         )
-        all_blocks = self.db.read()
-        headers_to_send = []
-        found_start = False
-
-        if not all_blocks and getheaders_msg.start_block.hex() == "00" * 32:
-            found_start = True
-
-        if getheaders_msg.start_block.hex() == "00" * 32:
-            found_start = True
-
-        for block_data in all_blocks:
-            if (
-                not found_start
-                and block_data["BlockHeader"]["blockHash"]
-                == getheaders_msg.start_block.hex()
-            ):
-                found_start = True
-                continue
-
-            if found_start:
-                header = Block.to_obj(block_data).BlockHeader
-                headers_to_send.append(header)
-                if len(headers_to_send) >= MAX_HEADERS_TO_SEND:
-                    break
-
-        if found_start:
-            if headers_to_send:
-                logger.info(f"Sending {len(headers_to_send)} headers to peer")
-            else:
-                logger.info("Peer is up-to-date")
+        self.last_missing_block = missing[-1]
+        items_to_get = [
+            (INV_TYPE_BLOCK, bytes.fromhex(index_entry.hash)) for index_entry in missing
+        ]
+        self.send_message(conn, GetData(items_to_get))
 
-            headers_msg = Headers(headers_to_send)
-            self.send_message(conn, headers_msg)
+    def handle_getheaders(self, conn, getheaders_msg):
+        start_hash = getheaders_msg.start_block.hex()
+        logger.debug(f"Received getheaders request starting from {start_hash}")
 
-        elif getheaders_msg.start_block.hex() == "00" * 32 and not all_blocks:
-            logger.info("Peer asked from genesis, we have no blocks")
-            headers_msg = Headers([])
-            self.send_message(conn, headers_msg)
+        if start_hash == "00" * 32:
+            start_height = -1
+        else:
+            start_index = self.db.get_index(start_hash)
+            if not start_index or not self.db.is_in_active_chain(start_index):
+                logger.warning(
+                    f"GetHeaders start_block {start_hash} not found in main chain"
+                )
+                return
+            start_height = start_index.height
 
+        headers_to_send = [
+            index_entry.get_header()
+            for index_entry in self.db.active_chain[
+                start_height + 1 : start_height + 1 + MAX_HEADERS_TO_SEND
+            ]
+        ]
+
+        if headers_to_send:
+            logger.info(f"Sending {len(headers_to_send)} headers to peer")
+        elif start_height == -1:
+            logger.info("Peer asked from genesis, we have no blocks")
         else:
-            logger.warning(
-                f"GetHeaders start_block {getheaders_msg.start_block.hex()} not found in main chain"
-            )
+            logger.info("Peer is up-to-date")
+
+        headers_msg = Headers(headers_to_send)
+        self.send_message(conn, headers_msg)
 
     def handle_headers(self, conn, headers_msg):
         if not headers_msg.headers:
@@ -319,8 +341,8 @@ class SyncManager:
 
         logger.debug(f"Received {len(headers_msg.headers)} headers from peer")
 
-        last_known_block = self.db.lastBlock()
-        if not last_known_block:
+        last_known_index = self.db.get_main_chain_tip()
+        if not last_known_index:
             prev_block_hash = "00" * 32
             from src.core.genesis import GENESIS_BLOCK_HASH
 
@@ -330,7 +352,7 @@ class SyncManager:
             else:
                 prev_block_hash = last_known_block_hash_from_db
         else:
-            prev_block_hash = last_known_block["BlockHeader"]["blockHash"]
+            prev_block_hash = last_known_index.hash
 
         headers_to_request = []
         last_valid_header = None
@@ -397,7 +419,7 @@ class SyncManager:
                 if item_hash.hex() not in self.mempool:
                     items_to_get.append((INV_TYPE_TX, item_hash))
             elif item_type == INV_TYPE_BLOCK:
-                if not self.db.get_block(item_hash.hex()):
+                if not self.db.has_block(item_hash.hex()):
                     items_to_get.append((INV_TYPE_BLOCK, item_hash))
 
         if items_to_get:
@@ -415,18 +437,12 @@ class SyncManager:
                     )
                     self.send_message(conn, tx_msg)
             elif item_type == INV_TYPE_BLOCK:
-                block_hash_hex = item_hash.hex()
-                block_data = self.db.get_block(block_hash_hex)
-                if block_data:
-                    block_obj = Block.to_obj(block_data)
-                    block_msg = Block(
-                        block_obj.Height,
-                        block_obj.Blocksize,
-                        block_obj.BlockHeader,
-                        block_obj.Txcount,
-                        block_obj.Txs,
-                    )
-                    self.send_message(conn, block_msg)
+                block_hash = item_hash.hex()
+                block_view = self.db.get_block_view(block_hash)
+                if block_view is not None:
+                    self.send_raw_message(conn, Block.command, block_view)
+                elif self.db.is_pruned(block_hash):
+                    logger.debug(f"Not sending block {block_hash}: pruned")
 
     def handle_tx(self, tx_obj, origin_peer_socket=None):
         tx_id = tx_obj.id()
@@ -452,6 +468,11 @@ class SyncManager:
 
         if self.incoming_blocks_queue is not None:
             self.incoming_blocks_queue.put(block_obj)
+            last_missing_block = self.last_missing_block
+            if last_missing_block and block_hash == last_missing_block.hash:
+                self.request_missing_blocks(
+                    origin_peer_socket, last_missing_block.height + 1
+                )
         else:
             logger.warning(
                 "Incoming_blocks_queue not initialized in SyncManager. Block discarded"
@@ -1,3 +1,4 @@
+import argparse
 import logging
 import os
 import sys
@@ -7,11 +8,21 @@ from threading import Event, Thread
 
 sys.path.append(os.getcwd())
 
+from src.api.read_model import ExplorerReadModel
+from src.api.server import ChainEventPublisher
 from src.api.server import main as web_main
+from src.api.server import start_workers as start_api_workers
 from src.chain.chain_manager import ChainManager
+from src.chain.params import (MIN_PRUNE_TARGET, UTXO_CACHE_FLUSH_INTERVAL,
+                              UTXO_CACHE_MAX_MEMORY)
+from src.chain.snapshot import (SnapshotError, SnapshotValidator,
+                                clear_snapshot_info, get_snapshot_info,
+                                load_snapshot)
 from src.core.genesis import create_genesis_block
-from src.database.db_manager import UTXODB, BlockchainDB, MempoolDB, TxIndexDB
-from src.database.utxo_manager import UTXOManager
+from src.database.db_manager import (UTXODB, AddressIndexDB, BlockchainDB,
+                                     ChainStatsDB, MempoolDB, TxIndexDB)
+from src.database.kvstore import open_store
+from src.database.utxo_cache import UTXOCache
 from src.net.sync_manager import SyncManager
 from src.node.rpc_server import rpcServer
 from src.utils.config_loader import load_config
@@ -38,6 +49,10 @@ def handle_incoming_blocks(incoming_blocks_queue, chain_manager, broadcast_queue
             else:
                 logger.warning(f"Block {block_obj.Height} rejected by ChainManager")
 
+            # Batch writes while blocks are queued (IBD), flush once caught up
+            if incoming_blocks_queue.empty():
+                chain_manager.flush_state(force=True)
+
         except Exception as e:
             logger.error(f"Error in block processing worker: {e}")
 
@@ -87,13 +102,42 @@ def reload_mempool(mempool_db, chain_manager):
     logger.info(f"Mempool reloaded. Kept {len(mempool_db)} valid transactions")
 
 
+def parse_args():
+    parser = argparse.ArgumentParser(description="Kernel node daemon")
+    parser.add_argument(
+        "-reindex",
+        "--reindex",
+        action="store_true",
+        help="Rebuild the UTXO set and txindex from the stored blocks",
+    )
+    parser.add_argument(
+        "--reindex-workers",
+        type=int,
+        default=os.cpu_count() or 1,
+        help="Processes decoding blocks during a reindex",
+    )
+    parser.add_argument(
+        "--load-snapshot",
+        metavar="PATH",
+        help="Start from a UTXO snapshot made by dumptxoutset (empty node only)",
+    )
+    parser.add_argument(
+        "--snapshot-hash",
+        help="Expected commitment of the snapshot, as printed by dumptxoutset",
+    )
+    return parser.parse_args()
+
+
 def main():
+    args = parse_args()
     setup_logging()
     config = load_config()
 
     host = config["NETWORK"]["host"]
     p2p_port = int(config["P2P"]["port"])
     api_port = int(config["API"]["port"])
+    # 0 serves the API from a thread of the node, otherwise from worker processes
+    api_workers = config.getint("API", "workers", fallback=0)
     rpc_port = api_port + 1
 
     mining_process_manager = {"shutdown_requested": False}
@@ -103,33 +147,58 @@ def main():
     new_block_event = Event()
 
     logger.debug("Initializing databases...")
-    db = BlockchainDB()
-    utxos_db = UTXODB()
+    store = open_store()
+    # 0 keeps every block, otherwise old block files go beyond this size
+    prune_mb = config.getint("PRUNE", "target_mb", fallback=0)
+    prune_target = prune_mb * 1024 * 1024
+    if prune_target and prune_target < MIN_PRUNE_TARGET:
+        logger.warning(
+            f"Prune target raised to the minimum of {MIN_PRUNE_TARGET // (1024 * 1024)}Mb"
+        )
+        prune_target = MIN_PRUNE_TARGET
+    db = BlockchainDB(store, prune_target=prune_target)
+    cache_mb = config.getint(
+        "UTXO", "cache_mb", fallback=UTXO_CACHE_MAX_MEMORY // (1024 * 1024)
+    )
+    flush_interval = config.getint(
+        "UTXO", "flush_interval", fallback=UTXO_CACHE_FLUSH_INTERVAL
+    )
+    utxos_db = UTXOCache(
+        UTXODB(store),
+        max_memory=cache_mb * 1024 * 1024,
+        flush_interval=flush_interval,
+    )
     mempool_db = MempoolDB()
-    txindex_db = TxIndexDB()
+    txindex_db = TxIndexDB(store)
+    addrindex_db = None
+    if config.getboolean("INDEX", "addrindex", fallback=True):
+        if prune_target:
+            logger.warning("Address index needs every block, disabled on pruned nodes")
+        else:
+            addrindex_db = AddressIndexDB(store)
 
-    chain_manager = ChainManager(db, utxos_db, mempool_db, txindex_db, new_block_event)
-    utxo_manager = UTXOManager(utxos_db)
+    chainstats_db = ChainStatsDB(store)
+
+    chain_manager = ChainManager(
+        db,
+        utxos_db,
+        mempool_db,
+        txindex_db,
+        new_block_event,
+        addrindex_db,
+        chainstats_db,
+    )
 
     if not db.get_main_chain_tip_hash():
         logger.debug("No main chain tip found. Checking for Genesis block...")
         genesis = create_genesis_block()
         genesis_hash = genesis.BlockHeader.generateBlockHash()
 
-        if not db.get_block(genesis_hash):
+        if not db.has_block(genesis_hash):
             logger.debug(
                 "No Genesis block found. Creating and writing Genesis block..."
             )
-            genesis.BlockHeader.to_hex()
-            tx_json_list = [tx.to_dict() for tx in genesis.Txs]
-            block_to_save = {
-                "Height": genesis.Height,
-                "Blocksize": genesis.Blocksize,
-                "BlockHeader": genesis.BlockHeader.__dict__,
-                "TxCount": len(tx_json_list),
-                "Txs": tx_json_list,
-            }
-            db.write_block(block_to_save)
+            db.write_block(genesis)
         else:
             logger.debug("Genesis block found in DB")
 
@@ -137,37 +206,82 @@ def main():
         chain_manager.connect_block(genesis)
         db.set_main_chain_tip(genesis_hash)
         utxos_db.set_meta("last_block_hash", genesis_hash)
-        utxos_db.commit()
+        chain_manager.flush_state(force=True)
         logger.debug("Genesis block processed")
 
-    last_hash_chain = db.get_main_chain_tip_hash()
-    last_hash_utxo_db = utxos_db.get_meta("last_block_hash")
-
-    if last_hash_chain == last_hash_utxo_db:
-        logger.debug(f"UTXO set is in sync with main chain tip: {last_hash_chain}")
+    if args.load_snapshot:
+        try:
+            load_snapshot(chain_manager, args.load_snapshot, args.snapshot_hash)
+        except (SnapshotError, OSError) as e:
+            logger.error(f"Could not load snapshot: {e}")
+            return
+
+    # Checked before any flush, a flush carries the best block forward
+    utxo_best_block = utxos_db.get_meta("last_block_hash")
+    if addrindex_db and addrindex_db.get_best_block() != utxo_best_block:
+        addrindex_db.complete = False
+    if chainstats_db.get_best_block() != utxo_best_block:
+        chainstats_db.complete = False
+
+    snapshot_info = get_snapshot_info(db)
+    invalid_snapshot = snapshot_info is not None and snapshot_info.get("invalid")
+    if invalid_snapshot and not args.reindex:
+        logger.error(
+            "The chain state comes from a snapshot that failed validation. Restart with -reindex once all blocks are stored"
+        )
+        return
+
+    if args.reindex:
+        reindexed = chain_manager.reindex(args.reindex_workers)
+        if invalid_snapshot:
+            if not reindexed:
+                logger.error(
+                    "Could not rebuild the chain state of the invalid snapshot"
+                )
+                return
+            clear_snapshot_info(db)
+    elif chain_manager.recover_chain_state():
+        logger.debug(
+            f"UTXO set is in sync with main chain tip: {db.get_main_chain_tip_hash()}"
+        )
         logger.debug(f"Loaded {len(utxos_db)} UTXOs")
     else:
+        # Only happens for data written before the chain state store existed
         logger.info(f"UTXO set is out of sync. Rebuilding... This may take a while...")
-        logger.debug("Clearing TxIndex for rebuild...")
-        txindex_db.clear()
+        chain_manager.reindex(args.reindex_workers)
 
-        logger.debug("Rebuilding UTXO set...")
-        utxo_manager.build_utxos_from_db()
+    if addrindex_db and not addrindex_db.complete:
+        logger.info("Address index is not in sync with the chain. Rebuilding...")
+        if not chain_manager.reindex(args.reindex_workers):
+            logger.error("Address index cannot be built on this node, disabling it")
+            chain_manager.addrindex = None
+            addrindex_db = None
 
-        logger.debug("Rebuilding TxIndex...")
-        all_blocks = db.read()
-        for block_dict in all_blocks:
-            block_hash = block_dict["BlockHeader"]["blockHash"]
-            for tx in block_dict["Txs"]:
-                txindex_db[tx["TxId"]] = block_hash
-        logger.debug("TxIndex rebuilt")
-
-        utxos_db.set_meta("last_block_hash", last_hash_chain)
-        utxos_db.commit()
-        logger.info(f"UTXO set rebuilt. {len(utxos_db)} UTXOs found")
+    if not chainstats_db.complete:
+        logger.info("Explorer totals are not in sync with the chain. Rebuilding...")
+        chain_manager.build_chain_stats()
 
     reload_mempool(mempool_db, chain_manager)
 
+    read_model = None
+    if not api_workers:
+        read_model = ExplorerReadModel(db, txindex_db, chainstats_db, utxos_db)
+        with chain_manager.chain_lock:
+            read_model.load()
+            chain_manager.add_listener(read_model)
+            # After the read model, so clients see the block it reports
+            chain_manager.add_listener(ChainEventPublisher())
+
+    snapshot_validator = None
+    snapshot_info = get_snapshot_info(db)
+    if snapshot_info and not snapshot_info["validated"]:
+        snapshot_validator = SnapshotValidator(
+            chain_manager,
+            # The node stops rather than serve a UTXO set that did not validate
+            on_invalid=lambda: mining_process_manager.update(shutdown_requested=True),
+        )
+        snapshot_validator.start()
+
     sync_manager = SyncManager(
         host,
         p2p_port,
@@ -183,13 +297,31 @@ def main():
     p2p_server_thread.daemon = True
     p2p_server_thread.start()
 
-    # API Thread
-    api_thread = Thread(
-        target=web_main, args=(utxos_db, mempool_db, api_port, p2p_port)
-    )
-    api_thread.daemon = True
-    api_thread.start()
-    logger.info(f"API server started on port {api_port}")
+    if api_workers:
+        # Workers read the chain state from disk, make it current first
+        chain_manager.flush_state(force=True)
+        api_host = config.get("API", "host", fallback="127.0.0.1")
+        start_api_workers(api_host, api_port, api_workers, addrindex_db is not None)
+        logger.info(
+            f"API server started on port {api_port} with {api_workers} worker processes"
+        )
+    else:
+        # API Thread
+        api_thread = Thread(
+            target=web_main,
+            args=(
+                db,
+                read_model,
+                utxos_db,
+                mempool_db,
+                api_port,
+                p2p_port,
+                addrindex_db,
+            ),
+        )
+        api_thread.daemon = True
+        api_thread.start()
+        logger.info(f"API server started on port {api_port}")
 
     # RPC Thread
     rpc_thread = Thread(
@@ -252,6 +384,11 @@ def main():
     except KeyboardInterrupt:
         logger.info("\nShutting down daemon...")
 
+    if snapshot_validator:
+        snapshot_validator.stop()
+    logger.debug("Flushing chain state to disk...")
+    chain_manager.flush_state(force=True)
+
 
 if __name__ == "__main__":
     main()
@@ -1,5 +1,6 @@
 import json
 import logging
+import os
 import socketserver
 import time
 from io import BytesIO
@@ -9,10 +10,11 @@ logger = logging.getLogger(__name__)
 from src.chain.difficulty import calculate_new_bits
 from src.chain.mempool import Mempool
 from src.chain.params import FEE_RATE_NORMAL, KOR
+from src.chain.snapshot import dump_snapshot, get_snapshot_info
 from src.chain.validator import Validator
 from src.core.block import Block
 from src.core.coinbase_tx import CoinbaseTx
-from src.database.db_manager import AccountDB, BlockchainDB
+from src.database.db_manager import AccountDB
 from src.database.utxo_manager import UTXOManager
 from src.utils.serialization import decode_base58
 from src.wallet.send import Send
@@ -21,16 +23,15 @@ from src.wallet.wallet import wallet
 RPC_CONTEXT = {}
 
 
-def get_block_template(mempool, utxos):
-    db = BlockchainDB()
-    last_block = db.lastBlock()
-    if not last_block:
+def get_block_template(db, mempool, utxos):
+    last_index = db.get_main_chain_tip()
+    if not last_index:
         raise Exception("Blockchain has not been initialized")
 
     mempool_manager = Mempool(mempool, utxos)
     block_data = mempool_manager.get_transactions_for_block()
 
-    height = last_block["Height"] + 1
+    height = last_index.height + 1
     coinbase_tx = CoinbaseTx(height).CoinbaseTransaction(fees=block_data["fees"])
     if not coinbase_tx:
         raise Exception("Impossible to create coinbase transaction")
@@ -38,11 +39,11 @@ def get_block_template(mempool, utxos):
     transactions = [coinbase_tx.to_dict()] + [
         tx.to_dict() for tx in block_data["transactions"]
     ]
-    bits = calculate_new_bits(height)
+    bits = calculate_new_bits(db, height)
 
     return {
         "version": 1,
-        "previous_block_hash": last_block["BlockHeader"]["blockHash"],
+        "previous_block_hash": last_index.hash,
         "transactions": transactions,
         "bits": bits.hex(),
         "height": height,
@@ -113,7 +114,7 @@ class TCPRequestHandler(socketserver.BaseRequestHandler):
                 new_block_event.wait(timeout=60.0)
                 new_block_event.clear()
                 try:
-                    template = get_block_template(mempool, utxos)
+                    template = get_block_template(chain_manager.db, mempool, utxos)
                     response = {"status": "success", "template": template}
                 except Exception as e:
                     response = {"status": "error", "message": str(e)}
@@ -156,9 +157,8 @@ class TCPRequestHandler(socketserver.BaseRequestHandler):
 
             elif cmd == "get_chain_height":
                 try:
-                    db = BlockchainDB()
-                    last_block = db.lastBlock()
-                    height = last_block["Height"] if last_block else -1
+                    tip_index = chain_manager.db.get_main_chain_tip()
+                    height = tip_index.height if tip_index else -1
                     response = {"status": "success", "height": height}
                 except Exception as e:
                     response = {
@@ -283,9 +283,8 @@ class TCPRequestHandler(socketserver.BaseRequestHandler):
 
             elif cmd == "getinfo":
                 try:
-                    db = BlockchainDB()
-                    last_block = db.lastBlock()
-                    height = last_block["Height"] if last_block else -1
+                    tip_index = chain_manager.db.get_main_chain_tip()
+                    height = tip_index.height if tip_index else -1
 
                     mempool_size = len(mempool)
 
@@ -297,6 +296,8 @@ class TCPRequestHandler(socketserver.BaseRequestHandler):
                             "height": height,
                             "mempool_size": mempool_size,
                             "wallet_count": wallet_count,
+                            "pruned": bool(chain_manager.db.prune_target),
+                            "prune_height": chain_manager.db.pruned_height,
                         },
                     }
                 except Exception as e:
@@ -305,6 +306,43 @@ class TCPRequestHandler(socketserver.BaseRequestHandler):
                         "message": f"Could not retrieve info: {e}",
                     }
 
+            elif cmd == "gettxoutsetinfo":
+                try:
+                    tip_index = chain_manager.db.get_main_chain_tip()
+                    stats = utxos.get_stats()
+                    response = {
+                        "status": "success",
+                        "info": {
+                            "height": tip_index.height if tip_index else -1,
+                            "bestblock": tip_index.hash if tip_index else None,
+                            "txouts": stats["coin_count"],
+                            "total_amount": stats["total_amount"] / KOR,
+                            "serialized_size": stats["serialized_size"],
+                            "snapshot": get_snapshot_info(chain_manager.db),
+                        },
+                    }
+                except Exception as e:
+                    response = {
+                        "status": "error",
+                        "message": f"Could not retrieve UTXO set info: {e}",
+                    }
+
+            elif cmd == "dumptxoutset":
+                try:
+                    height = chain_manager.db.get_chain_height()
+                    path = params.get("path") or os.path.join(
+                        "data", f"utxo-{height}.dat"
+                    )
+                    response = {
+                        "status": "success",
+                        "info": dump_snapshot(chain_manager, path),
+                    }
+                except Exception as e:
+                    response = {
+                        "status": "error",
+                        "message": f"Could not dump UTXO set: {e}",
+                    }
+
             elif cmd == "shutdown":
                 if mining_process_manager:
                     mining_process_manager["shutdown_requested"] = True
@@ -17,8 +17,11 @@ def _create_default_config():
 
     config["NETWORK"] = {"host": "127.0.0.1"}
     config["P2P"] = {"port": "8889"}
-    config["API"] = {"port": "8001"}
+    config["API"] = {"port": "8001", "host": "127.0.0.1", "workers": "0"}
     config["MINING"] = {"wallet": ""}
+    config["UTXO"] = {"cache_mb": "64", "flush_interval": "50"}
+    config["PRUNE"] = {"target_mb": "0"}
+    config["INDEX"] = {"addrindex": "1"}
     config["SEED_NODES"] = {}
 
     try:
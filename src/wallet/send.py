@@ -6,6 +6,7 @@ logger = logging.getLogger(__name__)
 from secp256k1 import PrivateKey
 
 from src.chain.params import KOR, TX_BASE_SIZE, TX_INPUT_SIZE, TX_OUTPUT_SIZE
+from src.core.coin import outpoint_key, parse_outpoint_key
 from src.core.transaction import Tx, TxIn, TxOut
 from src.database.db_manager import AccountDB
 from src.scripts.script import Script
@@ -71,30 +72,20 @@ class Send:
             if hasattr(tx_mem_obj, "tx_ins"):
                 for tx_in_mem in tx_mem_obj.tx_ins:
                     mempool_spent_utxos.add(
-                        f"{tx_in_mem.prev_tx.hex()}_{tx_in_mem.prev_index}"
+                        outpoint_key(tx_in_mem.prev_tx, tx_in_mem.prev_index)
                     )
         logger.debug(f"Found {len(mempool_spent_utxos)} UTXOs spent in mempool")
 
         spendable_utxos = []
-        confirmed_utxos = dict(self.utxos)
-        for key, txout in confirmed_utxos.items():
+        owned_coins = self.utxos.get_owned_coins(self.fromPubKeyHash)
+        for key, amount in owned_coins.items():
             if key in mempool_spent_utxos:
                 continue
 
-            if (
-                hasattr(txout.script_pubkey, "cmds")
-                and len(txout.script_pubkey.cmds) > 2
-                and txout.script_pubkey.cmds[2] == self.fromPubKeyHash
-            ):
-                try:
-                    tx_hex, index_str = key.split("_")
-                    index = int(index_str)
-                    spendable_utxos.append(
-                        {"tx_hex": tx_hex, "index": index, "amount": txout.amount}
-                    )
-                except (ValueError, IndexError):
-                    logger.warning(f"Could not parse UTXO key {key}")
-                    continue
+            tx_id, index = parse_outpoint_key(key)
+            spendable_utxos.append(
+                {"tx_hex": tx_id.hex(), "index": index, "amount": amount}
+            )
 
         if not spendable_utxos:
             logger.warning("No spendable UTXOs found")
@@ -107,7 +98,7 @@ class Send:
             TxIns.append(TxIn(bytes.fromhex(utxo["tx_hex"]), utxo["index"]))
             self.Total += utxo["amount"]
             logger.debug(
-                f"Selecting UTXO {utxo['tx_hex']}_{utxo['index']} with amount {utxo['amount']}. Total collected: {self.Total}"
+                f"Selecting UTXO {utxo['tx_hex']}:{utxo['index']} with amount {utxo['amount']}. Total collected: {self.Total}"
             )
 
             estimated_size = self.estimate_tx_size(num_inputs=len(TxIns), num_outputs=2)
@@ -0,0 +1,135 @@
+import json
+import os
+import shutil
+import tempfile
+import time
+import unittest
+from threading import Event
+from unittest import mock
+
+import src.chain.chain_manager as chain_manager_module
+import src.database.db_manager as db_manager_module
+import src.utils.config_loader as config_loader
+from src.chain.chain_manager import ChainManager
+from src.chain.validator import check_pow
+from src.core.block import Block
+from src.core.blockheader import BlockHeader
+from src.core.coinbase_tx import CoinbaseTx
+from src.core.genesis import create_genesis_block
+from src.database.db_manager import UTXODB, BlockchainDB, TxIndexDB
+from src.database.kvstore import CHAINSTATE_FILE, KVStore
+from src.database.utxo_cache import UTXOCache
+from src.utils.serialization import int_to_little_endian, merkle_root
+from src.wallet.wallet import wallet
+
+EASY_BITS = bytes.fromhex("ffff001f")
+
+
+def mine_block(prev_hash, height, timestamp, extra=b""):
+    coinbase = CoinbaseTx(height).CoinbaseTransaction(fees=0)
+    if extra:
+        # Makes a fork block differ from the active one at the same height
+        coinbase.tx_ins[0].script_sig.cmds.append(extra)
+    root = merkle_root([bytes.fromhex(coinbase.id())])[::-1]
+    header = BlockHeader(1, bytes.fromhex(prev_hash), root, timestamp, EASY_BITS, 0)
+    nonce = 0
+    header.nonce = nonce
+    while not check_pow(header):
+        nonce += 1
+        header.nonce = nonce
+    header.nonce = int_to_little_endian(nonce, 4)
+    size = len(header.serialize()) + len(coinbase.serialize())
+    return Block(height, size, header, 1, [coinbase])
+
+
+class ChainManagerTest(unittest.TestCase):
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.workdir = tempfile.mkdtemp()
+        os.chdir(self.workdir)
+        os.makedirs(os.path.join("data", "wallets"))
+        patches = [
+            mock.patch.object(
+                config_loader,
+                "CONFIG_PATH",
+                os.path.join(self.workdir, "data", "config.ini"),
+            ),
+            mock.patch.object(db_manager_module, "MAX_BLOCKFILE_SIZE", 1200),
+            mock.patch.object(chain_manager_module, "MIN_BLOCKS_TO_KEEP", 3),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+        keys = wallet().createKeys("miner")
+        with open(os.path.join("data", "wallets", "miner.json"), "w") as f:
+            json.dump(dict(keys), f)
+        config_loader.update_config("MINING", "wallet", "miner")
+
+        self.store = KVStore(CHAINSTATE_FILE)
+        self.db = BlockchainDB(self.store, prune_target=2500)
+        self.utxos = UTXOCache(UTXODB(self.store))
+        self.chain_manager = ChainManager(
+            self.db, self.utxos, {}, TxIndexDB(self.store), Event()
+        )
+
+    def tearDown(self):
+        self.store.close()
+        os.chdir(self.cwd)
+        shutil.rmtree(self.workdir, ignore_errors=True)
+
+    def add_genesis(self):
+        genesis = create_genesis_block()
+        genesis_hash = genesis.BlockHeader.generateBlockHash()
+        self.db.write_block(genesis)
+        self.chain_manager.connect_block(genesis)
+        self.db.set_main_chain_tip(genesis_hash)
+        self.utxos.set_meta("last_block_hash", genesis_hash)
+        self.chain_manager.flush_state(force=True)
+        return genesis
+
+    def test_block_height_must_follow_parent(self):
+        genesis_hash = self.add_genesis().BlockHeader.generateBlockHash()
+        start = int(time.time()) - 1000
+        for height in (0, 2):
+            block = mine_block(genesis_hash, height, start)
+            self.assertFalse(self.chain_manager.process_new_block(block))
+            self.assertIsNone(self.db.get_index(block.BlockHeader.generateBlockHash()))
+        self.assertTrue(
+            self.chain_manager.process_new_block(mine_block(genesis_hash, 1, start))
+        )
+        self.assertEqual(self.db.get_chain_height(), 1)
+
+    def test_reorg_below_pruned_height_is_refused(self):
+        genesis = self.add_genesis()
+        start = int(time.time()) - 1000
+        blocks = [genesis]
+        for height in range(1, 21):
+            block = mine_block(
+                blocks[-1].BlockHeader.generateBlockHash(), height, start + height
+            )
+            self.assertTrue(self.chain_manager.process_new_block(block))
+            blocks.append(block)
+        self.chain_manager.flush_state(force=True)
+        self.assertGreater(self.db.pruned_height, 2)
+
+        tip_hash = self.db.get_main_chain_tip_hash()
+        utxo_count = len(self.utxos)
+        # More work than the active chain, forking off a pruned block
+        fork = blocks[1]
+        for height in range(2, 23):
+            fork = mine_block(
+                fork.BlockHeader.generateBlockHash(),
+                height,
+                start + height + 50,
+                extra=b"fork",
+            )
+            self.chain_manager.process_new_block(fork)
+
+        self.assertEqual(self.db.get_main_chain_tip_hash(), tip_hash)
+        self.assertEqual(self.utxos.get_meta("last_block_hash"), tip_hash)
+        self.assertEqual(len(self.utxos), utxo_count)
+
+
+if __name__ == "__main__":
+    unittest.main()